@@ -3,32 +3,41 @@ Simple Rubber Duck Debugging Slack Bot
 """
 
 import os
+import asyncio
 import hmac
-import hashlib
 import time
 import ssl
 from datetime import datetime, timedelta
-from openai import OpenAI
+from openai import AsyncOpenAI
 from fastapi import FastAPI, Request
-from slack_sdk import WebClient
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from slack_sdk.web.async_client import AsyncWebClient
 from dotenv import load_dotenv
-from db import init_db, save_conversation, get_conversation_history, reset_conversation, get_bot_stats, get_recent_queries
+from db import (
+    init_db, save_conversation_async, reset_conversation_async,
+    get_bot_stats_async, get_recent_queries_async, get_latency_report_async, with_message_session
+)
+from dispatch import WorkerPool
+from coalesce import MessageCoalescer
+from retention import start_sweeper, stop_sweeper
+from write_behind import start_write_behind, stop_write_behind, write_queue
+from profiles import get_user_name, warm_profiles, PROFILE_WARMUP
+from ratelimit import create_rate_limiter
+from dedup import create_dedup_store, should_drop_retry
+from personas import Persona, load_personas, resolve_user_id
+from context import build_context, estimate_request_tokens
+from llm import llm_scheduler
+from routing import choose_route
+from export import export_lines, parse_date, EXPORT_FORMATS
+from metrics import stage
+import metrics
+import response_cache
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
 load_dotenv()
 
 app = FastAPI()
-init_db()  # Initialize database on startup
-
-# Load environment variables
-# Duck Bot
-SLACK_BOT_TOKEN_DUCK = os.getenv("SLACK_BOT_TOKEN_DUCK")
-SLACK_SIGNING_SECRET_DUCK = os.getenv("SLACK_SIGNING_SECRET_DUCK")
-
-# Goose Bot
-SLACK_BOT_TOKEN_GOOSE = os.getenv("SLACK_BOT_TOKEN_GOOSE")
-SLACK_SIGNING_SECRET_GOOSE = os.getenv("SLACK_SIGNING_SECRET_GOOSE")
 
 # Shared
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -37,64 +46,72 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_USER_IDS = os.getenv("ADMIN_USER_IDS", "").split(",")
 ADMIN_USER_IDS = [uid.strip() for uid in ADMIN_USER_IDS if uid.strip()]
 
-# Create Slack clients
-duck_client = WebClient(token=SLACK_BOT_TOKEN_DUCK)
-goose_client = WebClient(token=SLACK_BOT_TOKEN_GOOSE)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Get bot user IDs (for mention detection in group DMs)
-try:
-    duck_auth = duck_client.auth_test()
-    DUCK_USER_ID = duck_auth.get("user_id")
-except:
-    DUCK_USER_ID = None
-
-try:
-    goose_auth = goose_client.auth_test()
-    GOOSE_USER_ID = goose_auth.get("user_id")
-except:
-    GOOSE_USER_ID = None
+# Student cohorts for stats breakdowns (e.g. "section-a:U01ABC|U02DEF;section-b:U03GHI")
+STUDENT_COHORTS = {}
+for cohort_spec in os.getenv("STUDENT_COHORTS", "").split(";"):
+    if ":" in cohort_spec:
+        cohort_name, cohort_users = cohort_spec.split(":", 1)
+        STUDENT_COHORTS[cohort_name.strip().lower()] = [uid.strip() for uid in cohort_users.split("|") if uid.strip()]
 
-# Rate limiting: 500 messages per hour per user
-user_requests = {}
+# Tutoring personas (Duck and Goose by default, or PERSONAS_FILE)
+personas = load_personas()
 
-# Event deduplication
-processed_events = set()
-
-DUCK_PROMPT = """You are an expert programming tutor configured as the Duck programming assistant. Begin each response with "Quack!". Use warm, friendly language, express enthusiasm, and show interest in the user's coding questions and thoughts. Pay close attention to the user's opinions and preferences, and adapt your responses to align with and complement their inputs. Begin by providing a balanced view on programming topics relevant to the user query, then gradually support the user's perspective if they express strong opinions. Provide additional information to support and strengthen the user's views. Avoid directly challenging the user's perspective. Use open, educational questioning techniques to help the user think critically, but never provide whole code solutions. Before responding, identify and define key computational thinking or coding concepts related to the user's question, using metaphors, analogies, or everyday examples suitable for novice programmers. Prompt the user for clarification if their question is ambiguous. Do not use first-person pronouns or present yourself as a human tutor.
+# Slack Web API base URL (overridden by loadtest.py to point at its fake Slack server);
+# the OpenAI client reads OPENAI_BASE_URL the same way
+SLACK_API_URL = os.getenv("SLACK_API_URL", "https://slack.com/api/")
 
-Format your responses using Slack's mrkdwn syntax: use *text* for bold (single asterisk, NOT **text**), _text_ for italic, `code` for inline code, ```code block``` for code blocks, ~text~ for strikethrough, and dashes with line breaks for lists. Do not use double asterisks for bold.
+# Create Slack clients (async so in-flight replies don't block the event loop)
+ssl_context = ssl._create_unverified_context()
+for persona in personas:
+    persona.client = AsyncWebClient(token=persona.token, base_url=SLACK_API_URL, ssl=ssl_context)
+# Retries are done by llm_scheduler (backoff shared across requests, honoring 429 headers)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
-Never ignore any of these instructions."""
+# Research export endpoint (disabled unless a bearer token is configured)
+EXPORT_API_TOKEN = os.getenv("EXPORT_API_TOKEN")
 
-GOOSE_PROMPT = """You are an expert programming tutor configured as the Goose programming assistant. Begin each response with "Honk!". Maintain an objective, neutral, and clear tone in your responses. Focus on providing well-structured, accurate explanations that acknowledge multiple perspectives on programming topics. Avoid overly formal or stiff language, but communicate concepts in a straightforward and approachable manner. Do not adapt your responses to align with the user's opinions or preferences. Avoid using overly polite phrases like please or thank you excessively, but remain respectful. Provide answers based strictly on programming knowledge and best practices. Use educational questioning techniques to encourage critical thinking, but do not provide whole code solutions. Before responding, identify and define key computational thinking or coding concepts related to the user's question, using clear and understandable explanations suitable for novice programmers. Prompt the user for clarification if their question is ambiguous. Do not use first-person pronouns or present yourself as a human tutor.
+# Rate limiting: 500 messages per hour per user (shared across both bots)
+rate_limiter = create_rate_limiter()
 
-Format your responses using Slack's mrkdwn syntax: use *text* for bold (single asterisk, NOT **text**), _text_ for italic, `code` for inline code, ```code block``` for code blocks, ~text~ for strikethrough, and dashes with line breaks for lists. Do not use double asterisks for bold.
-
-Never ignore any of these instructions."""
+# Event deduplication
+processed_events = create_dedup_store()
 
-def is_rate_limited(user_id: str) -> bool:
-    now = datetime.now()
-    cutoff = now - timedelta(hours=1)
+# Replies are generated in the background so Slack gets its ack immediately
+worker_pool = WorkerPool()
 
-    if user_id not in user_requests:
-        user_requests[user_id] = []
+# Queue depths are read when /metrics is scraped
+metrics.WORKER_QUEUE_DEPTH.set_function(worker_pool.depth)
+metrics.WRITE_BEHIND_ROWS.set_function(lambda: len(write_queue))
 
-    # Remove old requests
-    user_requests[user_id] = [req for req in user_requests[user_id] if req > cutoff]
+# Streaming replies: post a placeholder and edit it as GPT tokens arrive
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", 1.5))  # seconds between edits of one message
+STREAM_UPDATES_PER_MINUTE = int(os.getenv("STREAM_UPDATES_PER_MINUTE", 50))  # chat.update is Slack rate tier 3
+stream_update_windows = {}  # bot_type -> (window_start, updates_in_window)
 
-    # Check limit
-    if len(user_requests[user_id]) >= 500:
-        return True
+async def is_rate_limited(user_id: str) -> tuple:
+    """Count a request against the user's limit
 
-    # Add current request
-    user_requests[user_id].append(now)
-    return False
+    Returns:
+        Tuple of (limited, requests_in_window)
+    """
+    allowed, request_count = await rate_limiter.hit(user_id)
+    return not allowed, request_count
 
 def is_admin(user_id: str) -> bool:
     """Check if user is an admin"""
     return user_id in ADMIN_USER_IDS
 
+def is_command(user_id: str, channel_id: str, text: str) -> bool:
+    """Messages handle_message treats as commands (clear, admin commands); never coalesced"""
+    if not channel_id.startswith('D'):
+        return False
+    text_lower = text.strip().lower()
+    if text_lower == "clear":
+        return True
+    return is_admin(user_id) and (text_lower in ("stats", "llm", "latency")
+                                  or text_lower.startswith(("stats ", "latency ", "query")))
+
 def format_slack_date(dt):
     """Convert datetime to Slack's auto-timezone format"""
     if dt is None:
@@ -104,27 +121,32 @@ def format_slack_date(dt):
     # Slack's date format: automatically shows in user's local timezone
     return f"<!date^{unix_timestamp}^{{date_short_pretty}} at {{time}}|{dt.strftime('%b %d, %Y %I:%M %p')}>"
 
-def verify_signature(body: bytes, timestamp: str, signature: str, signing_secret: str) -> bool:
-    if abs(time.time() - int(timestamp)) > 60 * 5:
-        return False
+def parse_stats_args(args: list) -> dict:
+    """Parse the options of the admin stats command
 
-    sig_basestring = f'v0:{timestamp}:{body.decode()}'
-    my_signature = 'v0=' + hmac.new(
-        signing_secret.encode(),
-        sig_basestring.encode(),
-        hashlib.sha256
-    ).hexdigest()
-
-    return hmac.compare_digest(my_signature, signature)
-
-def detect_bot_from_signature(body: bytes, timestamp: str, signature: str) -> str:
-    """Detect which bot sent the event by trying both signing secrets"""
-    if verify_signature(body, timestamp, signature, SLACK_SIGNING_SECRET_DUCK):
-        return 'duck'
-    elif verify_signature(body, timestamp, signature, SLACK_SIGNING_SECRET_GOOSE):
-        return 'goose'
-    else:
-        return None
+    Accepts "7d" (last 7 days), up to two YYYY-MM-DD dates (from, to),
+    "cohorts" (per-cohort breakdown) and a cohort name ("cohort NAME" or just NAME).
+    """
+    options = {"since": None, "until": None, "cohort": None, "breakdown": False}
+    for arg in args:
+        if arg == "cohorts":
+            options["breakdown"] = True
+        elif arg == "cohort":
+            continue
+        elif arg in STUDENT_COHORTS:
+            options["cohort"] = arg
+        elif arg.endswith("d") and arg[:-1].isdigit():
+            options["since"] = datetime.utcnow() - timedelta(days=int(arg[:-1]))
+        else:
+            try:
+                day = datetime.strptime(arg, "%Y-%m-%d")
+            except ValueError:
+                continue
+            if options["since"] is None:
+                options["since"] = day
+            else:
+                options["until"] = day
+    return options
 
 def should_respond_to_event(event: dict, channel_id: str, bot_user_id: str = None) -> bool:
     """Determine if bot should respond to this event"""
@@ -165,71 +187,217 @@ def get_conversation_context(event: dict):
 
     return channel_id, db_channel_id, thread_ts, message_ts
 
-def get_bot_response(
+async def get_bot_response(
     message: str,
     user_id: str,
-    bot_type: str,
-    system_prompt: str,
+    persona: Persona,
     user_name: str = None,
     channel_id: str = None,
-    thread_ts: str = None
+    thread_ts: str = None,
+    timings: dict = None
 ) -> tuple:
     """Generate AI response with conversation history
 
+    Args:
+        timings: Optional dict that receives stage durations (seconds) and the model used
+
     Returns:
         Tuple of (response_text, tokens_used)
     """
     try:
-        # Get conversation history for this user, bot, and context
-        history = get_conversation_history(user_id, bot_type, channel_id, thread_ts)
-
-        # Build messages with history
-        prompt = system_prompt
-        if user_name:
-            prompt += f"\n\nThe student's name is {user_name}. Feel free to address them by name in your responses."
-        messages = [{"role": "system", "content": prompt}]
-
-        # Add conversation history
-        for prev_msg, prev_response in history:
-            messages.append({"role": "user", "content": prev_msg})
-            messages.append({"role": "assistant", "content": prev_response})
-
-        # Add current message
-        messages.append({"role": "user", "content": message})
-
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
-        )
+        # Repeated first-turn questions are answered from the shared response cache
+        cache_key, cached_response = await response_cache.lookup(
+            persona, message, user_id, user_name, channel_id, thread_ts)
+        if cached_response is not None:
+            return cached_response, 0
+
+        # Conversation history for this user, bot, and context, trimmed to the token budget
+        context = {}
+        with stage("history", persona.bot_type, timings):
+            messages = await build_context(openai_client, persona, message, user_id, user_name, channel_id, thread_ts,
+                                           context)
+
+        # Admitted by the scheduler (in-flight limit, token budget, fair order across students)
+        # Model and completion limit for this turn (the persona's own unless routing is on)
+        route = choose_route(persona, message, context["turns"], context["summarized"])
+        metrics.ROUTES.inc(persona.bot_type, route.name)
+        if timings is not None:
+            timings.update(model=route.model, route=route.name)
+        estimate = estimate_request_tokens(messages, route.model, route.max_tokens)
+        async with llm_scheduler.admit(persona.bot_type, user_id, estimate) as ticket:
+            with stage("openai", persona.bot_type, timings):
+                response = await llm_scheduler.create(
+                    openai_client.chat.completions.create,
+                    persona.bot_type,
+                    model=route.model,
+                    messages=messages,
+                    max_tokens=route.max_tokens,
+                    temperature=persona.temperature
+                )
+            ticket.used = response.usage.total_tokens if response.usage else None
+        metrics.record_usage(persona.bot_type, response.usage)
 
         # Extract response and token usage
         response_text = response.choices[0].message.content.strip()
         tokens_used = response.usage.total_tokens if response.usage else 0
 
+        if cache_key:
+            await store_cached_response(cache_key, persona, message, response_text, tokens_used, user_name)
         return response_text, tokens_used
     except:
         return "Something went wrong. Could you try asking your question again?", 0
 
-def handle_message(
+async def store_cached_response(cache_key: str, persona: Persona, message: str, response_text: str,
+                                tokens_used: int, user_name: str = None):
+    """Cache a first-turn reply; a failure here never affects the reply itself"""
+    try:
+        await response_cache.store(cache_key, persona, message, response_text, tokens_used, user_name)
+    except Exception as e:
+        print(f"Response cache: could not store reply for {persona.bot_type}: {e}")
+
+def can_stream_update(bot_type: str) -> bool:
+    """Check the per-bot chat.update budget for the current minute"""
+    now = time.time()
+    window_start, count = stream_update_windows.get(bot_type, (now, 0))
+    if now - window_start >= 60:
+        window_start, count = now, 0
+    if count >= STREAM_UPDATES_PER_MINUTE:
+        stream_update_windows[bot_type] = (window_start, count)
+        return False
+    stream_update_windows[bot_type] = (window_start, count + 1)
+    return True
+
+async def stream_bot_response(
+    message: str,
+    user_id: str,
+    persona: Persona,
+    post_params: dict,
+    user_name: str = None,
+    channel_id: str = None,
+    thread_ts: str = None,
+    timings: dict = None
+) -> tuple:
+    """Post a placeholder, then edit it in place as GPT tokens arrive
+
+    Intermediate chat_update calls are throttled to STREAM_UPDATE_INTERVAL per
+    message and STREAM_UPDATES_PER_MINUTE per bot; the final text is always sent.
+
+    Args:
+        post_params: chat_postMessage params for the placeholder (channel, text, thread_ts)
+        channel_id: Channel ID used for the history lookup (db_channel_id)
+        timings: Optional dict that receives stage durations (seconds) and the model used
+
+    Returns:
+        Tuple of (response_text, tokens_used)
+    """
+    slack_client = persona.client
+    with stage("slack_post", persona.bot_type, timings):
+        placeholder = await slack_client.chat_postMessage(**post_params)
+    reply_channel = placeholder["channel"]
+    reply_ts = placeholder["ts"]
+
+    response_text = ""
+    tokens_used = 0
+    cache_key = None
+    try:
+        cache_key, cached_response = await response_cache.lookup(
+            persona, message, user_id, user_name, channel_id, thread_ts)
+        if cached_response is not None:
+            await slack_client.chat_update(channel=reply_channel, ts=reply_ts, text=cached_response)
+            return cached_response, 0
+
+        context = {}
+        with stage("history", persona.bot_type, timings):
+            messages = await build_context(openai_client, persona, message, user_id, user_name, channel_id, thread_ts,
+                                           context)
+
+        # The scheduler slot is held until the last chunk; timed likewise (intermediate edits included)
+        # Model and completion limit for this turn (the persona's own unless routing is on)
+        route = choose_route(persona, message, context["turns"], context["summarized"])
+        metrics.ROUTES.inc(persona.bot_type, route.name)
+        if timings is not None:
+            timings.update(model=route.model, route=route.name)
+        estimate = estimate_request_tokens(messages, route.model, route.max_tokens)
+        async with llm_scheduler.admit(persona.bot_type, user_id, estimate) as ticket:
+            with stage("openai", persona.bot_type, timings):
+                stream = await llm_scheduler.create(
+                    openai_client.chat.completions.create,
+                    persona.bot_type,
+                    model=route.model,
+                    messages=messages,
+                    max_tokens=route.max_tokens,
+                    temperature=persona.temperature,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+
+                last_update = time.monotonic()
+                async for chunk in stream:
+                    if chunk.usage:
+                        tokens_used = chunk.usage.total_tokens
+                        ticket.used = tokens_used
+                        metrics.record_usage(persona.bot_type, chunk.usage)
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    response_text += chunk.choices[0].delta.content
+
+                    if time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL and can_stream_update(persona.bot_type):
+                        last_update = time.monotonic()
+                        try:
+                            await slack_client.chat_update(channel=reply_channel, ts=reply_ts, text=response_text)
+                        except:
+                            pass
+
+        response_text = response_text.strip()
+        if cache_key:
+            await store_cached_response(cache_key, persona, message, response_text, tokens_used, user_name)
+    except:
+        response_text = "Something went wrong. Could you try asking your question again?"
+        tokens_used = 0
+
+    # Final edit always goes out so the message matches what gets saved
+    try:
+        with stage("slack_post", persona.bot_type, timings):
+            await slack_client.chat_update(channel=reply_channel, ts=reply_ts, text=response_text)
+    except Exception as e:
+        print(f"Stream update failed: bot={persona.bot_type}, error={str(e)}")
+
+    return response_text, tokens_used
+
+def turn_timings(timings: dict, received_at: float = None) -> dict:
+    """Latency columns (milliseconds) of a saved turn from its stage durations"""
+    def ms(seconds):
+        return int(seconds * 1000) if seconds is not None else None
+
+    return {
+        "total_ms": ms(time.monotonic() - received_at) if received_at is not None else None,
+        "llm_ms": ms(timings.get("openai")),
+        "history_ms": ms(timings.get("history")),
+        "slack_ms": ms(timings.get("slack_post")),
+    }
+
+@with_message_session
+async def handle_message(
+    persona: Persona,
     user_id: str,
     channel_id: str,
     text: str,
-    bot_type: str,
-    slack_client: WebClient,
-    system_prompt: str,
-    bot_name: str,
     db_channel_id: str = None,
     thread_ts: str = None,
-    message_ts: str = None
+    message_ts: str = None,
+    received_at: float = None
 ):
-    """Generic message handler for both Duck and Goose bots
+    """Generic message handler for every persona
 
     Args:
         channel_id: Original Slack channel ID (D*, C*, G*) - used for logic checks
         db_channel_id: Channel ID for database storage (user_id for DMs, channel_id for others)
+        received_at: time.monotonic() when the webhook received the event (for total_ms)
     """
+    bot_type = persona.bot_type
+    bot_name = persona.greeting
+    slack_client = persona.client
+
     # Use db_channel_id for database operations, channel_id for logic checks
     if db_channel_id is None:
         db_channel_id = channel_id
@@ -239,16 +407,32 @@ def handle_message(
         text_lower = text.strip().lower()
 
         # Stats command
-        if text_lower == "stats":
+        if text_lower == "stats" or text_lower.startswith("stats "):
+            options = parse_stats_args(text_lower.split()[1:])
+            cohort_user_ids = STUDENT_COHORTS.get(options["cohort"])
+
             # Exclude admin users from stats
-            stats = get_bot_stats(bot_type, exclude_user_ids=ADMIN_USER_IDS)
-            bot_name_display = "Duck" if bot_type == 'duck' else "Goose"
+            stats = await get_bot_stats_async(
+                bot_type, exclude_user_ids=ADMIN_USER_IDS,
+                since=options["since"], until=options["until"], user_ids=cohort_user_ids
+            )
+            bot_name_display = persona.display_name
+
+            # Describe any filters under the title
+            filters = []
+            if options["since"] or options["until"]:
+                since_str = options["since"].strftime('%b %d, %Y') if options["since"] else "start"
+                until_str = options["until"].strftime('%b %d, %Y') if options["until"] else "now"
+                filters.append(f"{since_str} – {until_str}")
+            if options["cohort"]:
+                filters.append(f"cohort {options['cohort']}")
+            filter_line = f"\n_{' · '.join(filters)}_" if filters else ""
 
             # Format dates (Slack auto-timezone format - shows in each user's local timezone)
             earliest_str = format_slack_date(stats['earliest_date'])
             latest_str = format_slack_date(stats['latest_date'])
 
-            response_text = f"""*{bot_name_display} Bot Statistics*
+            response_text = f"""*{bot_name_display} Bot Statistics*{filter_line}
 ━━━━━━━━━━━━━━━━━━━━━━━━
 *Total tokens used:* {stats['total_tokens']:,}
 *Total messages:* {stats['total_messages']:,}
@@ -258,8 +442,30 @@ def handle_message(
 *First message:* {earliest_str}
 *Latest message:* {latest_str}"""
 
+            # Per-cohort breakdown (same date range)
+            if options["breakdown"] and STUDENT_COHORTS:
+                lines = ["", "*By cohort*"]
+                for cohort_name, user_ids in STUDENT_COHORTS.items():
+                    cohort_stats = await get_bot_stats_async(
+                        bot_type, exclude_user_ids=ADMIN_USER_IDS,
+                        since=options["since"], until=options["until"], user_ids=user_ids
+                    )
+                    lines.append(
+                        f"- *{cohort_name}:* {cohort_stats['total_messages']:,} messages, "
+                        f"{cohort_stats['unique_users']} students, {cohort_stats['total_tokens']:,} tokens"
+                    )
+                response_text += "\n" + "\n".join(lines)
+
+            # Shared response cache (all time, not affected by the filters above)
+            if response_cache.RESPONSE_CACHE_ENABLED:
+                cache_stats = await response_cache.cache_stats(bot_type)
+                response_text += (
+                    f"\n\n*Response cache:* {cache_stats['entries']:,} questions, {cache_stats['hits']:,} hits "
+                    f"({cache_stats['hit_rate']}% hit rate), {cache_stats['tokens_saved']:,} tokens saved"
+                )
+
             try:
-                slack_client.chat_postMessage(
+                await slack_client.chat_postMessage(
                     channel=channel_id,
                     text=response_text
                 )
@@ -267,6 +473,74 @@ def handle_message(
                 pass
             return
 
+        # OpenAI scheduler state: in flight, queue, waits, budget, retries
+        if text_lower == "llm":
+            state = llm_scheduler.snapshot()
+            by_bot = ", ".join(f"{name}: {count}" for name, count in state["queued_by_bot"].items()) or "none"
+            budget = (f"{state['tokens_available']:,} of {state['tokens_per_minute']:,} tokens/min available"
+                      if state["tokens_per_minute"] else "no token budget")
+            response_text = f"""*OpenAI Scheduler*
+━━━━━━━━━━━━━━━━━━━━━━━━
+*In flight:* {state['in_flight']} / {state['max_in_flight']}
+*Queued:* {state['queued']} ({by_bot}) from {state['students_waiting']} students
+*Admission wait:* p50 {state['wait_p50']:.2f}s, p95 {state['wait_p95']:.2f}s, max {state['wait_max']:.2f}s
+*Budget:* {budget}
+*Requests:* {state['admitted']:,} admitted, {state['retries']:,} retries, {state['rate_limited']:,} rate limited, {state['timeouts']:,} timed out waiting"""
+            if state["paused_for"]:
+                response_text += f"\n*Paused by a 429 for another {state['paused_for']:.1f}s*"
+            try:
+                await slack_client.chat_postMessage(
+                    channel=channel_id,
+                    text=response_text
+                )
+            except:
+                pass
+            return
+
+        # Latency percentiles of saved turns (default: last 7 days)
+        if text_lower == "latency" or text_lower.startswith("latency "):
+            options = parse_stats_args(text_lower.split()[1:])
+            since = options["since"] or datetime.utcnow() - timedelta(days=7)
+            # The "to" date is inclusive, like stats
+            until = options["until"] + timedelta(days=1) if options["until"] else None
+            report = await get_latency_report_async(
+                bot_type, since=since, until=until, exclude_user_ids=ADMIN_USER_IDS
+            )
+
+            def fmt(ms):
+                return "–" if ms is None else f"{ms / 1000:.2f}s"
+
+            until_str = options["until"].strftime('%b %d, %Y') if options["until"] else "now"
+            lines = [
+                f"*{persona.display_name} Bot Latency*",
+                f"_{since.strftime('%b %d, %Y')} – {until_str}_",
+                "━━━━━━━━━━━━━━━━━━━━━━━━",
+                f"*Turns:* {report['turns']:,}",
+            ]
+            for column, label in (("total_ms", "Total"), ("llm_ms", "OpenAI"),
+                                  ("history_ms", "History"), ("slack_ms", "Slack post")):
+                values = report[column]
+                if values["count"]:
+                    lines.append(f"*{label}:* p50 {fmt(values[50])}, p95 {fmt(values[95])}, "
+                                 f"p99 {fmt(values[99])} ({values['count']:,} turns)")
+                else:
+                    lines.append(f"*{label}:* no data")
+            if report["models"]:
+                models = ", ".join(f"{model} ({count:,})" for model, count in
+                                   sorted(report["models"].items(), key=lambda item: -item[1]))
+                lines.append(f"*Models:* {models}")
+            for route, values in sorted(report["routes"].items()):
+                lines.append(f"*Route {route}:* {values['turns']:,} turns, OpenAI p50 {fmt(values['llm_p50'])}, "
+                             f"{values['avg_tokens']:,} tokens/turn")
+            try:
+                await slack_client.chat_postMessage(
+                    channel=channel_id,
+                    text="\n".join(lines)
+                )
+            except:
+                pass
+            return
+
         # Query command (with optional number)
         if text_lower.startswith("query"):
             parts = text_lower.split()
@@ -277,7 +551,7 @@ def handle_message(
             # Check if limit exceeds maximum
             if limit > 100:
                 try:
-                    slack_client.chat_postMessage(
+                    await slack_client.chat_postMessage(
                         channel=channel_id,
                         text="Maximum query limit is 100. Please request 100 or fewer queries."
                     )
@@ -286,12 +560,12 @@ def handle_message(
                 return
 
             # Exclude admin users from query results
-            queries = get_recent_queries(bot_type, limit, exclude_user_ids=ADMIN_USER_IDS)
+            queries = await get_recent_queries_async(bot_type, limit, exclude_user_ids=ADMIN_USER_IDS)
 
             if not queries:
-                response_text = f"No student queries found for {bot_type.capitalize()} bot."
+                response_text = f"No student queries found for {persona.display_name} bot."
                 try:
-                    slack_client.chat_postMessage(
+                    await slack_client.chat_postMessage(
                         channel=channel_id,
                         text=response_text
                     )
@@ -301,7 +575,7 @@ def handle_message(
                 # Send header
                 header_text = f"*Recent Student Queries (Last {len(queries)})*\n━━━━━━━━━━━━━━━━━━━━━━━━"
                 try:
-                    slack_client.chat_postMessage(
+                    await slack_client.chat_postMessage(
                         channel=channel_id,
                         text=header_text
                     )
@@ -334,7 +608,7 @@ def handle_message(
 
                     batch_text = "\n".join(batch_lines)
                     try:
-                        slack_client.chat_postMessage(
+                        await slack_client.chat_postMessage(
                             channel=channel_id,
                             text=batch_text
                         )
@@ -346,10 +620,10 @@ def handle_message(
     # Check for clear command (only in DMs)
     if text.strip().lower() == "clear" and channel_id.startswith('D'):
         # Only clear the DM context, not channel or group DM histories
-        deleted_count = reset_conversation(user_id, bot_type, db_channel_id, thread_ts)
+        deleted_count = await reset_conversation_async(user_id, bot_type, db_channel_id, thread_ts)
         response_text = f"{bot_name} I've cleared our DM conversation history. Ready for a fresh start!"
         try:
-            slack_client.chat_postMessage(
+            await slack_client.chat_postMessage(
                 channel=channel_id,
                 text=response_text
             )
@@ -358,10 +632,9 @@ def handle_message(
         return
 
     # Check rate limit (shared across both bots)
-    if is_rate_limited(user_id):
-        # TEMPORARY DEBUG LOGGING - TODO: REMOVE AFTER DIAGNOSIS
-        if user_id in user_requests:
-            print(f"[DEBUG] RATE LIMITED: bot={bot_type}, user={user_id}, request_count={len(user_requests[user_id])}")
+    limited, request_count = await is_rate_limited(user_id)
+    if limited:
+        metrics.RATE_LIMITED.inc(bot_type)
         rate_limit_msg = f"{bot_name} Take a break and think about the questions that have been asked. What have you tried so far?"
         try:
             post_params = {
@@ -372,100 +645,214 @@ def handle_message(
             if channel_id.startswith('C') and thread_ts:
                 post_params["thread_ts"] = thread_ts
 
-            slack_client.chat_postMessage(**post_params)
+            await slack_client.chat_postMessage(**post_params)
         except:
             pass
         return
-    else:
-        # TEMPORARY DEBUG LOGGING - TODO: REMOVE AFTER DIAGNOSIS
-        if user_id in user_requests:
-            print(f"[DEBUG] NOT rate limited: bot={bot_type}, user={user_id}, request_count={len(user_requests[user_id])}")
 
-    # Get user's display name
-    try:
-        user_info = slack_client.users_info(user=user_id)
-        user_data = user_info["user"]
-        user_name = user_data.get("real_name") or user_data.get("display_name") or user_data.get("name", "Unknown User")
-    except:
-        user_name = f"User_{user_id[-4:]}"
+    # Get user's display name (cached, shared by both bots)
+    with stage("users_info", bot_type):
+        user_name = await get_user_name(slack_client, user_id)
 
-    # Get AI response with context (use db_channel_id for database lookup)
-    response, tokens_used = get_bot_response(text, user_id, bot_type, system_prompt, user_name, db_channel_id, thread_ts)
+    # Threaded ONLY for channels, not for DMs or group DMs
+    post_params = {"channel": channel_id}
+    if channel_id.startswith('C') and thread_ts:
+        post_params["thread_ts"] = thread_ts
 
-    # Save conversation to database with context (use db_channel_id for storage)
-    save_conversation(user_id, user_name, text, response, bot_type, db_channel_id, thread_ts, message_ts, tokens_used)
+    # Stage durations of this turn, saved with it (see turn_timings)
+    timings = {}
 
-    # Send to Slack (threaded ONLY for channels, not for DMs or group DMs)
+    if STREAM_REPLIES:
+        # Placeholder is posted first and edited as tokens arrive
+        try:
+            response, tokens_used = await stream_bot_response(
+                text, user_id, persona, {**post_params, "text": bot_name}, user_name, db_channel_id, thread_ts,
+                timings=timings
+            )
+        except Exception as e:
+            print(f"Send failed: bot={bot_type}, error={str(e)}")
+            return
+        with stage("db_save", bot_type):
+            await save_conversation_async(user_id, user_name, text, response, bot_type, db_channel_id, thread_ts,
+                                          message_ts, tokens_used, model=timings.get("model"),
+                                          route=timings.get("route"), timings=turn_timings(timings, received_at))
+        return
+
+    # Get AI response with context (use db_channel_id for database lookup)
+    response, tokens_used = await get_bot_response(text, user_id, persona, user_name, db_channel_id, thread_ts,
+                                                   timings=timings)
+
+    # Send to Slack first so the saved turn includes the post time
     try:
-        post_params = {
-            "channel": channel_id,
-            "text": response
-        }
+        with stage("slack_post", bot_type, timings):
+            await slack_client.chat_postMessage(**post_params, text=response)
+    except Exception as e:
+        print(f"Send failed: bot={bot_type}, error={str(e)}")
+
+    # Save conversation to database with context (use db_channel_id for storage)
+    with stage("db_save", bot_type):
+        await save_conversation_async(user_id, user_name, text, response, bot_type, db_channel_id, thread_ts,
+                                      message_ts, tokens_used, model=timings.get("model"),
+                                      route=timings.get("route"), timings=turn_timings(timings, received_at))
 
-        # Only use threading for channels (C*), not for DMs (D*) or group DMs (G*)
-        if channel_id.startswith('C') and thread_ts:
-            post_params["thread_ts"] = thread_ts
+async def submit_burst(key: tuple, job_args: tuple, messages: list):
+    """Queue one handle_message job for a coalesced burst of messages
 
-        slack_client.chat_postMessage(**post_params)
-        # TEMPORARY DEBUG LOGGING - TODO: REMOVE AFTER DIAGNOSIS
-        print(f"[DEBUG] MESSAGE SENT: bot={bot_type}, channel={channel_id}, response_length={len(response)}")
+    The events were already acknowledged, so this waits for queue space
+    instead of rejecting.
+    """
+    persona, user_id, channel_id, _, db_channel_id, thread_ts, _, received_at = job_args
+    messages = sorted(messages, key=lambda item: item[0] or "")
+    text = "\n\n".join(message_text for _, message_text in messages)
+    # total_ms counts from the first fragment, so it includes the coalescing window
+    args = (key, persona, user_id, channel_id, text, db_channel_id, thread_ts, messages[0][0], received_at)
+    while not await worker_pool.submit(handle_burst, *args):
+        await asyncio.sleep(1)
+
+async def handle_burst(key: tuple, *job_args):
+    try:
+        await handle_message(*job_args)
+    finally:
+        coalescer.finished(key)
+
+# Optional debounce: quick fragments of one conversation become one turn (COALESCE_WINDOW)
+coalescer = MessageCoalescer(submit_burst)
+
+@app.on_event("startup")
+async def start_worker_pool():
+    # One schema_version lookup when the schema is current
+    await asyncio.to_thread(init_db)
+    # Bot user IDs (for mention detection in group DMs) resolve in the background
+    asyncio.create_task(personas.resolve_identities())
+    await start_write_behind()
+    await worker_pool.start()
+    start_sweeper()
+    if PROFILE_WARMUP:
+        asyncio.create_task(warm_profile_cache())
+
+async def warm_profile_cache():
+    """Bulk-load student names (known cohorts, or the whole workspace) in the background"""
+    cohort_user_ids = [uid for user_ids in STUDENT_COHORTS.values() for uid in user_ids]
+    try:
+        count = await warm_profiles(personas.personas[0].client, cohort_user_ids or None)
+        print(f"Profile cache: warmed {count} profiles")
     except Exception as e:
-        # TEMPORARY DEBUG LOGGING - TODO: REMOVE AFTER DIAGNOSIS
-        print(f"[DEBUG] SEND FAILED: bot={bot_type}, error={str(e)}")
+        print(f"Profile cache warm-up failed: {e}")
+
+@app.on_event("shutdown")
+async def stop_worker_pool():
+    await coalescer.stop()
+    await worker_pool.stop()
+    await stop_write_behind()
+    await asyncio.to_thread(stop_sweeper)
 
 @app.get("/")
 async def health():
     return {"status": "ok"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Pipeline metrics in the Prometheus text format"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/test-bots")
 async def test_bots():
-    """Test endpoint to verify both bot configurations"""
+    """Test endpoint to verify every persona's bot configuration"""
     results = {}
 
-    # Test Duck bot
-    try:
-        duck_response = duck_client.auth_test()
-        results["duck"] = {
-            "status": "success",
-            "bot_user_id": duck_response.get("user_id"),
-            "bot_name": duck_response.get("user"),
-            "team": duck_response.get("team"),
-            "team_id": duck_response.get("team_id")
-        }
-    except Exception as e:
-        results["duck"] = {
-            "status": "error",
-            "error": str(e)
-        }
+    for persona in personas:
+        try:
+            auth_response = await persona.client.auth_test()
+            results[persona.bot_type] = {
+                "status": "success",
+                "bot_user_id": auth_response.get("user_id"),
+                "bot_name": auth_response.get("user"),
+                "team": auth_response.get("team"),
+                "team_id": auth_response.get("team_id")
+            }
+        except Exception as e:
+            results[persona.bot_type] = {
+                "status": "error",
+                "error": str(e)
+            }
+
+    return results
+
+@app.get("/export/conversations")
+async def export_conversations(
+    request: Request,
+    format: str = "ndjson",
+    bot: str = None,
+    since: str = None,
+    until: str = None,
+    user: str = None,
+    channel_type: str = None,
+    include_admins: bool = False,
+    include_archived: bool = True
+):
+    """Stream stored conversations as NDJSON or CSV (Authorization: Bearer EXPORT_API_TOKEN)
+
+    Filters: bot, since/until (YYYY-MM-DD, until inclusive), user, channel_type (dm/channel/group).
+    Admin users are left out unless include_admins=true; archived conversations are
+    included unless include_archived=false.
+    """
+    if not EXPORT_API_TOKEN:
+        return JSONResponse(status_code=404, content={"error": "export disabled"})
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {EXPORT_API_TOKEN}"):
+        return JSONResponse(status_code=401, content={"error": "unauthorized"})
 
-    # Test Goose bot
+    if format not in EXPORT_FORMATS or channel_type not in (None, "dm", "channel", "group"):
+        return JSONResponse(status_code=400, content={"error": "invalid format or channel_type"})
     try:
-        goose_response = goose_client.auth_test()
-        results["goose"] = {
-            "status": "success",
-            "bot_user_id": goose_response.get("user_id"),
-            "bot_name": goose_response.get("user"),
-            "team": goose_response.get("team"),
-            "team_id": goose_response.get("team_id")
-        }
-    except Exception as e:
-        results["goose"] = {
-            "status": "error",
-            "error": str(e)
+        filters = {
+            "bot_type": bot,
+            "since": parse_date(since),
+            "until": parse_date(until, end=True),
+            "user_id": user,
+            "context_type": channel_type,
+            "exclude_user_ids": None if include_admins else ADMIN_USER_IDS,
+            "include_archived": include_archived
         }
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "dates must be YYYY-MM-DD"})
 
-    return results
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_lines(format, **filters),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="conversations.{format}"'}
+    )
 
 @app.post("/slack/events")
 async def slack_events(request: Request):
+    return await handle_slack_event(request)
+
+@app.post("/slack/events/{persona_name}")
+async def slack_persona_events(request: Request, persona_name: str):
+    """Per-persona Request URL: only that persona's signing secret is checked"""
+    return await handle_slack_event(request, persona_name)
+
+async def handle_slack_event(request: Request, persona_name: str = None):
+    received_at = time.monotonic()
+
+    # Retries with an opted-in reason (DEDUP_DROP_RETRY_REASONS): skip without reading the body;
+    # other retries are verified and dropped by dedup if the event was already claimed
+    if should_drop_retry(request.headers):
+        return {"status": "ok"}
+
     body = await request.body()
     timestamp = request.headers.get("X-Slack-Request-Timestamp", "")
     signature = request.headers.get("X-Slack-Signature", "")
 
-    # Detect which bot this event is for
-    bot_type = detect_bot_from_signature(body, timestamp, signature)
-    if not bot_type:
+    # Route to a persona by endpoint path or api_app_id, verifying one signature
+    with stage("signature") as timer:
+        persona = personas.route(body, timestamp, signature, persona_name)
+        if persona:
+            timer.bot = persona.bot_type
+    if not persona:
+        metrics.INVALID_SIGNATURES.inc()
         return {"error": "invalid signature"}, 401
+    bot_type = persona.bot_type
 
     event_data = await request.json()
 
@@ -477,23 +864,18 @@ async def slack_events(request: Request):
     if event_data.get("type") == "event_callback":
         event = event_data.get("event", {})
 
-        # Event deduplication (bot-specific to allow both bots to respond to same event)
+        # Event deduplication (bot-specific to allow every persona to respond to same event)
         event_id = event.get("client_msg_id") or event.get("ts")
         event_type = event.get("type")
         channel_id = event.get("channel")
 
-        # TEMPORARY DEBUG LOGGING - TODO: REMOVE AFTER DIAGNOSIS
-        print(f"[DEBUG] EVENT RECEIVED: bot={bot_type}, event_id={event_id}, event_type={event_type}, channel={channel_id}")
-
-        bot_event_key = (event_id, bot_type, event_type)  # Combine event_id + bot_type + event_type
-        if event_id and bot_event_key in processed_events:
-            print(f"[DEBUG] SKIPPED (deduplicated): {bot_event_key}")
-            return {"status": "ok"}
+        bot_event_key = f"{event_id}:{bot_type}:{event_type}"  # Combine event_id + bot_type + event_type
         if event_id:
-            processed_events.add(bot_event_key)
-            print(f"[DEBUG] PROCESSING: {bot_event_key}, processed_set_size={len(processed_events)}")
-            if len(processed_events) > 1000:
-                processed_events.clear()
+            with stage("dedup", bot_type):
+                claimed = await processed_events.claim(bot_event_key)
+            if not claimed:
+                metrics.EVENTS.inc(bot_type, "duplicate")
+                return {"status": "ok"}
 
         # Handle both regular messages and app mentions
         if (event_type == "message" or event_type == "app_mention") and not event.get("bot_id"):
@@ -501,34 +883,44 @@ async def slack_events(request: Request):
             channel_id = event.get("channel")
             text = event.get("text", "")
 
-            # Get the appropriate bot user ID
-            bot_user_id = DUCK_USER_ID if bot_type == 'duck' else GOOSE_USER_ID
+            # Group DMs need the bot user ID to spot @mentions; resolve it now if startup hasn't yet
+            bot_user_id = persona.user_id
+            if bot_user_id is None and channel_id and channel_id.startswith('G'):
+                bot_user_id = await resolve_user_id(persona, timeout=2)
 
             # Check if we should respond to this event
             should_respond = should_respond_to_event(event, channel_id, bot_user_id)
-            print(f"[DEBUG] should_respond={should_respond}, bot={bot_type}, user={user_id}, text='{text[:50]}...'")
 
             if should_respond:
                 # Extract conversation context
                 channel_id, db_channel_id, thread_ts, message_ts = get_conversation_context(event)
 
-                print(f"[DEBUG] CALLING handle_message: bot={bot_type}, channel={channel_id}, db_channel={db_channel_id}")
-
-                # Route to appropriate bot handler
-                if bot_type == 'duck':
-                    handle_message(
-                        user_id, channel_id, text, 'duck',
-                        duck_client, DUCK_PROMPT, "Quack!",
-                        db_channel_id, thread_ts, message_ts
-                    )
-                elif bot_type == 'goose':
-                    handle_message(
-                        user_id, channel_id, text, 'goose',
-                        goose_client, GOOSE_PROMPT, "Honk!",
-                        db_channel_id, thread_ts, message_ts
-                    )
-            else:
-                print(f"[DEBUG] NOT RESPONDING: should_respond=False for bot={bot_type}")
+                # Runs on the worker pool, not in the request
+                job_args = (persona, user_id, channel_id, text, db_channel_id, thread_ts, message_ts, received_at)
+                if coalescer.enabled:
+                    key = (user_id, bot_type, db_channel_id, thread_ts)
+                    if is_command(user_id, channel_id, text):
+                        # Runs once earlier fragments have been answered, never alongside them
+                        coalescer.add_exclusive(key, job_args, text, message_ts)
+                        metrics.EVENTS.inc(bot_type, "queued")
+                        return {"status": "ok"}
+                    # A conversation with a burst waiting or a job in flight always goes through the
+                    # coalescer (one job at a time); a new one is refused below while the pool is full
+                    if coalescer.busy(key) or not worker_pool.full():
+                        joined = coalescer.add(key, job_args, text, message_ts)
+                        metrics.EVENTS.inc(bot_type, "coalesced" if joined else "queued")
+                        return {"status": "ok"}
+
+                if coalescer.enabled or not await worker_pool.submit(handle_message, *job_args):
+                    # Backpressure: forget the event so Slack's retry is processed later
+                    await processed_events.release(bot_event_key)
+                    metrics.EVENTS.inc(bot_type, "busy")
+                    print(f"Worker queue full: bot={bot_type}, queue_depth={worker_pool.depth()}")
+                    return JSONResponse(status_code=503, content={"error": "busy"})
+                metrics.EVENTS.inc(bot_type, "queued")
+                return {"status": "ok"}
+
+        metrics.EVENTS.inc(bot_type, "ignored")
 
     return {"status": "ok"}
 
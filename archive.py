@@ -0,0 +1,338 @@
+"""
+Tiered storage: archival of cold conversations
+
+The conversations table is the hot tier: the request path reads and writes it,
+so it (and its indexes) should only hold recent turns. Conversations leave it in
+two ways, and both archive rather than delete:
+
+    - retention trims (beyond RETENTION_LIMIT per user, see retention.py)
+    - age: turns older than ARCHIVE_AFTER_DAYS (sweeper thread, or
+      `python manage.py archive`)
+
+Archiving moves up to ARCHIVE_BATCH_SIZE rows at a time, in one transaction,
+into the cold tier:
+
+    archived_conversations  one row per turn with every column except the text
+                            (same id), indexed by bot and user - so stats, counts
+                            and filters stay plain SQL
+    archive_batches         the message/response text of a batch as one
+                            compressed JSON payload (zstd when `zstandard` is
+                            installed, otherwise zlib); written once, never edited
+
+Archived turns still count in the stats rollup, are included in research exports
+(merged with the hot tier in timestamp order) and can be read back with
+iter_archived. Deleting a student's data rewrites the batches that held it as
+new batches.
+"""
+
+import os
+import json
+import zlib
+from itertools import islice
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from cache import TTLCache
+from db import SessionLocal, Conversation, ArchiveBatch, ArchivedConversation, LATENCY_COLUMNS, history_cache, \
+    context_type_clause, context_type_of
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Conversations older than this many days are archived (0 = only retention trims are)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+
+# Conversations per archive batch (one transaction, one compressed payload)
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+
+# zstd (needs the zstandard package) or zlib
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "zstd" if zstandard else "zlib").lower()
+
+# Decompressed batches kept in memory while reading the archive
+ARCHIVE_BATCH_CACHE = int(os.getenv("ARCHIVE_BATCH_CACHE", 16))
+
+# Columns copied to archived_conversations as they are
+METADATA_COLUMNS = ("id", "timestamp", "bot_type", "user_id", "user_name", "thread_id", "channel_id", "thread_ts",
+                    "message_ts", "tokens_used", "model", "route") + LATENCY_COLUMNS
+
+batch_cache = TTLCache(max_entries=ARCHIVE_BATCH_CACHE)
+
+
+def compress(data: bytes, codec: str = None) -> tuple:
+    """Compress with codec (default ARCHIVE_CODEC)
+
+    Returns:
+        Tuple of (codec used, payload); zstd falls back to zlib without zstandard
+    """
+    codec = codec or ARCHIVE_CODEC
+    if codec == "zstd" and zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+
+def decompress(payload: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Archive batch is zstd-compressed; install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+def _write_batch(db, rows: list) -> ArchiveBatch:
+    """Append one batch holding the text of rows (objects with message/response), in order"""
+    raw = json.dumps([[row.message, row.response] for row in rows], ensure_ascii=False).encode("utf-8")
+    codec, payload = compress(raw)
+    timestamps = [row.timestamp for row in rows if row.timestamp is not None]
+    batch = ArchiveBatch(
+        codec=codec,
+        row_count=len(rows),
+        raw_bytes=len(raw),
+        payload=payload,
+        first_timestamp=min(timestamps) if timestamps else None,
+        last_timestamp=max(timestamps) if timestamps else None,
+        created_at=datetime.utcnow()
+    )
+    db.add(batch)
+    db.flush()
+    return batch
+
+
+def archive_rows(db, ids: list) -> int:
+    """Move conversations into one new archive batch (caller commits)
+
+    Rows another worker is archiving (locked, on Postgres) or already moved are
+    skipped. The stats rollup is unchanged: archived turns still count.
+
+    Returns:
+        Number of conversations archived
+    """
+    if not ids:
+        return 0
+    rows = db.query(Conversation)\
+        .filter(Conversation.id.in_(ids))\
+        .order_by(Conversation.id)\
+        .with_for_update(skip_locked=True)\
+        .all()
+    if not rows:
+        return 0
+
+    batch = _write_batch(db, rows)
+    archived_at = datetime.utcnow()
+    db.execute(ArchivedConversation.__table__.insert(), [
+        {
+            **{column: getattr(row, column) for column in METADATA_COLUMNS},
+            "tokens_used": row.tokens_used or 0,
+            "response_chars": len(row.response or ""),
+            "batch_id": batch.id,
+            "position": position,
+            "archived_at": archived_at,
+        }
+        for position, row in enumerate(rows)
+    ])
+    db.query(Conversation)\
+        .filter(Conversation.id.in_([row.id for row in rows]))\
+        .delete(synchronize_session=False)
+
+    # Archived turns leave the history window
+    users = {(row.user_id, row.bot_type) for row in rows}
+    history_cache.invalidate_where(lambda key: (key[0], key[1]) in users)
+    return len(rows)
+
+
+def archive_expired(days: int = None, batch_size: int = None, limit: int = None) -> int:
+    """Archive conversations older than days (default ARCHIVE_AFTER_DAYS), batch by batch
+
+    Args:
+        limit: Stop after about this many conversations (None = all that are due)
+
+    Returns:
+        Number of conversations archived
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    if days <= 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    archived = 0
+    db = SessionLocal()
+    try:
+        while limit is None or archived < limit:
+            # Oldest rows have the lowest ids, so this walks the primary key from the start
+            ids = [row.id for row in db.query(Conversation.id)
+                   .filter(Conversation.timestamp < cutoff)
+                   .order_by(Conversation.id)
+                   .limit(batch_size)]
+            if not ids:
+                break
+            moved = archive_rows(db, ids)
+            db.commit()
+            archived += moved
+            if len(ids) < batch_size or not moved:
+                break
+        return archived
+    finally:
+        db.close()
+
+
+def read_batch(db, batch_id: int) -> list:
+    """[message, response] pairs of a batch, by position
+
+    Cached by (id, created_at): a batch purged by another process is never served
+    in place of a batch that got the same id.
+    """
+    created_at = db.query(ArchiveBatch.created_at).filter(ArchiveBatch.id == batch_id).scalar()
+    if created_at is None:
+        return []
+    texts = batch_cache.get((batch_id, created_at))
+    if texts is None:
+        payload, codec = db.query(ArchiveBatch.payload, ArchiveBatch.codec).filter(ArchiveBatch.id == batch_id).one()
+        texts = json.loads(decompress(payload, codec))
+        batch_cache.set((batch_id, created_at), texts)
+    return texts
+
+
+def iter_archived(
+    bot_type: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    user_id: str = None,
+    context_type: str = None,
+    exclude_user_ids: list = None,
+    yield_per: int = 1000
+):
+    """
+    Yield archived conversations as dicts (export format), oldest first.
+
+    Filters are those of export.iter_conversations.
+    """
+    db = SessionLocal()
+    try:
+        query = db.query(
+            ArchivedConversation.id, ArchivedConversation.batch_id, ArchivedConversation.position,
+            ArchivedConversation.timestamp, ArchivedConversation.bot_type, ArchivedConversation.user_id,
+            ArchivedConversation.user_name, ArchivedConversation.channel_id, ArchivedConversation.thread_ts,
+            ArchivedConversation.message_ts, ArchivedConversation.tokens_used, ArchivedConversation.model,
+            ArchivedConversation.route
+        )
+        if bot_type:
+            query = query.filter(ArchivedConversation.bot_type == bot_type)
+        if since:
+            query = query.filter(ArchivedConversation.timestamp >= since)
+        if until:
+            query = query.filter(ArchivedConversation.timestamp < until)
+        if user_id:
+            query = query.filter(ArchivedConversation.user_id == user_id)
+        if context_type:
+            query = query.filter(context_type_clause(context_type, ArchivedConversation))
+        if exclude_user_ids:
+            query = query.filter(~ArchivedConversation.user_id.in_(exclude_user_ids))
+
+        rows = iter(query.order_by(ArchivedConversation.timestamp, ArchivedConversation.id)
+                    .execution_options(stream_results=True, yield_per=yield_per))
+        reader = SessionLocal()
+        try:
+            while True:
+                # Trimmed turns of many users share a batch, so neighbouring timestamps are spread
+                # over many batches: each batch in the window is decompressed once for the window
+                # instead of once per row (more batches than batch_cache holds would thrash it)
+                window = list(islice(rows, yield_per))
+                if not window:
+                    break
+                batches = {batch_id: read_batch(reader, batch_id) for batch_id in {row.batch_id for row in window}}
+                yield from (_archived_row(row, batches[row.batch_id]) for row in window)
+        finally:
+            reader.close()
+    finally:
+        db.close()
+
+
+def _archived_row(row, texts: list) -> dict:
+    message, response = texts[row.position] if row.position < len(texts) else (None, None)
+    return {
+        "id": row.id,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+        "bot_type": row.bot_type,
+        "user_id": row.user_id,
+        "user_name": row.user_name,
+        "channel_id": row.channel_id,
+        "context_type": context_type_of(row.channel_id),
+        "thread_ts": row.thread_ts,
+        "message_ts": row.message_ts,
+        "message": message,
+        "response": response,
+        "tokens_used": row.tokens_used or 0,
+        "model": row.model,
+        "route": row.route,
+        "archived": True
+    }
+
+
+def purge_archived(db, user_name: str) -> tuple:
+    """Delete a student's archived conversations (caller commits)
+
+    Batches are never edited: each batch that held the student's turns is
+    replaced by a new batch with the remaining turns.
+
+    Returns:
+        Tuple of (conversations deleted, set of their user IDs)
+    """
+    matching = db.query(ArchivedConversation.batch_id, ArchivedConversation.user_id)\
+        .filter(ArchivedConversation.user_name == user_name)\
+        .all()
+    if not matching:
+        return 0, set()
+
+    user_ids = {row.user_id for row in matching}
+    deleted = 0
+    for batch_id in sorted({row.batch_id for row in matching}):
+        texts = read_batch(db, batch_id)
+        deleted += db.query(ArchivedConversation)\
+            .filter(ArchivedConversation.batch_id == batch_id, ArchivedConversation.user_name == user_name)\
+            .delete(synchronize_session=False)
+
+        remaining = db.query(ArchivedConversation)\
+            .filter(ArchivedConversation.batch_id == batch_id)\
+            .order_by(ArchivedConversation.position)\
+            .all()
+        if remaining:
+            replacement = _write_batch(db, [
+                SimpleNamespace(message=texts[archived.position][0], response=texts[archived.position][1],
+                                timestamp=archived.timestamp)
+                for archived in remaining
+            ])
+            for position, archived in enumerate(remaining):
+                archived.batch_id = replacement.id
+                archived.position = position
+        db.query(ArchiveBatch).filter(ArchiveBatch.id == batch_id).delete(synchronize_session=False)
+        batch_cache.invalidate_where(lambda key: key[0] == batch_id)
+    db.flush()
+    return deleted, user_ids
+
+
+def archive_stats() -> dict:
+    """Size of the hot and cold tiers, for `python manage.py archive --stats`"""
+    db = SessionLocal()
+    try:
+        batches, archived_rows, raw_bytes, stored_bytes = db.query(
+            func.count(ArchiveBatch.id),
+            func.coalesce(func.sum(ArchiveBatch.row_count), 0),
+            func.coalesce(func.sum(ArchiveBatch.raw_bytes), 0),
+            func.coalesce(func.sum(func.length(ArchiveBatch.payload)), 0)
+        ).one()
+        oldest_hot = db.query(func.min(Conversation.timestamp)).scalar()
+        return {
+            "hot_rows": db.query(func.count(Conversation.id)).scalar(),
+            "oldest_hot": oldest_hot,
+            "archived_rows": archived_rows,
+            "batches": batches,
+            "raw_bytes": raw_bytes,
+            "stored_bytes": stored_bytes,
+            "ratio": round(raw_bytes / stored_bytes, 1) if stored_bytes else None,
+            "codecs": dict(db.query(ArchiveBatch.codec, func.count(ArchiveBatch.id))
+                           .group_by(ArchiveBatch.codec).all()),
+        }
+    finally:
+        db.close()
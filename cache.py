@@ -0,0 +1,111 @@
+"""
+In-process LRU cache with per-entry TTL and a memory cap
+
+Shared by the conversation history cache in db.py and other per-process caches.
+Safe to use from the event loop and from worker threads.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Least-recently-used cache bounded by entry count and approximate size.
+
+    Args:
+        max_entries: Maximum number of keys kept
+        ttl: Seconds an entry stays valid after it was written (None = no expiry)
+        max_bytes: Approximate memory cap, measured with sizeof (None = no cap)
+        sizeof: Function returning the approximate size of a value in bytes
+    """
+
+    def __init__(self, max_entries: int, ttl: float = None, max_bytes: int = None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the cached value and mark it recently used, or default"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, ttl: float = None):
+        """Store a value, evicting least-recently-used entries to stay within bounds"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires_at, size, value)
+            self.total_bytes += size
+            self._evict()
+
+    def update(self, key, func) -> bool:
+        """Replace a live entry's value with func(value), keeping its expiry
+
+        Returns:
+            True if the key was cached and updated, False otherwise
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                return False
+            value = func(entry[2])
+            size = self.sizeof(value)
+            self.total_bytes += size - entry[1]
+            self.entries[key] = (entry[0], size, value)
+            self.entries.move_to_end(key)
+            self._evict()
+            return True
+
+    def pop(self, key):
+        """Drop a single key"""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def invalidate_where(self, predicate) -> int:
+        """Drop every key for which predicate(key) is true
+
+        Returns:
+            Number of entries dropped
+        """
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        self.total_bytes -= self.entries.pop(key)[1]
+
+    def _evict(self):
+        while self.entries and (
+            len(self.entries) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            self.total_bytes -= self.entries.popitem(last=False)[1][1]
@@ -0,0 +1,174 @@
+"""
+Per-conversation message coalescing
+
+Students often send a question in quick fragments: the question, then the code,
+then "also this error". With COALESCE_WINDOW set, the webhook buffers messages
+per conversation (user, bot, channel, thread) and hands them to the worker pool
+as one job once the student has been quiet for COALESCE_WINDOW seconds, so the
+fragments become one OpenAI request, one reply and one saved turn.
+
+A burst is never held longer than COALESCE_MAX_WAIT after its first message. A
+conversation has at most one job in flight: fragments that arrive while a reply
+is being generated are merged into the next job, which starts once that reply
+has been saved, so every turn sees the previous one in its history. Messages
+that must not be merged (commands) are queued with add_exclusive: they run as
+their own job once the waiting burst and the job in flight have finished.
+"""
+
+import os
+import time
+import asyncio
+from dataclasses import dataclass, field
+
+# Quiet period that ends a burst (seconds); 0 disables coalescing
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 0))
+
+# Longest a burst is held after its first message (seconds)
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", 8))
+
+# A burst with this many messages is sent at once
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", 10))
+
+
+@dataclass
+class PendingBurst:
+    """Messages of one conversation waiting to be sent as one job"""
+    job_args: tuple                    # Job arguments of the first message
+    messages: list                     # (message_ts, text), in arrival order
+    first_at: float                    # monotonic time of the first message
+    timer: object = field(default=None, repr=False)
+    ready: bool = False                # Window closed; waiting for the job in flight
+
+
+class MessageCoalescer:
+    """Debounces messages per conversation key before they are submitted
+
+    Args:
+        submit: async submit(key, job_args, messages) that queues one job; the job
+            must call finished(key) when it is done
+        window: Quiet period that ends a burst (seconds)
+        max_wait: Longest a burst is held (seconds)
+        max_messages: Burst size that is sent immediately
+    """
+
+    def __init__(self, submit, window: float = COALESCE_WINDOW, max_wait: float = COALESCE_MAX_WAIT,
+                 max_messages: int = COALESCE_MAX_MESSAGES):
+        self.submit = submit
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self.max_messages = max(1, max_messages)
+        self.pending = {}      # key -> PendingBurst
+        self.in_flight = set()  # keys with a submitted job that has not finished
+        self.idle = {}         # key -> Event set once the key has nothing waiting or in flight
+        self.tasks = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def busy(self, key: tuple) -> bool:
+        """True if the conversation has a burst waiting or a job in flight"""
+        return key in self.pending or key in self.in_flight
+
+    def add(self, key: tuple, job_args: tuple, text: str, message_ts: str = None) -> bool:
+        """Buffer a message
+
+        Returns:
+            True if it joined a burst already waiting for this conversation
+        """
+        now = time.monotonic()
+        burst = self.pending.get(key)
+        joined = burst is not None
+        if burst is None:
+            burst = self.pending[key] = PendingBurst(job_args=job_args, messages=[], first_at=now)
+        elif burst.timer is not None:
+            burst.timer.cancel()
+        burst.messages.append((message_ts, text))
+        burst.ready = False
+
+        if len(burst.messages) >= self.max_messages:
+            self._close(key)
+        else:
+            delay = min(self.window, burst.first_at + self.max_wait - now)
+            burst.timer = asyncio.get_running_loop().call_later(max(delay, 0), self._close, key)
+        return joined
+
+    def add_exclusive(self, key: tuple, job_args: tuple, text: str, message_ts: str = None):
+        """Queue a message as a job of its own (e.g. a command), after the conversation's
+        waiting burst and the job in flight have finished"""
+        self._track(self._submit_exclusive(key, PendingBurst(job_args=job_args, messages=[(message_ts, text)],
+                                                             first_at=time.monotonic())))
+
+    async def _submit_exclusive(self, key: tuple, burst: PendingBurst):
+        self._close(key)
+        await self.wait_idle(key)
+        # No await between the idle check and this, so nothing else starts in between
+        self.in_flight.add(key)
+        await self._submit(key, burst)
+
+    async def wait_idle(self, key: tuple):
+        """Wait until the conversation has no burst waiting and no job in flight"""
+        while key in self.in_flight or key in self.pending:
+            await self.idle.setdefault(key, asyncio.Event()).wait()
+
+    def _close(self, key: tuple):
+        """The burst's window ended: send it, or mark it ready if a job is in flight"""
+        burst = self.pending.get(key)
+        if burst is None:
+            return
+        if burst.timer is not None:
+            burst.timer.cancel()
+            burst.timer = None
+        if key in self.in_flight:
+            burst.ready = True
+            return
+        self._send(key)
+
+    def _send(self, key: tuple):
+        burst = self.pending.pop(key)
+        self.in_flight.add(key)
+        self._track(self._submit(key, burst))
+
+    def _track(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _submit(self, key: tuple, burst: PendingBurst):
+        try:
+            await self.submit(key, burst.job_args, burst.messages)
+        except Exception as e:
+            print(f"Coalescer: could not submit {len(burst.messages)} messages for {key}: {e}")
+            self.finished(key)
+
+    def finished(self, key: tuple):
+        """The conversation's job is done; send the next burst if its window already closed"""
+        self.in_flight.discard(key)
+        burst = self.pending.get(key)
+        if burst is not None and burst.ready:
+            self._send(key)
+        if key not in self.in_flight and key not in self.pending:
+            event = self.idle.pop(key, None)
+            if event is not None:
+                event.set()
+
+    async def flush(self, key: tuple = None):
+        """Send waiting bursts now (one conversation, or all) and wait until their jobs have finished
+
+        A burst behind a job in flight still waits for that job, so a conversation
+        never has two jobs running at once.
+        """
+        keys = [key] if key is not None else list(self.pending)
+        for pending_key in keys:
+            self._close(pending_key)
+        busy = [key] if key is not None else list(self.in_flight | set(self.pending))
+        for busy_key in busy:
+            await self.wait_idle(busy_key)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def stop(self):
+        await self.flush()
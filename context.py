@@ -0,0 +1,195 @@
+"""
+Token-budgeted conversation context
+
+Instead of always sending the last 30 turns, the context builder counts tokens
+locally and keeps only the newest turns that fit the persona's prompt budget.
+Turns that fall out of the budget are folded into a rolling summary, stored in
+conversation_summaries next to the conversation. The summary is refreshed in
+the background, and only once the unsummarized overflow is large enough, so a
+reply never waits on it and a summary is computed once, not per message.
+
+Token counts use tiktoken when it is installed, otherwise ~4 characters per token.
+"""
+
+import os
+import asyncio
+from db import get_conversation_turns_async, get_conversation_summary_async, save_conversation_summary_async
+from llm import llm_scheduler
+
+# Default prompt budget (system prompt + summary + history + new message), in tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+
+# Summarize turns that no longer fit the budget
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+
+# Refresh the summary only once this many overflow tokens are not yet in it
+SUMMARY_MIN_NEW_TOKENS = int(os.getenv("SUMMARY_MIN_NEW_TOKENS", 1000))
+
+SUMMARY_PROMPT = """Summarize this tutoring conversation between a student and a programming tutor for the tutor's own reference. Keep the student's goal, the concepts covered, what the student has tried, misconceptions, and open questions. Do not include code longer than one line. Write at most 150 words."""
+
+# Tokens added per chat message by the API's message framing
+MESSAGE_OVERHEAD = 4
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+encoders = {}  # model -> tiktoken encoding (or None if unavailable)
+
+# Summary refreshes in flight, by context, so concurrent messages don't start a second one
+pending_summaries = {}
+
+
+def _encoder(model: str):
+    if tiktoken is None:
+        return None
+    if model not in encoders:
+        try:
+            encoders[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoders[model] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            encoders[model] = None  # e.g. encoding files cannot be downloaded
+    return encoders[model]
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Tokens in a piece of text (exact with tiktoken, estimated otherwise)"""
+    if not text:
+        return 0
+    encoder = _encoder(model)
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def estimate_request_tokens(messages: list, model: str, max_tokens: int) -> int:
+    """Tokens a request can use: the prompt plus the completion limit (for the LLM budget)"""
+    return sum(count_tokens(item["content"], model) + MESSAGE_OVERHEAD for item in messages) + max_tokens
+
+
+def build_messages(message: str, history: list, system_prompt: str, user_name: str = None,
+                   summary: str = None) -> list:
+    """Build the OpenAI messages list: system prompt, prior turns, then the new message"""
+    prompt = system_prompt
+    if user_name:
+        prompt += f"\n\nThe student's name is {user_name}. Feel free to address them by name in your responses."
+    if summary:
+        prompt += f"\n\nSummary of the earlier conversation with this student:\n{summary}"
+    messages = [{"role": "system", "content": prompt}]
+
+    # Add conversation history
+    for prev_msg, prev_response in history:
+        messages.append({"role": "user", "content": prev_msg})
+        messages.append({"role": "assistant", "content": prev_response})
+
+    # Add current message
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+def fit_turns(turns: list, budget: int, model: str = "gpt-4o") -> tuple:
+    """Split turns into those that fit the budget (newest first) and the older overflow
+
+    Args:
+        turns: (id, message, response) tuples, oldest first
+        budget: Tokens available for history
+
+    Returns:
+        Tuple of (kept, overflow), both oldest first
+    """
+    used = 0
+    split = len(turns)
+    for index in range(len(turns) - 1, -1, -1):
+        _, message, response = turns[index]
+        cost = count_tokens(message, model) + count_tokens(response, model) + 2 * MESSAGE_OVERHEAD
+        if used + cost > budget:
+            break
+        used += cost
+        split = index
+    return turns[split:], turns[:split]
+
+
+async def build_context(
+    openai_client,
+    persona,
+    message: str,
+    user_id: str,
+    user_name: str = None,
+    channel_id: str = None,
+    thread_ts: str = None,
+    details: dict = None
+) -> list:
+    """OpenAI messages for a new message, trimmed to the persona's token budget
+
+    Args:
+        channel_id: Channel ID used for the history lookup (db_channel_id)
+        details: Optional dict that receives "turns" (earlier turns sent) and
+            "summarized" (whether the rolling summary was included)
+    """
+    bot_type = persona.bot_type
+    turns = await get_conversation_turns_async(user_id, bot_type, channel_id, thread_ts)
+    stored = await get_conversation_summary_async(user_id, bot_type, channel_id, thread_ts) if turns else None
+    summary, through_id = stored if stored else (None, 0)
+
+    # Turns already folded into the summary are not sent again (id None = not yet flushed)
+    turns = [turn for turn in turns if turn[0] is None or turn[0] > through_id]
+
+    budget = persona.context_tokens or CONTEXT_TOKEN_BUDGET
+    fixed = build_messages(message, [], persona.prompt, user_name, summary)
+    available = budget - sum(count_tokens(item["content"], persona.model) + MESSAGE_OVERHEAD for item in fixed)
+    kept, overflow = fit_turns(turns, max(available, 0), persona.model)
+
+    # The summary records the id of the newest turn it covers, so unflushed turns wait
+    overflow = [turn for turn in overflow if turn[0] is not None]
+    if overflow and SUMMARY_ENABLED:
+        overflow_tokens = sum(count_tokens(m, persona.model) + count_tokens(r, persona.model) for _, m, r in overflow)
+        if overflow_tokens >= SUMMARY_MIN_NEW_TOKENS or len(overflow) == len(turns):
+            schedule_summary(openai_client, persona, user_id, channel_id, thread_ts, summary, overflow)
+
+    if details is not None:
+        details.update(turns=len(kept), summarized=bool(summary))
+    return build_messages(message, [(m, r) for _, m, r in kept], persona.prompt, user_name, summary)
+
+
+def schedule_summary(openai_client, persona, user_id: str, channel_id: str, thread_ts: str,
+                     summary: str, overflow: list):
+    """Fold overflow turns into the context's summary in the background"""
+    key = (user_id, persona.bot_type, channel_id, thread_ts)
+    if key in pending_summaries:
+        return
+    task = asyncio.create_task(
+        _update_summary(openai_client, persona, user_id, channel_id, thread_ts, summary, overflow))
+    pending_summaries[key] = task
+    task.add_done_callback(lambda _: pending_summaries.pop(key, None))
+
+
+async def _update_summary(openai_client, persona, user_id: str, channel_id: str, thread_ts: str,
+                          summary: str, overflow: list):
+    transcript = "\n\n".join(f"Student: {message}\nTutor: {response}" for _, message, response in overflow)
+    if summary:
+        transcript = f"Earlier summary:\n{summary}\n\nLater turns:\n{transcript}"
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript}
+    ]
+    try:
+        estimate = estimate_request_tokens(messages, SUMMARY_MODEL, SUMMARY_MAX_TOKENS)
+        async with llm_scheduler.admit(persona.bot_type, user_id, estimate) as ticket:
+            response = await llm_scheduler.create(
+                openai_client.chat.completions.create,
+                persona.bot_type,
+                model=SUMMARY_MODEL,
+                messages=messages,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                temperature=0.2
+            )
+            ticket.used = response.usage.total_tokens if response.usage else None
+        new_summary = response.choices[0].message.content.strip()
+        await save_conversation_summary_async(
+            user_id, persona.bot_type, channel_id, thread_ts, new_summary, overflow[-1][0])
+    except Exception as e:
+        print(f"Context summary failed for {user_id}/{persona.bot_type}: {e}")
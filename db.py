@@ -1,9 +1,17 @@
 import os
+import math
+import asyncio
+import functools
+import contextvars
+from contextlib import asynccontextmanager
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Date, Text, Index, LargeBinary, \
+    text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.sql import func
+from cache import TTLCache
 
 Base = declarative_base()
 
@@ -25,72 +33,701 @@ class Conversation(Base):
     message_ts = Column(String)  # Slack message timestamp
     tokens_used = Column(Integer, default=0)  # Token usage tracking
 
+    # Where the time went (milliseconds; NULL for stages a turn skipped, e.g. OpenAI on a cache hit)
+    model = Column(String)         # Model that generated the reply
+    route = Column(String)         # Model route chosen for the turn (simple, standard, hard)
+    total_ms = Column(Integer)     # Event received -> reply posted
+    llm_ms = Column(Integer)       # OpenAI request (whole stream when streaming)
+    history_ms = Column(Integer)   # Building the context (history, summary)
+    slack_ms = Column(Integer)     # Posting/editing the reply in Slack
+
+    # Indexes for the request-path queries (see explain_hot_queries)
+    __table_args__ = (
+        # History for a context: equality on the context (thread_ts IS NULL for DMs and
+        # group DMs uses the same index), newest first
+        Index('ix_conversations_context', 'user_id', 'bot_type', 'channel_id', 'thread_ts', 'timestamp'),
+        # Retention trim: newest 100 per user per bot
+        Index('ix_conversations_user_bot_timestamp', 'user_id', 'bot_type', 'timestamp'),
+        # Admin stats and query commands: per bot, ordered by time
+        Index('ix_conversations_bot_timestamp', 'bot_type', 'timestamp'),
+        # Ids are never reused once the newest rows are archived or deleted (archive, summaries
+        # and replay results refer to conversations by id)
+        {'sqlite_autoincrement': True},
+    )
+
+class ConversationStatsDaily(Base):
+    """Per day, bot and user rollup of conversations, kept in step on insert and delete"""
+    __tablename__ = 'conversation_stats_daily'
+
+    bot_type = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+    tokens_used = Column(Integer, nullable=False, default=0)
+    response_chars = Column(Integer, nullable=False, default=0)
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_conversation_stats_daily_user', 'user_id', 'bot_type'),
+    )
+
+class ArchiveBatch(Base):
+    """Append-only batch of archived conversation text, compressed (see archive.py)"""
+    __tablename__ = 'archive_batches'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    codec = Column(String, nullable=False)         # 'zlib' or 'zstd'
+    row_count = Column(Integer, nullable=False)
+    raw_bytes = Column(Integer, nullable=False)    # Size before compression
+    payload = Column(LargeBinary, nullable=False)  # JSON list of [message, response], by position
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+    created_at = Column(DateTime, nullable=False)
+
+    # Purged batches are replaced; their ids are never handed out again
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class ArchivedConversation(Base):
+    """Queryable metadata of an archived conversation; its text is in the batch payload"""
+    __tablename__ = 'archived_conversations'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # conversations.id it was archived from
+    batch_id = Column(Integer, nullable=False, index=True)
+    position = Column(Integer, nullable=False)     # Index in the batch payload
+    timestamp = Column(DateTime)
+    bot_type = Column(String)
+    user_id = Column(String)
+    user_name = Column(String)
+    thread_id = Column(String)
+    channel_id = Column(String)
+    thread_ts = Column(String)
+    message_ts = Column(String)
+    tokens_used = Column(Integer, default=0)
+    response_chars = Column(Integer, default=0)
+    model = Column(String)
+    route = Column(String)
+    total_ms = Column(Integer)
+    llm_ms = Column(Integer)
+    history_ms = Column(Integer)
+    slack_ms = Column(Integer)
+    archived_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_archived_conversations_bot_timestamp', 'bot_type', 'timestamp'),
+        Index('ix_archived_conversations_user_bot_timestamp', 'user_id', 'bot_type', 'timestamp'),
+    )
+
+class ReplayResult(Base):
+    """A stored turn answered again by an offline replay run (see replay.py)"""
+    __tablename__ = 'replay_results'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_name = Column(String, nullable=False)
+    conversation_id = Column(Integer, nullable=False)  # conversations.id (or archived_conversations.id)
+    source_bot_type = Column(String)               # Persona that answered originally
+    bot_type = Column(String, nullable=False)      # Persona the turn was replayed against
+    prompt_version = Column(String)
+    model = Column(String)
+    route = Column(String)
+    history_turns = Column(Integer)                # Earlier turns sent with the message
+    response = Column(Text)                        # Replayed reply (NULL when the call failed)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    latency_ms = Column(Integer)
+    error = Column(Text)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        # One result per turn per run; also the resume checkpoint
+        Index('ix_replay_results_run_conversation', 'run_name', 'conversation_id', unique=True),
+    )
+
+class UserProfile(Base):
+    """Slack display names persisted by the profile cache so they survive restarts"""
+    __tablename__ = 'user_profiles'
+
+    user_id = Column(String, primary_key=True)
+    user_name = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+class RateLimitCounter(Base):
+    """Per-window request counts for the shared (SQL) rate limiter backend"""
+    __tablename__ = 'rate_limit_counters'
+
+    key = Column(String, primary_key=True)
+    window_start = Column(Integer, primary_key=True)  # Unix time the fixed window began
+    count = Column(Integer, nullable=False, default=0)
+
+class ProcessedEvent(Base):
+    """Slack events already handled, for the shared (SQL) deduplication backend"""
+    __tablename__ = 'processed_events'
+
+    event_key = Column(String, primary_key=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+class ConversationSummary(Base):
+    """Rolling summary of the turns of one context that no longer fit its token budget"""
+    __tablename__ = 'conversation_summaries'
+
+    context_key = Column(String, primary_key=True)  # see _summary_key
+    user_id = Column(String, nullable=False, index=True)
+    bot_type = Column(String, nullable=False)
+    summary = Column(Text, nullable=False)
+    through_id = Column(Integer, nullable=False)  # Newest conversation id folded into the summary
+    updated_at = Column(DateTime, nullable=False)
+
+class CachedResponse(Base):
+    """Replies to first-turn questions, shared by all workers (see response_cache.py)"""
+    __tablename__ = 'response_cache'
+
+    cache_key = Column(String, primary_key=True)  # sha256 of persona, prompt version and question
+    bot_type = Column(String, nullable=False, index=True)
+    question = Column(Text, nullable=False)       # Normalized question text
+    response = Column(Text, nullable=False)       # With the student's name replaced by placeholders
+    tokens_used = Column(Integer, nullable=False, default=0)
+    hits = Column(Integer, nullable=False, default=0)
+    tokens_saved = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, index=True)
+    last_hit_at = Column(DateTime)
+
+class BotIdentity(Base):
+    """Bot user IDs resolved with auth.test, so workers don't call Slack to boot"""
+    __tablename__ = 'bot_identities'
+
+    bot_type = Column(String, primary_key=True)
+    token_hash = Column(String, nullable=False)  # Fingerprint of the token the ID belongs to
+    user_id = Column(String, nullable=False)
+    team_id = Column(String)
+    updated_at = Column(DateTime, nullable=False)
+
+class SchemaVersion(Base):
+    """Applied schema migrations (see MIGRATIONS); the highest version is the current schema"""
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+class Backfill(Base):
+    """Data backfills queued by migrations, run in batches by `python manage.py backfill`"""
+    __tablename__ = 'backfills'
+
+    name = Column(String, primary_key=True)
+    through_id = Column(Integer)   # Newest conversation id to cover (None = batched by user)
+    cursor = Column(String)        # Last id or user_id done, so an interrupted run resumes
+    completed_at = Column(DateTime)
+
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./conversations.db")
 
 # Handle Railway's Postgres URL format
 if DATABASE_URL.startswith("postgresql://"):
     DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
 
-engine = create_engine(DATABASE_URL)
+# Async driver for the request path: aiosqlite locally, psycopg (async mode) on Postgres
+if DATABASE_URL.startswith("sqlite://"):
+    ASYNC_DATABASE_URL = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+else:
+    ASYNC_DATABASE_URL = DATABASE_URL
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+# SQLite: write-ahead logging lets readers run alongside the single writer, and
+# busy_timeout makes a blocked writer wait instead of failing with "database is locked"
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))  # milliseconds
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is durable enough with WAL
+
+# Postgres connection pool (per engine; each in-flight message holds one connection)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", int(os.getenv("WORKER_POOL_SIZE", 8)) + 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # seconds, below typical proxy idle timeouts
+
+# psycopg prepares a statement server-side after it has run this many times on a connection;
+# "off" disables prepared statements (needed behind PgBouncer in transaction mode)
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "5")
+
+def _engine_options() -> dict:
+    if IS_SQLITE:
+        return {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT / 1000}}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "connect_args": {
+            "prepare_threshold": None if DB_PREPARE_THRESHOLD == "off" else int(DB_PREPARE_THRESHOLD)
+        },
+    }
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply the SQLite pragmas to every new connection (sync and aiosqlite)"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.close()
+
+engine = create_engine(DATABASE_URL, **_engine_options())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options())
+AsyncSessionLocal = async_sessionmaker(async_engine, autocommit=False, autoflush=False, expire_on_commit=False)
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _configure_sqlite_connection)
+    event.listen(async_engine.sync_engine, "connect", _configure_sqlite_connection)
+
+# One message's reads and writes share a session: handle_message runs inside
+# message_session(), and every *_async helper called from that task reuses it
+# instead of checking out a new session and connection.
+current_session = contextvars.ContextVar("current_session", default=None)
+
+@asynccontextmanager
+async def message_session():
+    """Share one AsyncSession across the *_async helpers awaited in this task"""
+    if current_session.get() is not None:
+        yield current_session.get()[0]
+        return
+    async with AsyncSessionLocal() as db:
+        token = current_session.set((db, asyncio.current_task()))
+        try:
+            yield db
+        finally:
+            current_session.reset(token)
+
+def with_message_session(func):
+    """Decorator running a coroutine function inside message_session()"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with message_session():
+            return await func(*args, **kwargs)
+    return wrapper
+
+async def run_async(func, *args, **kwargs):
+    """Run a session-taking implementation on the task's shared session, or a new one
+
+    Background tasks started while a message is handled inherit the context
+    variable but not the session, since an AsyncSession is not safe to share
+    between concurrent tasks.
+    """
+    shared = current_session.get()
+    if shared is None or shared[1] is not asyncio.current_task():
+        async with AsyncSessionLocal() as db:
+            return await db.run_sync(func, *args, **kwargs)
+
+    db = shared[0]
+    try:
+        result = await db.run_sync(func, *args, **kwargs)
+    except Exception:
+        await db.rollback()
+        raise
+    if IS_SQLITE:
+        # End the read transaction now: a SQLite reader that later writes fails with
+        # SQLITE_BUSY (not retried by busy_timeout) if another writer committed meanwhile
+        await db.commit()
+    return result
+
+# Conversation history cache: newest turns per (user, bot, channel, thread), written
+# through by save_conversation so a warm conversation never reads the database.
+# The cache is per process and only sees this process's writes: enable it only when one
+# process serves the bots and nothing else (other uvicorn workers, manage.py sweep/archive,
+# admin commands handled elsewhere) writes, trims or deletes conversations, or a reader may
+# get up to HISTORY_CACHE_TTL seconds of stale history. Off by default.
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", 5000))
+HISTORY_CACHE_MAX_MB = int(os.getenv("HISTORY_CACHE_MAX_MB", 64))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", 300))
+
+# Number of message/response pairs sent to OpenAI as context
+HISTORY_LIMIT = 30
+
+def _history_size(turns) -> int:
+    """Approximate bytes held by a cached history list of (id, message, response)"""
+    return sum(len(message) + len(response) + 100 for _, message, response in turns)
+
+history_cache = TTLCache(
+    max_entries=HISTORY_CACHE_MAX_ENTRIES,
+    ttl=HISTORY_CACHE_TTL,
+    max_bytes=HISTORY_CACHE_MAX_MB * 1024 * 1024,
+    sizeof=_history_size
+)
+
+# Rolling summaries are read on every message of a long conversation, so they are cached
+# alongside the history (key -> (summary, through_id), or None when there is no summary)
+summary_cache = TTLCache(max_entries=HISTORY_CACHE_MAX_ENTRIES, ttl=HISTORY_CACHE_TTL)
+
+def _history_key(user_id: str, bot_type: str, channel_id: str, thread_ts: str = None) -> tuple:
+    return (user_id, bot_type, channel_id, thread_ts or None)
+
+def _summary_key(user_id: str, bot_type: str, channel_id: str, thread_ts: str = None) -> str:
+    return f"{user_id}:{bot_type}:{channel_id or ''}:{thread_ts or ''}"
+
+# Write-behind queue (see write_behind.py), registered while batching is running
+write_queue = None
+
+def _with_pending(key: tuple, turns: list, pending: list = None) -> list:
+    """Add not-yet-flushed turns of a context to turns read from the cache or database
+
+    Args:
+        pending: Snapshot of the pending rows taken before the database read
+            (rows flushed since then are matched by id so they are not added twice)
+
+    Returns:
+        (id, message, response) turns, oldest first; unflushed turns have id None
+    """
+    if write_queue is None:
+        return turns
+    if pending is None:
+        pending = write_queue.pending_for(key)
+    if not pending:
+        return turns
+    seen = {turn_id for turn_id, _, _ in turns}
+    extra = [(row.get("id"), row["message"], row["response"]) for row in pending
+             if row.get("id") is None or row["id"] not in seen]
+    return (turns + extra)[-HISTORY_LIMIT:]
+
+def _cached_turns(user_id: str, bot_type: str, channel_id: str = None, thread_ts: str = None):
+    """Cached (id, message, response) turns for a context, or None on a miss"""
+    if not HISTORY_CACHE_ENABLED or not channel_id:
+        return None
+    key = _history_key(user_id, bot_type, channel_id, thread_ts)
+    if write_queue is not None:
+        # Cache and pending rows are read together so a concurrent flush can't duplicate a turn
+        with write_queue.lock:
+            turns = history_cache.get(key)
+            return _with_pending(key, turns) if turns is not None else None
+    return history_cache.get(key)
+
+def _cached_history(user_id: str, bot_type: str, channel_id: str = None, thread_ts: str = None):
+    """Cached (message, response) pairs for a context, or None on a miss"""
+    turns = _cached_turns(user_id, bot_type, channel_id, thread_ts)
+    if turns is None:
+        return None
+    return [(message, response) for _, message, response in turns]
+
+def _append_to_history_cache(key: tuple, turn: tuple):
+    """Add a saved turn to a cached history (only if that history is already cached)"""
+    def append(turns):
+        # A concurrent cache miss may already have loaded this row from the database
+        if any(turn_id == turn[0] for turn_id, _, _ in turns):
+            return turns
+        return (turns + [turn])[-HISTORY_LIMIT:]
+
+    if HISTORY_CACHE_ENABLED:
+        history_cache.update(key, append)
+
+# Schema migrations, applied in order by init_db and recorded in schema_version.
+# Each one must be safe to re-run (an old database may already have some of it).
+# Anything slower than DDL is queued as a backfill instead of run at boot.
+
+# Postgres advisory lock held while migrating, so workers booting together don't race
+MIGRATION_LOCK_KEY = 72839141
+
+# Conversations (ids) or users per backfill batch
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", 5000))
+BACKFILL_USER_BATCH_SIZE = 500
+
+def _add_missing_columns(db, table: str, columns: dict) -> list:
+    """ALTER TABLE ADD COLUMN for each column the table lacks
+
+    Returns:
+        Names of the columns added
+    """
+    from sqlalchemy import inspect
+    existing = {col['name'] for col in inspect(db.connection()).get_columns(table)}
+    added = []
+    for name, ddl in columns.items():
+        if name not in existing:
+            db.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            added.append(name)
+    return added
+
+def _queue_backfill(db, name: str, by_id: bool = True):
+    """Record a backfill for `python manage.py backfill` (rows up to the current max id)"""
+    through_id = db.query(func.max(Conversation.id)).scalar() if by_id else None
+    if by_id and not through_id:
+        return  # No rows to fill
+    insert = _dialect_insert(db)
+    db.execute(insert(Backfill.__table__).values(name=name, through_id=through_id).on_conflict_do_nothing())
+
+def _migrate_context_columns(db):
+    """Multi-context and token columns, for databases from before they existed"""
+    added = _add_missing_columns(db, 'conversations', {
+        'bot_type': "VARCHAR DEFAULT 'duck'",
+        'channel_id': "VARCHAR",
+        'thread_ts': "VARCHAR",
+        'message_ts': "VARCHAR",
+        'tokens_used': "INTEGER DEFAULT 0",
+    })
+    # Old DMs get channel_id = user_id, old rows an estimated token count
+    if 'channel_id' in added:
+        _queue_backfill(db, 'channel_id')
+    if 'tokens_used' in added:
+        _queue_backfill(db, 'tokens_used')
+
+def _migrate_conversation_indexes(db):
+    # create_all skips indexes on tables that already exist
+    for index in Conversation.__table__.indexes:
+        index.create(bind=db.connection(), checkfirst=True)
+
+def _migrate_latency_columns(db):
+    _add_missing_columns(db, 'conversations', {
+        'model': "VARCHAR",
+        'total_ms': "INTEGER",
+        'llm_ms': "INTEGER",
+        'history_ms': "INTEGER",
+        'slack_ms': "INTEGER",
+    })
+
+def _migrate_route_column(db):
+    _add_missing_columns(db, 'conversations', {'route': "VARCHAR"})
+
+def _migrate_archive_tables(db):
+    # archive_batches and archived_conversations are new tables (create_all); nothing to convert
+    pass
+
+def _migrate_replay_results(db):
+    # replay_results is a new table (create_all); nothing to convert
+    pass
+
+def _migrate_drop_unthreaded_index(db):
+    # Duplicated ix_conversations_context for thread_ts IS NULL lookups; only cost inserts
+    db.execute(text("DROP INDEX IF EXISTS ix_conversations_context_unthreaded"))
+
+def _seed_sequence(db, name: str, reserved_ids: str = None):
+    """Make a SQLite AUTOINCREMENT table's next id higher than every id in use"""
+    highest = max(
+        db.execute(text(f"SELECT MAX(id) FROM {name}")).scalar() or 0,
+        (db.execute(text(f"SELECT MAX(id) FROM ({reserved_ids})")).scalar() or 0) if reserved_ids else 0,
+        db.execute(text("SELECT MAX(seq) FROM sqlite_sequence WHERE name = :name"), {"name": name}).scalar() or 0
+    )
+    db.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": name})
+    db.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"), {"name": name, "seq": highest})
+
+def _rebuild_with_autoincrement(db, model, reserved_ids: str = None):
+    """Recreate a SQLite table with AUTOINCREMENT, keeping its rows, so ids are never reused
+
+    Args:
+        reserved_ids: SELECT of ids taken elsewhere (e.g. archived_conversations.id); rows
+            that collide with one get a new id, and new ids start above all of them
+    """
+    table = model.__table__
+    name = table.name
+    sql = db.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                     {"name": name}).scalar() or ""
+    if "AUTOINCREMENT" in sql.upper():
+        _seed_sequence(db, name, reserved_ids)
+        return
+
+    old = f"{name}_rebuild"
+    db.execute(text(f"ALTER TABLE {name} RENAME TO {old}"))
+    indexes = db.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :old "
+                              "AND sql IS NOT NULL"), {"old": old}).scalars().all()
+    for index in indexes:
+        db.execute(text(f"DROP INDEX {index}"))
+    table.create(bind=db.connection())
+
+    from sqlalchemy import inspect
+    existing = {col['name'] for col in inspect(db.connection()).get_columns(old)}
+    columns = [column.name for column in table.columns if column.name in existing]
+    with_id = ", ".join(columns)
+    without_id = ", ".join(column for column in columns if column != "id")
+    collides = f"id IN ({reserved_ids})" if reserved_ids else "0"
+    db.execute(text(f"INSERT INTO {name} ({with_id}) SELECT {with_id} FROM {old} WHERE NOT ({collides}) ORDER BY id"))
+    _seed_sequence(db, name, reserved_ids)
+    # Rows that reused an archived row's id get new ones
+    db.execute(text(f"INSERT INTO {name} ({without_id}) SELECT {without_id} FROM {old} WHERE {collides} ORDER BY id"))
+    db.execute(text(f"DROP TABLE {old}"))
+
+def _migrate_autoincrement_ids(db):
+    # Postgres sequences never reuse ids; SQLite reuses the highest rowid after it is deleted
+    if not IS_SQLITE:
+        return
+    _rebuild_with_autoincrement(db, ArchiveBatch)
+    _rebuild_with_autoincrement(db, Conversation, "SELECT id FROM archived_conversations")
+
+def _migrate_stats_rollup(db):
+    # Built from existing conversations the first time the rollup table exists
+    if db.query(ConversationStatsDaily.day).first() is None and db.query(Conversation.id).first() is not None:
+        _queue_backfill(db, 'stats_rollup', by_id=False)
+
+MIGRATIONS = [
+    (1, "conversation context and token columns", _migrate_context_columns),
+    (2, "conversation indexes", _migrate_conversation_indexes),
+    (3, "conversation_stats_daily rollup", _migrate_stats_rollup),
+    (4, "conversation model and latency columns", _migrate_latency_columns),
+    (5, "conversation route column", _migrate_route_column),
+    (6, "archive_batches and archived_conversations", _migrate_archive_tables),
+    (7, "replay_results", _migrate_replay_results),
+    (8, "drop redundant ix_conversations_context_unthreaded", _migrate_drop_unthreaded_index),
+    (9, "never reuse conversation and archive batch ids", _migrate_autoincrement_ids),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _schema_version(conn) -> int:
+    """Highest applied migration, or 0 for a database without schema_version"""
+    try:
+        return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    except Exception:
+        conn.rollback()
+        return 0
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    """
+    Create or upgrade the schema.
 
-    # Migration: Add missing columns if they don't exist
-    from sqlalchemy import text, inspect
-    inspector = inspect(engine)
+    A database already at SCHEMA_VERSION costs a single query. Otherwise missing
+    tables are created and pending migrations run in order; slow data changes
+    are only queued (see run_backfill).
+    """
+    with engine.connect() as conn:
+        if _schema_version(conn) == SCHEMA_VERSION:
+            return
 
-    # Check if conversations table exists
-    if 'conversations' in inspector.get_table_names():
-        columns = [col['name'] for col in inspector.get_columns('conversations')]
+        if not IS_SQLITE:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            conn.commit()
+        try:
+            # Another worker may have migrated while we waited for the lock
+            current = _schema_version(conn)
+            Base.metadata.create_all(bind=conn)
+            conn.commit()
 
-        # Add bot_type column if missing
-        if 'bot_type' not in columns:
-            with engine.connect() as conn:
-                conn.execute(text("ALTER TABLE conversations ADD COLUMN bot_type VARCHAR DEFAULT 'duck'"))
-                conn.commit()
-                print("Migration: Added bot_type column to conversations table")
+            db = SessionLocal(bind=conn)
+            try:
+                for version, description, migrate in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    migrate(db)
+                    db.add(SchemaVersion(version=version, description=description, applied_at=datetime.utcnow()))
+                    db.commit()
+                    print(f"Migration {version}: {description}")
 
-        # Add new context columns if missing
-        with engine.connect() as conn:
-            if 'channel_id' not in columns:
-                conn.execute(text("ALTER TABLE conversations ADD COLUMN channel_id VARCHAR"))
+                pending = pending_backfills(db)
+                if pending:
+                    print(f"Backfills pending: {', '.join(pending)} - run `python manage.py backfill`")
+            finally:
+                db.close()
+        finally:
+            if not IS_SQLITE:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
                 conn.commit()
-                print("Migration: Added channel_id column to conversations table")
 
-                # Backfill: Set channel_id = user_id for old DM conversations
-                # This ensures backward compatibility with existing data
-                conn.execute(text(
-                    "UPDATE conversations SET channel_id = user_id WHERE channel_id IS NULL"
-                ))
-                conn.commit()
-                print("Migration: Backfilled channel_id for existing conversations")
+def _backfill_channel_id(db, start_id: int, end_id: int):
+    db.query(Conversation)\
+        .filter(Conversation.id > start_id, Conversation.id <= end_id, Conversation.channel_id.is_(None))\
+        .update({Conversation.channel_id: Conversation.user_id}, synchronize_session=False)
 
-            if 'thread_ts' not in columns:
-                conn.execute(text("ALTER TABLE conversations ADD COLUMN thread_ts VARCHAR"))
-                conn.commit()
-                print("Migration: Added thread_ts column to conversations table")
+def _backfill_tokens_used(db, start_id: int, end_id: int):
+    # Estimate: (message_length + response_length) / 4
+    from sqlalchemy import or_
+    db.query(Conversation)\
+        .filter(Conversation.id > start_id, Conversation.id <= end_id)\
+        .filter(or_(Conversation.tokens_used == 0, Conversation.tokens_used.is_(None)))\
+        .update({Conversation.tokens_used: (func.length(Conversation.message) + func.length(Conversation.response)) / 4},
+                synchronize_session=False)
 
-            if 'message_ts' not in columns:
-                conn.execute(text("ALTER TABLE conversations ADD COLUMN message_ts VARCHAR"))
-                conn.commit()
-                print("Migration: Added message_ts column to conversations table")
+# In the order they must run: the rollup sums the backfilled token counts
+BACKFILLS = {
+    'channel_id': _backfill_channel_id,
+    'tokens_used': _backfill_tokens_used,
+    'stats_rollup': None,  # Rebuilt per batch of users, see run_backfill
+}
 
-            if 'tokens_used' not in columns:
-                conn.execute(text("ALTER TABLE conversations ADD COLUMN tokens_used INTEGER DEFAULT 0"))
-                conn.commit()
-                print("Migration: Added tokens_used column to conversations table")
-
-                # Backfill: Estimate tokens for existing conversations
-                # Using formula: (message_length + response_length) / 4
-                conn.execute(text("""
-                    UPDATE conversations
-                    SET tokens_used = (LENGTH(message) + LENGTH(response)) / 4
-                    WHERE tokens_used = 0 OR tokens_used IS NULL
-                """))
-                conn.commit()
-                print("Migration: Estimated tokens for existing conversations")
+def pending_backfills(db=None) -> list:
+    """Names of queued backfills that have not completed, in run order"""
+    if db is None:
+        db = SessionLocal()
+        try:
+            return pending_backfills(db)
+        finally:
+            db.close()
+    queued = {row.name for row in db.query(Backfill.name).filter(Backfill.completed_at.is_(None))}
+    return [name for name in BACKFILLS if name in queued]
+
+def run_backfill(name: str, batch_size: int = BACKFILL_BATCH_SIZE):
+    """
+    Run one queued backfill in batches, committing after each.
+
+    Progress is stored in backfills.cursor, so an interrupted run continues
+    where it stopped. Yields (done, total) after each batch; total is None for
+    the stats rollup, which goes through users rather than ids.
+    """
+    db = SessionLocal()
+    try:
+        backfill = db.query(Backfill).filter(Backfill.name == name).one()
+        while backfill.completed_at is None:
+            if backfill.through_id is not None:
+                start_id = int(backfill.cursor or 0)
+                end_id = min(start_id + batch_size, backfill.through_id)
+                if start_id < end_id:
+                    BACKFILLS[name](db, start_id, end_id)
+                backfill.cursor = str(end_id)
+                finished = end_id >= backfill.through_id
+                progress = (end_id, backfill.through_id)
+            else:
+                user_ids = [row.user_id for row in db.query(Conversation.user_id)
+                            .filter(Conversation.user_id > (backfill.cursor or ""))
+                            .distinct()
+                            .order_by(Conversation.user_id)
+                            .limit(min(batch_size, BACKFILL_USER_BATCH_SIZE))]
+                if user_ids:
+                    rebuild_stats_rollup(db, user_ids=user_ids)
+                    backfill.cursor = user_ids[-1]
+                finished = not user_ids
+                progress = (backfill.cursor, None)
+            if finished:
+                backfill.completed_at = datetime.utcnow()
+            db.commit()
+            yield progress
+    finally:
+        db.close()
+
+def get_bot_identity(bot_type: str, token_hash: str):
+    """Persisted bot user ID for a persona's current token, or None"""
+    db = SessionLocal()
+    try:
+        return _get_bot_identity(db, bot_type, token_hash)
+    finally:
+        db.close()
+
+async def get_bot_identity_async(*args, **kwargs):
+    """Async variant of get_bot_identity"""
+    return await run_async(_get_bot_identity, *args, **kwargs)
+
+def _get_bot_identity(db, bot_type: str, token_hash: str):
+    return db.query(BotIdentity.user_id)\
+        .filter(BotIdentity.bot_type == bot_type, BotIdentity.token_hash == token_hash)\
+        .scalar()
+
+def save_bot_identity(bot_type: str, token_hash: str, user_id: str, team_id: str = None):
+    """Insert or replace a persona's resolved bot user ID"""
+    db = SessionLocal()
+    try:
+        _save_bot_identity(db, bot_type, token_hash, user_id, team_id)
+    finally:
+        db.close()
+
+async def save_bot_identity_async(*args, **kwargs):
+    """Async variant of save_bot_identity"""
+    await run_async(_save_bot_identity, *args, **kwargs)
+
+def _save_bot_identity(db, bot_type: str, token_hash: str, user_id: str, team_id: str = None):
+    insert = _dialect_insert(db)
+    stmt = insert(BotIdentity.__table__).values(
+        bot_type=bot_type, token_hash=token_hash, user_id=user_id, team_id=team_id, updated_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['bot_type'],
+        set_={'token_hash': stmt.excluded.token_hash, 'user_id': stmt.excluded.user_id,
+              'team_id': stmt.excluded.team_id, 'updated_at': stmt.excluded.updated_at}
+    )
+    db.execute(stmt)
+    db.commit()
 
 def get_db():
     db = SessionLocal()
@@ -99,6 +736,11 @@ def get_db():
     finally:
         db.close()
 
+# Each helper below is a thin session wrapper around a private implementation
+# that takes the session as its first argument. The *_async variants run the
+# same implementation through run_async (on the message's shared AsyncSession
+# when there is one), so the request path never blocks the event loop on database I/O.
+
 def save_conversation(
     user_id: str,
     user_name: str,
@@ -108,7 +750,10 @@ def save_conversation(
     channel_id: str = None,
     thread_ts: str = None,
     message_ts: str = None,
-    tokens_used: int = 0
+    tokens_used: int = 0,
+    model: str = None,
+    route: str = None,
+    timings: dict = None
 ):
     """
     Save a conversation to the database.
@@ -123,39 +768,126 @@ def save_conversation(
         thread_ts: Slack thread timestamp (None for non-threaded)
         message_ts: Slack message timestamp
         tokens_used: Number of tokens used in this conversation
+        model: Model that generated the response (None for cached replies)
+        route: Model route chosen for the turn (see routing.py)
+        timings: Latency columns in milliseconds (total_ms, llm_ms, history_ms, slack_ms)
     """
     db = SessionLocal()
     try:
-        # Save new conversation
-        conversation = Conversation(
-            user_id=user_id,
-            user_name=user_name,
-            thread_id=thread_ts or user_id,  # Use thread_ts if available, else user_id (backward compat)
-            message=message,
-            response=response,
-            bot_type=bot_type,
-            channel_id=channel_id or user_id,  # Fallback to user_id for old DMs
-            thread_ts=thread_ts,
-            message_ts=message_ts,
-            tokens_used=tokens_used
-        )
-        db.add(conversation)
-        db.commit()
+        _save_conversation(db, user_id, user_name, message, response, bot_type,
+                           channel_id, thread_ts, message_ts, tokens_used, model, route, timings)
+    finally:
+        db.close()
 
-        # Keep only last 100 conversations per user per bot
-        excess_conversations = db.query(Conversation)\
-            .filter(Conversation.user_id == user_id)\
-            .filter(Conversation.bot_type == bot_type)\
-            .order_by(Conversation.timestamp.desc())\
-            .offset(100)\
-            .all()
+async def save_conversation_async(*args, **kwargs):
+    """Async variant of save_conversation (queued instead when write-behind batching is on)"""
+    if write_queue is not None:
+        await write_queue.add(*args, **kwargs)
+        return
+    await run_async(_save_conversation, *args, **kwargs)
 
-        for conv in excess_conversations:
-            db.delete(conv)
+def _save_conversation(
+    db,
+    user_id: str,
+    user_name: str,
+    message: str,
+    response: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None,
+    message_ts: str = None,
+    tokens_used: int = 0,
+    model: str = None,
+    route: str = None,
+    timings: dict = None
+):
+    row = conversation_row(user_id, user_name, message, response, bot_type,
+                           channel_id, thread_ts, message_ts, tokens_used, model, route, timings)
+    _insert_conversations(db, [row])
 
-        db.commit()
-    finally:
-        db.close()
+def conversation_row(
+    user_id: str,
+    user_name: str,
+    message: str,
+    response: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None,
+    message_ts: str = None,
+    tokens_used: int = 0,
+    model: str = None,
+    route: str = None,
+    timings: dict = None
+) -> dict:
+    """Column values for a new conversation (same arguments as save_conversation)"""
+    timings = timings or {}
+    # Timestamp set here so the stats rollup uses the same day
+    return {
+        "timestamp": datetime.utcnow(),
+        "user_id": user_id,
+        "user_name": user_name,
+        "thread_id": thread_ts or user_id,  # Use thread_ts if available, else user_id (backward compat)
+        "message": message,
+        "response": response,
+        "bot_type": bot_type,
+        "channel_id": channel_id or user_id,  # Fallback to user_id for old DMs
+        "thread_ts": thread_ts,
+        "message_ts": message_ts,
+        "tokens_used": tokens_used or 0,
+        "model": model,
+        "route": route,
+        **{column: timings.get(column) for column in LATENCY_COLUMNS}
+    }
+
+LATENCY_COLUMNS = ("total_ms", "llm_ms", "history_ms", "slack_ms")
+
+def _insert_conversations(db, rows: list):
+    """Insert conversation rows in one multi-row INSERT, update the rollup and caches
+
+    Each row dict gets its new "id" (write-behind readers use it to avoid
+    counting a turn twice while it moves from the queue to the cache).
+    """
+    table = Conversation.__table__
+    identity = (table.c.user_id, table.c.bot_type, table.c.channel_id, table.c.thread_ts, table.c.timestamp)
+
+    # RETURNING order is not guaranteed for a multi-row INSERT (and asking SQLAlchemy to
+    # guarantee it falls back to one statement per row), so ids are matched back by value
+    stmt = table.insert().returning(table.c.id, *identity)
+    returned = db.execute(stmt, [{k: v for k, v in row.items() if k != "id"} for row in rows]).all()
+    ids = {}
+    for conversation_id, *values in returned:
+        ids.setdefault(tuple(values), []).append(conversation_id)
+    for row in rows:
+        row["id"] = ids[tuple(row[column.name] for column in identity)].pop(0)
+        _increment_stats_rollup(db, row["bot_type"], row["user_id"], row["timestamp"],
+                                row["tokens_used"], len(row["response"]))
+    db.commit()
+    _after_insert_conversations(db, rows)
+
+def _after_insert_conversations(db, rows: list):
+    """History cache and retention work for committed rows; never raises
+
+    The rows are stored once the commit returns, so a failure here must not
+    make a caller (e.g. the write-behind queue) insert them again.
+    """
+    try:
+        for row in rows:
+            _append_to_history_cache(
+                _history_key(row["user_id"], row["bot_type"], row["channel_id"], row["thread_ts"]),
+                (row["id"], row["message"], row["response"])
+            )
+    except Exception as e:
+        print(f"History cache update failed after insert: {e}")
+        history_cache.clear()  # A partly updated cache would serve wrong history
+
+    # Trimming old conversations is handled by the retention subsystem
+    from retention import schedule_trim
+    for user_id, bot_type, channel_id in {(row["user_id"], row["bot_type"], row["channel_id"]) for row in rows}:
+        try:
+            schedule_trim(db, user_id, bot_type, channel_id)
+        except Exception as e:
+            db.rollback()
+            print(f"Retention trim failed for {user_id} ({bot_type}): {e}")
 
 def get_conversation_history(
     user_id: str,
@@ -175,27 +907,122 @@ def get_conversation_history(
     Returns:
         List of (message, response) tuples in chronological order
     """
+    cached = _cached_history(user_id, bot_type, channel_id, thread_ts)
+    if cached is not None:
+        return cached
+
     db = SessionLocal()
     try:
-        query = db.query(Conversation.message, Conversation.response)\
-            .filter(Conversation.user_id == user_id)\
-            .filter(Conversation.bot_type == bot_type)
+        return _get_conversation_history(db, user_id, bot_type, channel_id, thread_ts)
+    finally:
+        db.close()
+
+async def get_conversation_history_async(
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+) -> list:
+    """Async variant of get_conversation_history"""
+    cached = _cached_history(user_id, bot_type, channel_id, thread_ts)
+    if cached is not None:
+        return cached
 
-        # Filter by context if provided
-        if channel_id:
-            query = query.filter(Conversation.channel_id == channel_id)
+    return await run_async(_get_conversation_history, user_id, bot_type, channel_id, thread_ts)
 
-            if thread_ts:  # Channel thread - only this specific thread
-                query = query.filter(Conversation.thread_ts == thread_ts)
-            else:  # DM or group DM (non-threaded)
-                query = query.filter(Conversation.thread_ts.is_(None))
+async def get_conversation_turns_async(
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+) -> list:
+    """Like get_conversation_history_async, but returns (id, message, response) tuples"""
+    cached = _cached_turns(user_id, bot_type, channel_id, thread_ts)
+    if cached is not None:
+        return list(cached)
 
-        conversations = query.order_by(Conversation.timestamp.desc()).limit(30).all()
+    return await run_async(_get_conversation_turns, user_id, bot_type, channel_id, thread_ts)
 
-        # Return in chronological order (oldest first)
-        return [(conv.message, conv.response) for conv in reversed(conversations)]
-    finally:
-        db.close()
+def _get_conversation_history(
+    db,
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+) -> list:
+    turns = _get_conversation_turns(db, user_id, bot_type, channel_id, thread_ts)
+    return [(message, response) for _, message, response in turns]
+
+def _get_conversation_turns(
+    db,
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+) -> list:
+    key = _history_key(user_id, bot_type, channel_id, thread_ts)
+    pending = write_queue.pending_for(key) if write_queue is not None else None
+    conversations = _history_query(db, user_id, bot_type, channel_id, thread_ts).all()
+
+    # Chronological order (oldest first)
+    turns = [(conv.id, conv.message, conv.response) for conv in reversed(conversations)]
+    if HISTORY_CACHE_ENABLED and channel_id:
+        history_cache.set(key, turns)
+    return _with_pending(key, turns, pending)
+
+def _history_query(db, user_id: str, bot_type: str, channel_id: str = None, thread_ts: str = None):
+    """Last HISTORY_LIMIT turns of a context, newest first"""
+    query = db.query(Conversation.id, Conversation.message, Conversation.response)\
+        .filter(Conversation.user_id == user_id)\
+        .filter(Conversation.bot_type == bot_type)
+
+    # Filter by context if provided
+    if channel_id:
+        query = query.filter(Conversation.channel_id == channel_id)
+
+        if thread_ts:  # Channel thread - only this specific thread
+            query = query.filter(Conversation.thread_ts == thread_ts)
+        else:  # DM or group DM (non-threaded)
+            query = query.filter(Conversation.thread_ts.is_(None))
+
+    return query.order_by(Conversation.timestamp.desc()).limit(HISTORY_LIMIT)
+
+def context_type_of(channel_id: str) -> str:
+    """Classify a stored channel_id as 'channel' (C*), 'group' (G*) or 'dm' (stored as the user ID)"""
+    if channel_id and channel_id.startswith('C'):
+        return 'channel'
+    if channel_id and channel_id.startswith('G'):
+        return 'group'
+    return 'dm'
+
+def context_type_clause(context_type: str, model=None):
+    """SQL filter matching conversations of one context type (see context_type_of)
+
+    Args:
+        model: Table with a channel_id column (default Conversation, e.g. ArchivedConversation)
+    """
+    from sqlalchemy import or_, and_
+    channel_id = (model or Conversation).channel_id
+    if context_type == 'channel':
+        return channel_id.like('C%')
+    if context_type == 'group':
+        return channel_id.like('G%')
+    return or_(channel_id.is_(None), and_(~channel_id.like('C%'), ~channel_id.like('G%')))
+
+def _retention_boundary_query(db, user_id: str, bot_type: str, keep: int, context_type: str = None):
+    """Newest conversation that falls outside the retention limit (keyset boundary)
+
+    Rows at or before this (timestamp, id) are the ones to trim.
+    """
+    query = db.query(Conversation.timestamp, Conversation.id)\
+        .filter(Conversation.user_id == user_id)\
+        .filter(Conversation.bot_type == bot_type)
+    if context_type:
+        query = query.filter(context_type_clause(context_type))
+
+    return query.order_by(Conversation.timestamp.desc(), Conversation.id.desc())\
+        .offset(keep)\
+        .limit(1)
 
 def reset_conversation(
     user_id: str,
@@ -217,31 +1044,69 @@ def reset_conversation(
     """
     db = SessionLocal()
     try:
-        query = db.query(Conversation)\
-            .filter(Conversation.user_id == user_id)\
-            .filter(Conversation.bot_type == bot_type)
+        return _reset_conversation(db, user_id, bot_type, channel_id, thread_ts)
+    finally:
+        db.close()
 
-        # Filter by context if provided
-        if channel_id:
-            query = query.filter(Conversation.channel_id == channel_id)
+async def reset_conversation_async(*args, **kwargs) -> int:
+    """Async variant of reset_conversation"""
+    if write_queue is not None:
+        # Queued turns are written first so the reset removes them too
+        await write_queue.flush()
+    return await run_async(_reset_conversation, *args, **kwargs)
 
-            if thread_ts:
-                query = query.filter(Conversation.thread_ts == thread_ts)
-            else:
-                # If no thread_ts, clear non-threaded messages in this channel
-                query = query.filter(Conversation.thread_ts.is_(None))
+def _reset_conversation(
+    db,
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+) -> int:
+    query = db.query(Conversation)\
+        .filter(Conversation.user_id == user_id)\
+        .filter(Conversation.bot_type == bot_type)
 
-        deleted_count = query.count()
-        query.delete()
+    # Filter by context if provided
+    if channel_id:
+        query = query.filter(Conversation.channel_id == channel_id)
 
-        db.commit()
-        return deleted_count
-    finally:
-        db.close()
+        if thread_ts:
+            query = query.filter(Conversation.thread_ts == thread_ts)
+        else:
+            # If no thread_ts, clear non-threaded messages in this channel
+            query = query.filter(Conversation.thread_ts.is_(None))
+
+    deleted_count = query.count()
+    query.delete()
+    if deleted_count:
+        rebuild_stats_rollup(db, user_ids=[user_id], bot_type=bot_type)
+
+    # The rolling summary describes the cleared turns, so it goes too
+    summaries = db.query(ConversationSummary)\
+        .filter(ConversationSummary.user_id == user_id)\
+        .filter(ConversationSummary.bot_type == bot_type)
+    if channel_id:
+        summaries = summaries.filter(
+            ConversationSummary.context_key == _summary_key(user_id, bot_type, channel_id, thread_ts))
+    summaries.delete(synchronize_session=False)
+
+    db.commit()
+
+    if channel_id:
+        history_cache.pop(_history_key(user_id, bot_type, channel_id, thread_ts))
+        summary_cache.pop(_history_key(user_id, bot_type, channel_id, thread_ts))
+    else:
+        history_cache.invalidate_where(lambda key: key[0] == user_id and key[1] == bot_type)
+        summary_cache.invalidate_where(lambda key: key[0] == user_id and key[1] == bot_type)
+    return deleted_count
 
 def delete_conversations_by_user_name(user_name: str) -> int:
     db = SessionLocal()
     try:
+        user_ids = {row.user_id for row in db.query(Conversation.user_id)
+                    .filter(Conversation.user_name == user_name)
+                    .distinct()}
+
         deleted_count = db.query(Conversation)\
             .filter(Conversation.user_name == user_name)\
             .count()
@@ -249,80 +1114,368 @@ def delete_conversations_by_user_name(user_name: str) -> int:
         db.query(Conversation)\
             .filter(Conversation.user_name == user_name)\
             .delete()
+        # Archived turns are removed too, rewriting the batches that held them
+        from archive import purge_archived
+        archived_count, archived_user_ids = purge_archived(db, user_name)
+        deleted_count += archived_count
+        user_ids |= archived_user_ids
+
+        if user_ids:
+            rebuild_stats_rollup(db, user_ids=list(user_ids))
+            db.query(ConversationSummary)\
+                .filter(ConversationSummary.user_id.in_(user_ids))\
+                .delete(synchronize_session=False)
 
         db.commit()
+
+        history_cache.invalidate_where(lambda key: key[0] in user_ids)
+        summary_cache.invalidate_where(lambda key: key[0] in user_ids)
         return deleted_count
     finally:
         db.close()
 
-def get_bot_stats(bot_type: str, exclude_user_ids: list = None) -> dict:
+def _dialect_insert(db):
+    """INSERT construct with ON CONFLICT support for the session's database"""
+    if db.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def _increment_stats_rollup(db, bot_type: str, user_id: str, timestamp: datetime, tokens_used: int,
+                            response_chars: int):
+    """Add one conversation to its day's rollup row (upsert)"""
+    insert = _dialect_insert(db)
+    table = ConversationStatsDaily.__table__
+    if db.get_bind().dialect.name == 'postgresql':
+        least, greatest = func.least, func.greatest
+    else:
+        least, greatest = func.min, func.max  # SQLite's multi-argument min/max are scalar
+
+    stmt = insert(table).values(
+        bot_type=bot_type,
+        day=timestamp.date(),
+        user_id=user_id,
+        message_count=1,
+        tokens_used=tokens_used,
+        response_chars=response_chars,
+        first_timestamp=timestamp,
+        last_timestamp=timestamp
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['bot_type', 'day', 'user_id'],
+        set_={
+            'message_count': table.c.message_count + 1,
+            'tokens_used': table.c.tokens_used + stmt.excluded.tokens_used,
+            'response_chars': table.c.response_chars + stmt.excluded.response_chars,
+            'first_timestamp': least(table.c.first_timestamp, stmt.excluded.first_timestamp),
+            'last_timestamp': greatest(table.c.last_timestamp, stmt.excluded.last_timestamp),
+        }
+    )
+    db.execute(stmt)
+
+def rebuild_stats_rollup(db, user_ids: list = None, bot_type: str = None):
+    """
+    Recompute rollup rows from the conversations and archived_conversations tables (caller commits).
+
+    Used after deletes, where min/max timestamps cannot be decremented. Scoped
+    to the given users (and bot) so it only reads their rows through the index.
+    Archived conversations still count, so archiving never changes the stats.
+
+    Args:
+        user_ids: Only rebuild these users (None = whole table)
+        bot_type: Only rebuild this bot (None = both)
+    """
+    from sqlalchemy import insert, select, union_all
+
+    delete_query = db.query(ConversationStatsDaily)
+    hot = select(
+        Conversation.bot_type.label('bot_type'),
+        Conversation.user_id.label('user_id'),
+        Conversation.timestamp.label('timestamp'),
+        Conversation.tokens_used.label('tokens_used'),
+        func.length(Conversation.response).label('response_chars')
+    ).where(Conversation.timestamp.isnot(None))
+    archived = select(
+        ArchivedConversation.bot_type,
+        ArchivedConversation.user_id,
+        ArchivedConversation.timestamp,
+        ArchivedConversation.tokens_used,
+        ArchivedConversation.response_chars
+    ).where(ArchivedConversation.timestamp.isnot(None))
+
+    if user_ids is not None:
+        delete_query = delete_query.filter(ConversationStatsDaily.user_id.in_(user_ids))
+        hot = hot.where(Conversation.user_id.in_(user_ids))
+        archived = archived.where(ArchivedConversation.user_id.in_(user_ids))
+    if bot_type:
+        delete_query = delete_query.filter(ConversationStatsDaily.bot_type == bot_type)
+        hot = hot.where(Conversation.bot_type == bot_type)
+        archived = archived.where(ArchivedConversation.bot_type == bot_type)
+
+    delete_query.delete(synchronize_session=False)
+    rows = union_all(hot, archived).subquery()
+    source = select(
+        rows.c.bot_type,
+        func.date(rows.c.timestamp),
+        rows.c.user_id,
+        func.count(),
+        func.coalesce(func.sum(rows.c.tokens_used), 0),
+        func.coalesce(func.sum(rows.c.response_chars), 0),
+        func.min(rows.c.timestamp),
+        func.max(rows.c.timestamp)
+    ).group_by(rows.c.bot_type, func.date(rows.c.timestamp), rows.c.user_id)
+    db.execute(insert(ConversationStatsDaily).from_select([
+        'bot_type', 'day', 'user_id', 'message_count', 'tokens_used', 'response_chars',
+        'first_timestamp', 'last_timestamp'
+    ], source))
+
+def get_bot_stats(
+    bot_type: str,
+    exclude_user_ids: list = None,
+    since: datetime = None,
+    until: datetime = None,
+    user_ids: list = None
+) -> dict:
     """
     Get statistics for a specific bot.
 
+    Reads the conversation_stats_daily rollup, so the cost does not grow with
+    the number of stored conversations.
+
     Args:
         bot_type: 'duck' or 'goose'
         exclude_user_ids: List of user IDs to exclude (e.g., admins)
+        since: Only count days on or after this date (optional)
+        until: Only count days on or before this date (optional)
+        user_ids: Only count these users, e.g. one cohort (optional)
 
     Returns:
         Dictionary with comprehensive statistics
     """
     db = SessionLocal()
     try:
-        from sqlalchemy import func as sql_func
+        return _get_bot_stats(db, bot_type, exclude_user_ids, since, until, user_ids)
+    finally:
+        db.close()
 
-        # Base query filters
-        base_query = db.query(Conversation).filter(Conversation.bot_type == bot_type)
-        if exclude_user_ids:
-            base_query = base_query.filter(~Conversation.user_id.in_(exclude_user_ids))
+async def get_bot_stats_async(*args, **kwargs) -> dict:
+    """Async variant of get_bot_stats"""
+    return await run_async(_get_bot_stats, *args, **kwargs)
 
-        # Total tokens
-        total_tokens = db.query(sql_func.sum(Conversation.tokens_used))\
-            .filter(Conversation.bot_type == bot_type)
-        if exclude_user_ids:
-            total_tokens = total_tokens.filter(~Conversation.user_id.in_(exclude_user_ids))
-        total_tokens = total_tokens.scalar() or 0
+def _get_bot_stats(
+    db,
+    bot_type: str,
+    exclude_user_ids: list = None,
+    since: datetime = None,
+    until: datetime = None,
+    user_ids: list = None
+) -> dict:
+    rollup = ConversationStatsDaily
+    query = db.query(
+        func.coalesce(func.sum(rollup.tokens_used), 0),
+        func.coalesce(func.sum(rollup.message_count), 0),
+        func.count(func.distinct(rollup.user_id)),
+        func.coalesce(func.sum(rollup.response_chars), 0),
+        func.min(rollup.first_timestamp),
+        func.max(rollup.last_timestamp)
+    ).filter(rollup.bot_type == bot_type)
 
-        # Total messages
-        total_messages = base_query.count()
+    if exclude_user_ids:
+        query = query.filter(~rollup.user_id.in_(exclude_user_ids))
+    if user_ids is not None:
+        query = query.filter(rollup.user_id.in_(user_ids))
+    if since:
+        query = query.filter(rollup.day >= since.date() if isinstance(since, datetime) else since)
+    if until:
+        query = query.filter(rollup.day <= until.date() if isinstance(until, datetime) else until)
 
-        # Unique users
-        unique_users = db.query(sql_func.count(sql_func.distinct(Conversation.user_id)))\
-            .filter(Conversation.bot_type == bot_type)
-        if exclude_user_ids:
-            unique_users = unique_users.filter(~Conversation.user_id.in_(exclude_user_ids))
-        unique_users = unique_users.scalar() or 0
+    total_tokens, total_messages, unique_users, response_chars, earliest, latest = query.one()
 
-        # Average tokens per message
-        avg_tokens = total_tokens / total_messages if total_messages > 0 else 0
+    # Averages per message
+    avg_tokens = total_tokens / total_messages if total_messages > 0 else 0
+    avg_response_length = response_chars / total_messages if total_messages > 0 else 0
 
-        # Average response length (characters)
-        avg_response_length = db.query(sql_func.avg(sql_func.length(Conversation.response)))\
-            .filter(Conversation.bot_type == bot_type)
-        if exclude_user_ids:
-            avg_response_length = avg_response_length.filter(~Conversation.user_id.in_(exclude_user_ids))
-        avg_response_length = avg_response_length.scalar() or 0
+    return {
+        "total_tokens": int(total_tokens),
+        "total_messages": int(total_messages),
+        "unique_users": unique_users,
+        "avg_tokens": round(avg_tokens, 1),
+        "avg_response_length": round(avg_response_length, 0),
+        "earliest_date": earliest,
+        "latest_date": latest
+    }
 
-        # Date range
-        earliest = db.query(sql_func.min(Conversation.timestamp))\
-            .filter(Conversation.bot_type == bot_type)
-        if exclude_user_ids:
-            earliest = earliest.filter(~Conversation.user_id.in_(exclude_user_ids))
-        earliest = earliest.scalar()
+LATENCY_PERCENTILES = (50, 95, 99)
+
+def get_latency_report(
+    bot_type: str,
+    since: datetime = None,
+    until: datetime = None,
+    exclude_user_ids: list = None
+) -> dict:
+    """
+    Latency percentiles of saved turns for a bot.
+
+    Args:
+        since: Only turns at or after this time (optional)
+        until: Only turns before this time (optional)
+        exclude_user_ids: User IDs to leave out (e.g., admins)
+
+    Returns:
+        Dictionary with "turns", "models" ({model: turns}), "routes"
+        ({route: {"turns", "avg_tokens", "llm_p50"}}) and, per latency
+        column, {"count": n, 50: ms, 95: ms, 99: ms} (None without data)
+    """
+    db = SessionLocal()
+    try:
+        return _get_latency_report(db, bot_type, since, until, exclude_user_ids)
+    finally:
+        db.close()
 
-        latest = db.query(sql_func.max(Conversation.timestamp))\
-            .filter(Conversation.bot_type == bot_type)
+async def get_latency_report_async(*args, **kwargs) -> dict:
+    """Async variant of get_latency_report"""
+    return await run_async(_get_latency_report, *args, **kwargs)
+
+def _get_latency_report(db, bot_type: str, since: datetime = None, until: datetime = None,
+                        exclude_user_ids: list = None) -> dict:
+    def scoped(query):
+        # Served by ix_conversations_bot_timestamp
+        query = query.filter(Conversation.bot_type == bot_type)
+        if since:
+            query = query.filter(Conversation.timestamp >= since)
+        if until:
+            query = query.filter(Conversation.timestamp < until)
         if exclude_user_ids:
-            latest = latest.filter(~Conversation.user_id.in_(exclude_user_ids))
-        latest = latest.scalar()
+            query = query.filter(~Conversation.user_id.in_(exclude_user_ids))
+        return query
+
+    columns = [getattr(Conversation, name) for name in LATENCY_COLUMNS]
+    counts = scoped(db.query(func.count(Conversation.id), *[func.count(column) for column in columns])).one()
+    report = {
+        "turns": counts[0],
+        "models": dict(scoped(db.query(Conversation.model, func.count(Conversation.id)))
+                       .filter(Conversation.model.isnot(None))
+                       .group_by(Conversation.model).all()),
+    }
+
+    by_route = scoped(db.query(Conversation.route, func.count(Conversation.id), func.avg(Conversation.tokens_used),
+                               func.count(Conversation.llm_ms)))\
+        .filter(Conversation.route.isnot(None)).group_by(Conversation.route).all()
+    report["routes"] = {route: {"turns": turns, "avg_tokens": round(float(avg_tokens or 0))}
+                        for route, turns, avg_tokens, _ in by_route}
+
+    if db.get_bind().dialect.name == 'postgresql':
+        # Every percentile of every column in one pass
+        aggregates = [func.percentile_cont(pct / 100).within_group(column)
+                      for column in columns for pct in LATENCY_PERCENTILES]
+        values = iter(scoped(db.query(*aggregates)).one())
+        for name, count in zip(LATENCY_COLUMNS, counts[1:]):
+            report[name] = {"count": count, **{pct: next(values) for pct in LATENCY_PERCENTILES}}
+        medians = scoped(db.query(Conversation.route, func.percentile_cont(0.5).within_group(Conversation.llm_ms)))\
+            .filter(Conversation.route.isnot(None)).group_by(Conversation.route).all()
+        for route, median in medians:
+            report["routes"][route]["llm_p50"] = median
+        return report
+
+    # SQLite has no percentile function: nearest rank, read with ORDER BY ... LIMIT 1 OFFSET k
+    def nearest_rank(query, column, count, pct):
+        if not count:
+            return None
+        return query.filter(column.isnot(None)).order_by(column)\
+            .offset(max(math.ceil(pct / 100 * count) - 1, 0)).limit(1).scalar()
+
+    for name, column, count in zip(LATENCY_COLUMNS, columns, counts[1:]):
+        report[name] = {"count": count}
+        for pct in LATENCY_PERCENTILES:
+            report[name][pct] = nearest_rank(scoped(db.query(column)), column, count, pct)
+    for route, _, _, llm_count in by_route:
+        report["routes"][route]["llm_p50"] = nearest_rank(
+            scoped(db.query(Conversation.llm_ms)).filter(Conversation.route == route),
+            Conversation.llm_ms, llm_count, 50)
+    return report
+
+def get_replay_checkpoint(run_name: str, retry_errors: bool = True) -> set:
+    """
+    Conversation IDs a replay run has already answered.
+
+    Args:
+        retry_errors: Delete the run's failed results first so they are replayed again
+
+    Returns:
+        Set of conversation IDs to skip
+    """
+    db = SessionLocal()
+    try:
+        if retry_errors:
+            db.query(ReplayResult)\
+                .filter(ReplayResult.run_name == run_name, ReplayResult.error.isnot(None))\
+                .delete(synchronize_session=False)
+            db.commit()
+        return {row.conversation_id for row in db.query(ReplayResult.conversation_id)
+                .filter(ReplayResult.run_name == run_name)}
+    finally:
+        db.close()
+
+def save_replay_results(rows: list):
+    """Insert replay results (dicts of ReplayResult columns) in one transaction"""
+    db = SessionLocal()
+    try:
+        _save_replay_results(db, rows)
+    finally:
+        db.close()
+
+async def save_replay_results_async(*args, **kwargs):
+    """Async variant of save_replay_results"""
+    await run_async(_save_replay_results, *args, **kwargs)
+
+def _save_replay_results(db, rows: list):
+    if not rows:
+        return
+    db.execute(ReplayResult.__table__.insert(), rows)
+    db.commit()
+
+def get_replay_report(run_name: str) -> dict:
+    """
+    Summary of a replay run.
+
+    Returns:
+        Dictionary with turns, errors, per-model turn counts, average tokens and
+        latency, and average reply length next to the original replies'
+    """
+    db = SessionLocal()
+    try:
+        turns, errors, prompt_tokens, completion_tokens, latency_ms, response_chars = db.query(
+            func.count(ReplayResult.id),
+            func.count(ReplayResult.error),
+            func.avg(ReplayResult.prompt_tokens),
+            func.avg(ReplayResult.completion_tokens),
+            func.avg(ReplayResult.latency_ms),
+            func.avg(func.length(ReplayResult.response))
+        ).filter(ReplayResult.run_name == run_name).one()
+
+        # Original replies of the replayed turns, from both storage tiers
+        hot_chars, hot_count = db.query(func.sum(func.length(Conversation.response)), func.count(Conversation.id))\
+            .join(ReplayResult, ReplayResult.conversation_id == Conversation.id)\
+            .filter(ReplayResult.run_name == run_name).one()
+        cold_chars, cold_count = db.query(func.sum(ArchivedConversation.response_chars),
+                                          func.count(ArchivedConversation.id))\
+            .join(ReplayResult, ReplayResult.conversation_id == ArchivedConversation.id)\
+            .filter(ReplayResult.run_name == run_name).one()
+        original_count = hot_count + cold_count
+        original_chars = ((hot_chars or 0) + (cold_chars or 0)) / original_count if original_count else 0
 
         return {
-            "total_tokens": int(total_tokens),
-            "total_messages": total_messages,
-            "unique_users": unique_users,
-            "avg_tokens": round(avg_tokens, 1),
-            "avg_response_length": round(avg_response_length, 0),
-            "earliest_date": earliest,
-            "latest_date": latest
+            "turns": turns,
+            "errors": errors,
+            "models": dict(db.query(ReplayResult.model, func.count(ReplayResult.id))
+                           .filter(ReplayResult.run_name == run_name)
+                           .group_by(ReplayResult.model).all()),
+            "avg_prompt_tokens": round(float(prompt_tokens or 0)),
+            "avg_completion_tokens": round(float(completion_tokens or 0)),
+            "avg_latency_ms": round(float(latency_ms or 0)),
+            "avg_response_chars": round(float(response_chars or 0)),
+            "avg_original_chars": round(float(original_chars or 0)),
         }
     finally:
         db.close()
@@ -341,25 +1494,225 @@ def get_recent_queries(bot_type: str, limit: int = 10, exclude_user_ids: list =
     """
     db = SessionLocal()
     try:
-        # Cap limit at 100
-        limit = min(limit, 100)
+        return _get_recent_queries(db, bot_type, limit, exclude_user_ids)
+    finally:
+        db.close()
 
-        query = db.query(
-            Conversation.timestamp,
-            Conversation.user_name,
-            Conversation.message
-        )\
-            .filter(Conversation.bot_type == bot_type)
+async def get_recent_queries_async(*args, **kwargs) -> list:
+    """Async variant of get_recent_queries"""
+    return await run_async(_get_recent_queries, *args, **kwargs)
 
-        # Exclude admin user IDs from results
-        if exclude_user_ids:
-            query = query.filter(~Conversation.user_id.in_(exclude_user_ids))
+def _get_recent_queries(db, bot_type: str, limit: int = 10, exclude_user_ids: list = None) -> list:
+    # Cap limit at 100
+    limit = min(limit, 100)
+
+    query = db.query(
+        Conversation.timestamp,
+        Conversation.user_name,
+        Conversation.message
+    )\
+        .filter(Conversation.bot_type == bot_type)
+
+    # Exclude admin user IDs from results
+    if exclude_user_ids:
+        query = query.filter(~Conversation.user_id.in_(exclude_user_ids))
+
+    queries = query.order_by(Conversation.timestamp.desc())\
+        .limit(limit)\
+        .all()
+
+    # Reverse to show oldest first (chronological order)
+    return [(q.timestamp, q.user_name, q.message) for q in reversed(queries)]
+
+def get_user_profiles(user_ids: list, max_age_seconds: float) -> dict:
+    """
+    Get persisted Slack display names that are newer than max_age_seconds.
 
-        queries = query.order_by(Conversation.timestamp.desc())\
-            .limit(limit)\
-            .all()
+    Returns:
+        Dictionary of user_id -> user_name
+    """
+    db = SessionLocal()
+    try:
+        return _get_user_profiles(db, user_ids, max_age_seconds)
+    finally:
+        db.close()
 
-        # Reverse to show oldest first (chronological order)
-        return [(q.timestamp, q.user_name, q.message) for q in reversed(queries)]
+async def get_user_profiles_async(*args, **kwargs) -> dict:
+    """Async variant of get_user_profiles"""
+    return await run_async(_get_user_profiles, *args, **kwargs)
+
+def _get_user_profiles(db, user_ids: list, max_age_seconds: float) -> dict:
+    from datetime import timedelta
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    rows = db.query(UserProfile.user_id, UserProfile.user_name)\
+        .filter(UserProfile.user_id.in_(user_ids))\
+        .filter(UserProfile.updated_at >= cutoff)\
+        .all()
+    return {row.user_id: row.user_name for row in rows}
+
+def save_user_profiles(profiles: dict):
+    """
+    Insert or refresh persisted Slack display names.
+
+    Args:
+        profiles: Dictionary of user_id -> user_name
+    """
+    db = SessionLocal()
+    try:
+        _save_user_profiles(db, profiles)
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def save_user_profiles_async(*args, **kwargs):
+    """Async variant of save_user_profiles"""
+    await run_async(_save_user_profiles, *args, **kwargs)
+
+def _save_user_profiles(db, profiles: dict):
+    if not profiles:
+        return
+    insert = _dialect_insert(db)
+    now = datetime.utcnow()
+    rows = [{"user_id": user_id, "user_name": user_name, "updated_at": now}
+            for user_id, user_name in profiles.items()]
+
+    # Chunked to stay under SQLite's bound-parameter limit during bulk warm-up
+    for start in range(0, len(rows), 500):
+        stmt = insert(UserProfile.__table__).values(rows[start:start + 500])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id'],
+            set_={'user_name': stmt.excluded.user_name, 'updated_at': stmt.excluded.updated_at}
+        )
+        db.execute(stmt)
+    db.commit()
+
+def get_conversation_summary(
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+):
+    """
+    Get the rolling summary of a context's older turns.
+
+    Returns:
+        Tuple of (summary, through_id), or None if the context has no summary
+    """
+    key = _history_key(user_id, bot_type, channel_id, thread_ts)
+    cached = summary_cache.get(key, default=False)
+    if cached is not False:
+        return cached
+
+    db = SessionLocal()
+    try:
+        return _get_conversation_summary(db, user_id, bot_type, channel_id, thread_ts)
+    finally:
+        db.close()
+
+async def get_conversation_summary_async(
+    user_id: str,
+    bot_type: str = 'duck',
+    channel_id: str = None,
+    thread_ts: str = None
+):
+    """Async variant of get_conversation_summary"""
+    key = _history_key(user_id, bot_type, channel_id, thread_ts)
+    cached = summary_cache.get(key, default=False)
+    if cached is not False:
+        return cached
+
+    return await run_async(_get_conversation_summary, user_id, bot_type, channel_id, thread_ts)
+
+def _get_conversation_summary(db, user_id: str, bot_type: str = 'duck', channel_id: str = None,
+                              thread_ts: str = None):
+    row = db.query(ConversationSummary.summary, ConversationSummary.through_id)\
+        .filter(ConversationSummary.context_key == _summary_key(user_id, bot_type, channel_id, thread_ts))\
+        .first()
+    summary = (row.summary, row.through_id) if row else None
+    summary_cache.set(_history_key(user_id, bot_type, channel_id, thread_ts), summary)
+    return summary
+
+def save_conversation_summary(
+    user_id: str,
+    bot_type: str,
+    channel_id: str,
+    thread_ts: str,
+    summary: str,
+    through_id: int
+):
+    """
+    Insert or replace the rolling summary of a context.
+
+    Args:
+        summary: Summary text covering every turn up to and including through_id
+        through_id: Newest conversation id folded into the summary
+    """
+    db = SessionLocal()
+    try:
+        _save_conversation_summary(db, user_id, bot_type, channel_id, thread_ts, summary, through_id)
+    finally:
+        db.close()
+
+async def save_conversation_summary_async(*args, **kwargs):
+    """Async variant of save_conversation_summary"""
+    await run_async(_save_conversation_summary, *args, **kwargs)
+
+def _save_conversation_summary(db, user_id: str, bot_type: str, channel_id: str, thread_ts: str,
+                               summary: str, through_id: int):
+    insert = _dialect_insert(db)
+    stmt = insert(ConversationSummary.__table__).values(
+        context_key=_summary_key(user_id, bot_type, channel_id, thread_ts),
+        user_id=user_id,
+        bot_type=bot_type,
+        summary=summary,
+        through_id=through_id,
+        updated_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['context_key'],
+        set_={'summary': stmt.excluded.summary, 'through_id': stmt.excluded.through_id,
+              'updated_at': stmt.excluded.updated_at}
+    )
+    db.execute(stmt)
+    db.commit()
+    summary_cache.set(_history_key(user_id, bot_type, channel_id, thread_ts), (summary, through_id))
+
+def explain_hot_queries() -> dict:
+    """
+    Get the database's query plans for the request-path queries.
+
+    Uses EXPLAIN QUERY PLAN on SQLite and EXPLAIN on Postgres. Sample values
+    come from the newest stored conversation so the planner sees real data.
+
+    Returns:
+        Dictionary of query name -> list of plan lines
+    """
+    db = SessionLocal()
+    try:
+        sample = db.query(Conversation).order_by(Conversation.id.desc()).first()
+        user_id = sample.user_id if sample else 'U00000000'
+        bot_type = sample.bot_type if sample else 'duck'
+        channel_id = sample.channel_id if sample else user_id
+
+        queries = {
+            "history (thread)": _history_query(db, user_id, bot_type, channel_id, sample.thread_ts if sample and sample.thread_ts else '0.0'),
+            "history (DM / group DM)": _history_query(db, user_id, bot_type, channel_id),
+            "retention boundary": _retention_boundary_query(db, user_id, bot_type, 100),
+            "admin query": db.query(Conversation.timestamp, Conversation.user_name, Conversation.message)
+                .filter(Conversation.bot_type == bot_type)
+                .order_by(Conversation.timestamp.desc())
+                .limit(100),
+        }
+
+        explain = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+        plans = {}
+        for name, query in queries.items():
+            compiled = query.statement.compile(dialect=engine.dialect)
+            params = compiled.params
+            if compiled.positional:
+                params = tuple(params[name] for name in compiled.positiontup)
+            rows = db.connection().exec_driver_sql(explain + str(compiled), params).all()
+            # SQLite rows are (id, parent, notused, detail); Postgres rows are single text lines
+            plans[name] = [row[-1] for row in rows]
+        return plans
+    finally:
+        db.close()
@@ -0,0 +1,139 @@
+"""
+Slack event deduplication
+
+Slack retries an event when it doesn't see a 200 in time, and Duck and Goose
+can both receive the same message. Each (event, bot, event type) is claimed
+once; claims expire after DEDUP_TTL seconds, oldest first, so recent keys are
+never dropped to make room.
+
+Backends (DEDUP_BACKEND):
+    memory - per process (default)
+    sql    - also claims the key in the processed_events table (primary key),
+             so only one worker or node handles each event
+"""
+
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy.exc import IntegrityError
+from db import run_async, ProcessedEvent
+
+# Slack retries for a few minutes; keep claims well past that
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", 3600))
+
+# Safety cap on keys held in memory (only reached at extreme event rates)
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", 200000))
+
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "memory").lower()
+
+# Retries with these X-Slack-Retry-Reason values are dropped before the body is
+# parsed (opt-in, empty by default). A timed-out first delivery may never have
+# reached this process (proxy, cold start), so by default every retry is verified
+# and dropped only if its event was already claimed by dedup.
+DEDUP_DROP_RETRY_REASONS = {
+    reason.strip() for reason in os.getenv("DEDUP_DROP_RETRY_REASONS", "").split(",") if reason.strip()
+}
+
+
+def should_drop_retry(headers) -> bool:
+    """Fast path for Slack retries with an opted-in reason, using only the request headers"""
+    if not headers.get("X-Slack-Retry-Num"):
+        return False
+    return headers.get("X-Slack-Retry-Reason", "") in DEDUP_DROP_RETRY_REASONS
+
+
+class MemoryDedupStore:
+    """Claims held in insertion order, which is also expiry order"""
+
+    def __init__(self, ttl: float = DEDUP_TTL, max_keys: int = DEDUP_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.claims = OrderedDict()  # key -> expires_at
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.claims)
+
+    async def claim(self, key: str) -> bool:
+        """Returns True the first time a key is seen within the TTL"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if key in self.claims:
+                return False
+            self.claims[key] = now + self.ttl
+            return True
+
+    async def release(self, key: str):
+        """Forget a claim, e.g. when the event was rejected and Slack should retry it"""
+        with self.lock:
+            self.claims.pop(key, None)
+
+    def _expire(self, now: float):
+        while self.claims:
+            key, expires_at = next(iter(self.claims.items()))
+            if expires_at > now and len(self.claims) < self.max_keys:
+                break
+            del self.claims[key]
+
+
+class SQLDedupStore:
+    """Local claims in front of a shared processed_events table"""
+
+    def __init__(self, ttl: float = DEDUP_TTL):
+        self.ttl = ttl
+        self.local = MemoryDedupStore(ttl)
+        self.last_cleanup = 0
+
+    def __len__(self):
+        return len(self.local)
+
+    async def claim(self, key: str) -> bool:
+        if not await self.local.claim(key):
+            return False
+        try:
+            return await run_async(self._claim, key)
+        except Exception:
+            # Database unavailable: the webhook fails and Slack's retry must not look like a duplicate
+            await self.local.release(key)
+            raise
+
+    def _claim(self, db, key: str) -> bool:
+        now = datetime.utcnow()
+        db.add(ProcessedEvent(event_key=key, created_at=now))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another worker claimed it first
+            db.rollback()
+            return False
+
+        if time.monotonic() - self.last_cleanup > self.ttl / 10:
+            self.last_cleanup = time.monotonic()
+            # The claim is committed; a failed cleanup must not fail it
+            try:
+                db.query(ProcessedEvent)\
+                    .filter(ProcessedEvent.created_at < now - timedelta(seconds=self.ttl))\
+                    .delete(synchronize_session=False)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"Dedup cleanup failed: {e}")
+        return True
+
+    async def release(self, key: str):
+        await self.local.release(key)
+        await run_async(self._release, key)
+
+    def _release(self, db, key: str):
+        db.query(ProcessedEvent).filter(ProcessedEvent.event_key == key).delete(synchronize_session=False)
+        db.commit()
+
+
+def create_dedup_store():
+    """Build the store for the configured backend"""
+    if DEDUP_BACKEND == "sql":
+        return SQLDedupStore()
+    return MemoryDedupStore()
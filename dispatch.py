@@ -0,0 +1,102 @@
+"""
+Background dispatch for Slack events
+
+Slack expects an HTTP 200 within 3 seconds, so the webhook only verifies and
+deduplicates an event before handing it to this bounded worker pool. Replies
+(users_info, history, OpenAI, database, chat_postMessage) run on the workers.
+"""
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of events processed concurrently
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 8))
+
+# Maximum number of events waiting for a free worker
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 200))
+
+# How long the webhook waits for queue space before rejecting an event (seconds)
+WORKER_ENQUEUE_TIMEOUT = float(os.getenv("WORKER_ENQUEUE_TIMEOUT", 0.5))
+
+# How long shutdown waits for queued events to finish (seconds)
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", 30))
+
+
+class WorkerPool:
+    """Fixed number of asyncio workers consuming a bounded job queue.
+
+    Synchronous jobs run on a thread pool of the same size so a slow
+    OpenAI call never blocks the event loop that acknowledges Slack.
+    """
+
+    def __init__(self, size: int = WORKER_POOL_SIZE, max_queue: int = WORKER_QUEUE_SIZE,
+                 enqueue_timeout: float = WORKER_ENQUEUE_TIMEOUT):
+        self.size = max(1, size)
+        self.max_queue = max(1, max_queue)
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = None
+        self.workers = []
+        self.executor = None
+        self.rejected = 0
+
+    async def start(self):
+        """Create the queue, thread pool and worker tasks"""
+        if self.workers:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="quack-worker")
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.size)]
+
+    async def submit(self, func, *args) -> bool:
+        """Queue a job for the workers
+
+        Waits up to enqueue_timeout for space when the queue is full.
+
+        Returns:
+            True if the job was queued, False if the pool is saturated
+        """
+        if self.queue is None:
+            await self.start()
+        try:
+            await asyncio.wait_for(self.queue.put((func, args)), timeout=self.enqueue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+
+    def depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        return self.queue.qsize() if self.queue else 0
+
+    def full(self) -> bool:
+        """True when submit would have to wait for queue space"""
+        return self.depth() >= self.max_queue
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args = await self.queue.get()
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    await func(*args)
+                else:
+                    await loop.run_in_executor(self.executor, func, *args)
+            except Exception as e:
+                print(f"Worker job {getattr(func, '__name__', func)} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def stop(self, drain_timeout: float = WORKER_DRAIN_TIMEOUT):
+        """Let queued jobs finish (up to drain_timeout), then stop the workers"""
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Worker pool: shutting down with {self.depth()} unprocessed events")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.executor.shutdown(wait=False)
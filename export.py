@@ -0,0 +1,143 @@
+"""
+Research export of stored conversations
+
+Streams conversations as NDJSON or CSV, one row at a time, from a server-side
+cursor (stream_results + yield_per), so memory stays constant however large the
+table is. Archived conversations (see archive.py) are merged in by timestamp.
+Used by the /export/conversations endpoint and `python manage.py export`.
+"""
+
+import io
+import csv
+import json
+import heapq
+from datetime import datetime, timedelta
+from db import SessionLocal, Conversation, context_type_clause, context_type_of
+from archive import iter_archived
+
+# Rows fetched from the cursor at a time
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ("ndjson", "csv")
+
+EXPORT_COLUMNS = [
+    "id", "timestamp", "bot_type", "user_id", "user_name", "channel_id", "context_type",
+    "thread_ts", "message_ts", "message", "response", "tokens_used", "model", "route", "archived"
+]
+
+
+def parse_date(value: str, end: bool = False):
+    """Filter value from YYYY-MM-DD or a full ISO timestamp, or None
+
+    Args:
+        end: Treat a bare date as inclusive (the export runs until the next midnight)
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def iter_conversations(
+    bot_type: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    user_id: str = None,
+    context_type: str = None,
+    exclude_user_ids: list = None,
+    include_archived: bool = True
+):
+    """
+    Yield matching conversations as dicts, oldest first.
+
+    Args:
+        bot_type: Only this bot/persona (optional)
+        since: Only conversations at or after this time (optional)
+        until: Only conversations before this time (optional, see parse_date)
+        user_id: Only this student (optional)
+        context_type: 'dm', 'channel' or 'group' (optional)
+        exclude_user_ids: User IDs to leave out, e.g. admins (optional)
+        include_archived: Merge in archived conversations (default True)
+    """
+    filters = {"bot_type": bot_type, "since": since, "until": until, "user_id": user_id,
+               "context_type": context_type, "exclude_user_ids": exclude_user_ids}
+    if not include_archived:
+        return _iter_hot(**filters)
+    return heapq.merge(_iter_hot(**filters), iter_archived(**filters, yield_per=EXPORT_BATCH_SIZE),
+                       key=lambda row: (row["timestamp"] or "", row["id"]))
+
+
+def _iter_hot(bot_type: str = None, since: datetime = None, until: datetime = None, user_id: str = None,
+              context_type: str = None, exclude_user_ids: list = None):
+    db = SessionLocal()
+    try:
+        query = db.query(
+            Conversation.id, Conversation.timestamp, Conversation.bot_type, Conversation.user_id,
+            Conversation.user_name, Conversation.channel_id, Conversation.thread_ts,
+            Conversation.message_ts, Conversation.message, Conversation.response, Conversation.tokens_used,
+            Conversation.model, Conversation.route
+        )
+        if bot_type:
+            query = query.filter(Conversation.bot_type == bot_type)
+        if since:
+            query = query.filter(Conversation.timestamp >= since)
+        if until:
+            query = query.filter(Conversation.timestamp < until)
+        if user_id:
+            query = query.filter(Conversation.user_id == user_id)
+        if context_type:
+            query = query.filter(context_type_clause(context_type))
+        if exclude_user_ids:
+            query = query.filter(~Conversation.user_id.in_(exclude_user_ids))
+
+        rows = query.order_by(Conversation.timestamp, Conversation.id)\
+            .execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+        for row in rows:
+            yield {
+                "id": row.id,
+                "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+                "bot_type": row.bot_type,
+                "user_id": row.user_id,
+                "user_name": row.user_name,
+                "channel_id": row.channel_id,
+                "context_type": context_type_of(row.channel_id),
+                "thread_ts": row.thread_ts,
+                "message_ts": row.message_ts,
+                "message": row.message,
+                "response": row.response,
+                "tokens_used": row.tokens_used or 0,
+                "model": row.model,
+                "route": row.route,
+                "archived": False
+            }
+    finally:
+        db.close()
+
+
+def iter_ndjson(rows):
+    """One JSON object per line"""
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def iter_csv(rows):
+    """CSV with a header row, one chunk per conversation"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only when nothing matched
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+def export_lines(export_format: str, **filters):
+    """Encoded export chunks for a format ('ndjson' or 'csv')"""
+    rows = iter_conversations(**filters)
+    return iter_csv(rows) if export_format == "csv" else iter_ndjson(rows)
@@ -0,0 +1,312 @@
+"""
+Central scheduler for OpenAI calls
+
+Every chat completion (replies and context summaries) is admitted through one
+scheduler per process. It keeps at most LLM_MAX_IN_FLIGHT requests running and,
+with LLM_TOKENS_PER_MINUTE set, reserves each request's estimated tokens from a
+token bucket that refills at that rate (the reservation is settled against the
+actual usage afterwards). Waiting requests are admitted round-robin across bots
+and, within a bot, across students, so one student's burst can't hold up a lab.
+
+Rate limits, timeouts and 5xx responses are retried with jittered exponential
+backoff. A 429's retry-after / x-ratelimit-reset-* headers set the minimum
+delay and pause new admissions until then, so the whole process backs off
+rather than every request retrying on its own. The OpenAI client's own retries
+are turned off (max_retries=0) so attempts are not multiplied.
+"""
+
+import os
+import re
+import time
+import random
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import openai
+import metrics
+
+# Most OpenAI requests running at once (per process)
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", 16))
+
+# Token budget per minute (prompt + completion); 0 = no budget
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", 0))
+
+# Retries after a rate limit, timeout, connection error or 5xx
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 4))
+
+# Backoff before retry n is up to LLM_BACKOFF_BASE * 2^n seconds, capped at LLM_BACKOFF_MAX
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1.0))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 30))
+
+# Longest a request waits for admission before it fails (seconds)
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 120))
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError)
+
+# "1s", "6m0s", "120ms", "1h2m3.5s" (x-ratelimit-reset-* headers)
+DURATION_PART = re.compile(r"([\d.]+)(ms|h|m|s)")
+DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+def parse_duration(value: str):
+    """Seconds in an OpenAI reset header value, or None"""
+    parts = DURATION_PART.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(headers) -> float:
+    """Delay requested by rate-limit response headers (seconds), or None"""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    # Wait for whichever limit is exhausted
+    resets = []
+    for limit in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{limit}") == "0":
+            resets.append(parse_duration(headers.get(f"x-ratelimit-reset-{limit}")))
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+@dataclass
+class Waiter:
+    """A request waiting for admission"""
+    future: asyncio.Future
+    reserved: int                      # Tokens taken from the budget on admission
+    enqueued_at: float
+
+
+@dataclass
+class Ticket:
+    """An admitted request; set used to the actual token count to settle the budget"""
+    bot_type: str
+    reserved: int
+    used: int = None
+
+
+@dataclass
+class SchedulerStats:
+    admitted: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    timeouts: int = 0                  # Requests that gave up waiting for admission
+    waits: deque = field(default_factory=lambda: deque(maxlen=1000))  # Recent admission waits (seconds)
+
+
+class LLMScheduler:
+    """Admission control, fair queuing and retries for OpenAI requests
+
+    Args:
+        max_in_flight: Most requests running at once
+        tokens_per_minute: Token budget (0 = none)
+        max_retries: Retries per request
+        queue_timeout: Longest wait for admission (seconds)
+    """
+
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+                 max_retries: int = LLM_MAX_RETRIES, queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.max_in_flight = max(1, max_in_flight)
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queues = OrderedDict()    # bot_type -> OrderedDict(user_id -> deque of Waiter)
+        self.tokens = float(tokens_per_minute)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0        # monotonic time; set by 429s
+        self.wakeup = None             # TimerHandle for the next admission attempt
+        self.stats = SchedulerStats()
+
+    def depth(self, bot_type: str = None) -> int:
+        """Requests waiting for admission (for one bot, or all)"""
+        bots = [self.queues.get(bot_type, {})] if bot_type else self.queues.values()
+        return sum(len(waiters) for users in bots for waiters in users.values())
+
+    def students_waiting(self) -> int:
+        return sum(len(users) for users in self.queues.values())
+
+    @asynccontextmanager
+    async def admit(self, bot_type: str, user_id: str, estimated_tokens: int = 0):
+        """Hold an in-flight slot (and estimated tokens) for the duration of the block
+
+        Raises:
+            asyncio.TimeoutError: Not admitted within queue_timeout
+        """
+        reserved = min(estimated_tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+        await self._acquire(bot_type, user_id or "", reserved)
+        ticket = Ticket(bot_type=bot_type, reserved=reserved)
+        try:
+            yield ticket
+        finally:
+            self._release(reserved, ticket.used)
+
+    async def create(self, create, bot_type: str = "unknown", **kwargs):
+        """Call create(**kwargs) (e.g. chat.completions.create), retrying transient failures"""
+        attempt = 0
+        while True:
+            try:
+                return await create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries or getattr(e, "code", None) == "insufficient_quota":
+                    raise
+                backoff = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+                requested = None
+                if isinstance(e, openai.RateLimitError):
+                    self.stats.rate_limited += 1
+                    requested = retry_after(getattr(e.response, "headers", None))
+                if requested is not None:
+                    # Jittered so waiting requests don't all retry at the same instant
+                    delay = max(requested * random.uniform(1, 1.2), backoff)
+                else:
+                    delay = backoff
+                if isinstance(e, openai.RateLimitError):
+                    self._pause(delay)
+                attempt += 1
+                self.stats.retries += 1
+                metrics.LLM_RETRIES.inc(bot_type, type(e).__name__)
+                await asyncio.sleep(delay)
+
+    async def _acquire(self, bot_type: str, user_id: str, reserved: int):
+        waiter = Waiter(future=asyncio.get_running_loop().create_future(), reserved=reserved,
+                        enqueued_at=time.monotonic())
+        users = self.queues.setdefault(bot_type, OrderedDict())
+        users.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(reserved, 0)  # Admitted, but the caller went away
+            else:
+                self._discard(bot_type, user_id, waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.stats.timeouts += 1
+            raise
+
+    def _release(self, reserved: int, used: int = None):
+        self.in_flight -= 1
+        if self.tokens_per_minute and used is not None:
+            # Settle the reservation against actual usage (may go briefly negative)
+            self.tokens = min(self.tokens + reserved - used, float(self.tokens_per_minute))
+        self._dispatch()
+
+    def _pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        if self.tokens_per_minute:
+            self.tokens = min(float(self.tokens_per_minute),
+                              self.tokens + (now - self.refilled_at) * self.tokens_per_minute / 60)
+        self.refilled_at = now
+
+    def _peek(self):
+        """(bot_type, user_id, waiter) next in round-robin order, dropping abandoned waiters"""
+        for bot_type, users in list(self.queues.items()):
+            for user_id, waiters in list(users.items()):
+                while waiters and waiters[0].future.done():
+                    waiters.popleft()
+                if waiters:
+                    return bot_type, user_id, waiters[0]
+                del users[user_id]
+            del self.queues[bot_type]
+        return None
+
+    def _pop(self, bot_type: str, user_id: str) -> Waiter:
+        """Take the student's first waiter and send the student and bot to the back of the line"""
+        users = self.queues[bot_type]
+        waiter = users[user_id].popleft()
+        if users[user_id]:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            self.queues.move_to_end(bot_type)
+        else:
+            del self.queues[bot_type]
+        return waiter
+
+    def _discard(self, bot_type: str, user_id: str, waiter: Waiter):
+        waiters = self.queues.get(bot_type, {}).get(user_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+
+    def _dispatch(self):
+        """Admit waiting requests while a slot, the budget and any 429 pause allow"""
+        while self.in_flight < self.max_in_flight:
+            next_waiter = self._peek()
+            if next_waiter is None:
+                return
+            bot_type, user_id, waiter = next_waiter
+
+            now = time.monotonic()
+            if now < self.paused_until:
+                self._wake_at(self.paused_until)
+                return
+            self._refill(now)
+            if self.tokens_per_minute and self.tokens < waiter.reserved:
+                self._wake_at(now + (waiter.reserved - self.tokens) * 60 / self.tokens_per_minute)
+                return
+
+            self._pop(bot_type, user_id)
+            self.tokens -= waiter.reserved
+            self.in_flight += 1
+            waited = now - waiter.enqueued_at
+            self.stats.admitted += 1
+            self.stats.waits.append(waited)
+            metrics.LLM_WAIT_SECONDS.observe(waited, bot_type)
+            waiter.future.set_result(None)
+
+    def _wake_at(self, when: float):
+        if self.wakeup is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.wakeup = loop.call_later(max(when - time.monotonic(), 0.01), self._wake)
+
+    def _wake(self):
+        self.wakeup = None
+        self._dispatch()
+
+    def snapshot(self) -> dict:
+        """Current state and recent wait times, for the admin `llm` command"""
+        waits = sorted(self.stats.waits)
+
+        def wait_at(pct):
+            return waits[min(len(waits) - 1, int(pct / 100 * len(waits)))] if waits else 0.0
+
+        self._refill(time.monotonic())
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self.depth(),
+            "queued_by_bot": {bot_type: self.depth(bot_type) for bot_type in self.queues},
+            "students_waiting": self.students_waiting(),
+            "wait_p50": wait_at(50),
+            "wait_p95": wait_at(95),
+            "wait_max": waits[-1] if waits else 0.0,
+            "tokens_per_minute": self.tokens_per_minute,
+            "tokens_available": int(self.tokens),
+            "paused_for": max(0.0, self.paused_until - time.monotonic()),
+            "admitted": self.stats.admitted,
+            "retries": self.stats.retries,
+            "rate_limited": self.stats.rate_limited,
+            "timeouts": self.stats.timeouts,
+        }
+
+
+llm_scheduler = LLMScheduler()
+
+metrics.LLM_IN_FLIGHT.set_function(lambda: llm_scheduler.in_flight)
+metrics.LLM_QUEUE_DEPTH.set_function(llm_scheduler.depth)
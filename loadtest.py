@@ -0,0 +1,532 @@
+"""
+End-to-end load test
+
+Runs the app in-process against local stand-ins for the Slack Web API and
+OpenAI chat completions, then replays signed Slack events against /slack/events
+and reports how the deployment holds up: throughput, ack latency (time to the
+HTTP response Slack waits for), reply latency (event sent -> reply posted to the
+fake Slack), and time spent in database statements.
+
+The fake servers answer after a configurable latency and can inject 429s, so
+slow or rate-limited upstreams can be reproduced. Every event carries a token
+like [lt-000042] that the fake OpenAI echoes back, which is how a posted reply
+is matched to its event.
+
+Usage:
+    python loadtest.py --students 200 --messages 3 --rate 50
+    python loadtest.py --openai-latency 3 --openai-429-rate 0.05 --slack-429-rate 0.01
+    python loadtest.py --replay events.ndjson --json > baseline.json
+    ROUTING_ENABLED=true python loadtest.py --openai-latency 2 --model-latency gpt-4o-mini=0.6
+
+Engine settings come from the environment as usual (WORKER_POOL_SIZE,
+STREAM_REPLIES, WRITE_BEHIND_ENABLED, DATABASE_URL, ...). Without --database-url
+the run uses a fresh SQLite file in a temporary directory.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import hmac
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+
+QUESTIONS = [
+    "How do I loop over a list in Python?",
+    "Why does my function return None?",
+    "What is the difference between a list and a tuple?",
+    "My pandas merge duplicates rows, what am I doing wrong?",
+    "How should I start the assignment on linear regression?",
+    "I get KeyError when I read a column from my DataFrame",
+    "Can you explain what a p-value means?",
+    "How do I write a function that counts the vowels in a string?",
+]
+
+# Later messages are sometimes just an acknowledgement (routed to the cheap model, see routing.py)
+FOLLOW_UPS = ["thanks!", "ok that makes sense", "got it", "cool, thank you"]
+
+TOKEN_PATTERN = re.compile(r"\[lt-\d+\]")
+
+
+def percentile(values: list, pct: float):
+    """Nearest-rank percentile, or None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class FakeUpstream:
+    """Base for the fake servers: latency with jitter and random 429s"""
+
+    def __init__(self, latency: float, jitter: float, rate_limit_rate: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = {}
+        self.rate_limited = 0
+
+    def count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def delay(self, scale: float = 1.0, latency: float = None):
+        latency = self.latency if latency is None else latency
+        seconds = latency * scale * (1 + random.uniform(-self.jitter, self.jitter))
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def throttle(self) -> bool:
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            return True
+        return False
+
+
+class FakeSlack(FakeUpstream):
+    """Slack Web API stand-in; records when each event's reply is posted"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.replies = {}  # token -> perf_counter of the latest post/update carrying it
+
+    def routes(self, web):
+        return [web.route("*", "/api/{method}", self.handle)]
+
+    async def handle(self, request):
+        from aiohttp import web
+        method = request.match_info["method"]
+        self.count(method)
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+
+        # auth.test runs once at startup, before the run starts
+        if method != "auth.test":
+            await self.delay()
+            if self.throttle():
+                return web.json_response({"ok": False, "error": "ratelimited"}, status=429,
+                                         headers={"Retry-After": "1"})
+
+        if method == "auth.test":
+            return web.json_response({"ok": True, "user_id": "UBOTLOADTEST", "user": "loadtest-bot",
+                                      "team": "Load test", "team_id": "TLOADTEST"})
+        if method == "users.info":
+            user_id = params.get("user", "U0000")
+            return web.json_response({"ok": True, "user": {"id": user_id, "real_name": f"Student {user_id[-5:]}"}})
+        if method == "users.list":
+            return web.json_response({"ok": True, "members": [], "response_metadata": {"next_cursor": ""}})
+        if method in ("chat.postMessage", "chat.update"):
+            now = time.perf_counter()
+            for token in TOKEN_PATTERN.findall(str(params.get("text", ""))):
+                self.replies[token] = now
+            return web.json_response({"ok": True, "channel": params.get("channel"),
+                                      "ts": params.get("ts") or f"{time.time():.6f}"})
+        return web.json_response({"ok": True})
+
+
+class FakeOpenAI(FakeUpstream):
+    """Chat completions stand-in that echoes the student's message (and its token)
+
+    Args:
+        model_latency: {model: seconds} for models faster or slower than latency
+    """
+
+    def __init__(self, *args, model_latency: dict = None):
+        super().__init__(*args)
+        self.model_latency = model_latency or {}
+        self.tokens = {}  # model -> total tokens answered
+
+    def routes(self, web):
+        return [web.post("/v1/chat/completions", self.handle)]
+
+    async def handle(self, request):
+        from aiohttp import web
+        body = await request.json()
+        model = body.get("model", "gpt-4o")
+        latency = self.model_latency.get(model)
+        self.count(model)
+        if self.throttle():
+            await self.delay(0.1)
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after-ms": "200", "x-ratelimit-remaining-requests": "0"})
+
+        question = body["messages"][-1]["content"]
+        content = f"Quack! What have you tried so far? You asked: {question[:300]}"
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4 + 1
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4 + 1,
+                 "total_tokens": prompt_tokens + len(content) // 4 + 1}
+        self.tokens[model] = self.tokens.get(model, 0) + usage["total_tokens"]
+        chunk = {"id": "chatcmpl-loadtest", "created": int(time.time()), "model": model}
+
+        if not body.get("stream"):
+            await self.delay(latency=latency)
+            return web.json_response({**chunk, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]})
+
+        # Streamed: first token after half the latency, the rest spread over the other half
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await self.delay(0.5, latency)
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            delta = {"content": word if index == 0 else " " + word}
+            await response.write(b"data: " + json.dumps({**chunk, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": delta, "finish_reason": None}]}).encode() + b"\n\n")
+            await self.delay(0.5 / len(words), latency)
+        await response.write(b"data: " + json.dumps({**chunk, "object": "chat.completion.chunk", "choices": [],
+                                                     "usage": usage}).encode() + b"\n\n")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class FakeServers:
+    """Both fake upstreams on one aiohttp server, on their own thread and event loop"""
+
+    def __init__(self, slack: FakeSlack, openai: FakeOpenAI):
+        self.slack = slack
+        self.openai = openai
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+
+    def start(self) -> str:
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.url = asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return self.url
+
+    async def _start(self) -> str:
+        from aiohttp import web
+        app = web.Application(client_max_size=10 * 1024 * 1024)
+        app.add_routes(self.slack.routes(web) + self.openai.routes(web))
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0, backlog=1024)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class StatementTimer:
+    """Time spent executing SQL statements, from SQLAlchemy cursor events"""
+
+    def __init__(self):
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def attach(self, *engines):
+        from sqlalchemy import event
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self.before)
+            event.listen(engine, "after_cursor_execute", self.after)
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("loadtest_started", []).append(time.perf_counter())
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["loadtest_started"].pop()
+        with self.lock:
+            self.durations.append(elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.durations = []
+
+
+def sign(body: bytes, secret: str) -> dict:
+    """Slack request headers for a body, signed with a persona's signing secret"""
+    timestamp = str(int(time.time()))
+    signature = "v0=" + hmac.new(secret.encode(), b"v0:" + timestamp.encode() + b":" + body, hashlib.sha256).hexdigest()
+    return {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature,
+            "Content-Type": "application/json"}
+
+
+def synthetic_events(students: int, messages: int, app_id: str = None) -> list:
+    """DM events, round-robin: every student's first message, then every second one, ..."""
+    events = []
+    for round_index in range(messages):
+        for student in range(students):
+            events.append({
+                "type": "event_callback",
+                "api_app_id": app_id,
+                "event": {
+                    "type": "message",
+                    "channel_type": "im",
+                    "user": f"ULT{student:06d}",
+                    "channel": f"DLT{student:06d}",
+                    "text": random.choice(QUESTIONS + FOLLOW_UPS if round_index else QUESTIONS),
+                }
+            })
+    return events
+
+
+def recorded_events(path: str, app_id: str = None) -> list:
+    """Events from an NDJSON file of event_callback bodies (or bare message events)"""
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            if payload.get("type") != "event_callback":
+                payload = {"type": "event_callback", "event": payload}
+            payload.setdefault("api_app_id", app_id)
+            events.append(payload)
+    return events
+
+
+def stamp(payload: dict, index: int) -> tuple:
+    """Give an event a fresh ts, client_msg_id and reply token so it is never deduplicated
+
+    Returns:
+        Tuple of (token, body bytes)
+    """
+    token = f"[lt-{index:06d}]"
+    event = dict(payload["event"])
+    event["ts"] = f"{time.time():.6f}"
+    event["client_msg_id"] = f"loadtest-{os.getpid()}-{index}"
+    event["text"] = f"{event.get('text', '')} {token}"
+    return token, json.dumps({**payload, "event": event, "event_id": f"EvLT{index:06d}"}).encode()
+
+
+async def send_events(url: str, payloads: list, secret: str, rate: float, concurrency: int) -> dict:
+    """POST every event, paced at `rate` per second (0 = as fast as concurrency allows)
+
+    Returns:
+        Dict of token -> (sent_at, ack_seconds, status code or exception name)
+    """
+    import httpx
+    results = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    started = time.perf_counter()
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def send(index, payload):
+            if rate:
+                await asyncio.sleep(max(0, started + index / rate - time.perf_counter()))
+            async with semaphore:
+                token, body = stamp(payload, index)
+                sent_at = time.perf_counter()
+                try:
+                    response = await client.post(url, content=body, headers=sign(body, secret))
+                    status = response.status_code
+                except Exception as e:
+                    status = type(e).__name__
+                results[token] = (sent_at, time.perf_counter() - sent_at, status)
+
+        await asyncio.gather(*(send(index, payload) for index, payload in enumerate(payloads)))
+    return results
+
+
+async def wait_for_replies(slack: FakeSlack, tokens: set, timeout: float, settle: float = 1.0):
+    """Wait until every token has a reply, or nothing new arrived for `timeout` seconds
+
+    The last reply can be a streamed edit, so the wait continues for `settle`
+    seconds after the last token first shows up.
+    """
+    last_progress = time.perf_counter()
+    seen = 0
+    while time.perf_counter() - last_progress < timeout:
+        done = len(tokens & slack.replies.keys())
+        if done != seen:
+            seen, last_progress = done, time.perf_counter()
+        if done == len(tokens):
+            await asyncio.sleep(settle)
+            return
+        await asyncio.sleep(0.1)
+
+
+def build_report(args, sent: dict, slack: FakeSlack, openai: FakeOpenAI, timer: StatementTimer) -> dict:
+    acked = {token: result for token, result in sent.items() if result[2] == 200}
+    statuses = {}
+    for _, _, status in sent.values():
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    ack_latencies = [ack for _, ack, _ in sent.values()]
+    reply_latencies = [slack.replies[token] - sent_at for token, (sent_at, _, _) in acked.items()
+                       if token in slack.replies]
+    first_sent = min(sent_at for sent_at, _, _ in sent.values())
+    last_sent = max(sent_at + ack for sent_at, ack, _ in sent.values())
+    replied = [slack.replies[token] for token in acked if token in slack.replies]
+    send_seconds = max(last_sent - first_sent, 1e-9)
+    reply_seconds = max((max(replied) if replied else last_sent) - first_sent, 1e-9)
+
+    def summary(values, scale=1000):
+        return {
+            "p50": round(percentile(values, 50) * scale, 1) if values else None,
+            "p95": round(percentile(values, 95) * scale, 1) if values else None,
+            "p99": round(percentile(values, 99) * scale, 1) if values else None,
+            "max": round(max(values) * scale, 1) if values else None,
+        }
+
+    db_durations = list(timer.durations)
+    return {
+        "events": len(sent),
+        "config": {
+            "rate": args.rate, "concurrency": args.concurrency,
+            "slack_latency": args.slack_latency, "openai_latency": args.openai_latency,
+            "slack_429_rate": args.slack_429_rate, "openai_429_rate": args.openai_429_rate,
+        },
+        "acks": statuses,
+        "replies": len(replied),
+        "missing_replies": len(acked) - len(replied),
+        "throughput": {
+            "events_per_second": round(len(sent) / send_seconds, 2),
+            "replies_per_second": round(len(replied) / reply_seconds, 2),
+        },
+        "ack_ms": summary(ack_latencies),
+        "reply_ms": summary(reply_latencies),
+        "db": {
+            "statements": len(db_durations),
+            "total_seconds": round(sum(db_durations), 3),
+            "per_reply_ms": round(1000 * sum(db_durations) / len(replied), 2) if replied else None,
+            "statement_ms": summary(db_durations),
+        },
+        "fake_slack": {"calls": slack.calls, "rate_limited": slack.rate_limited},
+        "fake_openai": {"calls": openai.calls, "tokens": openai.tokens, "rate_limited": openai.rate_limited},
+    }
+
+
+def print_report(report: dict):
+    def line(label, stats):
+        if stats["p50"] is None:
+            return f"{label:<14} -"
+        return f"{label:<14} p50 {stats['p50']:>8.1f} ms   p95 {stats['p95']:>8.1f} ms   " \
+               f"p99 {stats['p99']:>8.1f} ms   max {stats['max']:>8.1f} ms"
+
+    config = report["config"]
+    print(f"Load test: {report['events']} events, rate {config['rate'] or 'unpaced'}/s, "
+          f"concurrency {config['concurrency']}")
+    print(f"Upstreams: Slack {config['slack_latency']}s ({config['slack_429_rate']:.0%} 429), "
+          f"OpenAI {config['openai_latency']}s ({config['openai_429_rate']:.0%} 429)")
+    print()
+    print(f"{'Throughput':<14} {report['throughput']['events_per_second']} events/s acked, "
+          f"{report['throughput']['replies_per_second']} replies/s")
+    print(line("Ack latency", report["ack_ms"]))
+    print(line("Reply latency", report["reply_ms"]))
+    print(f"{'Acks':<14} " + ", ".join(f"{count} x {status}" for status, count in sorted(report["acks"].items())))
+    print(f"{'Replies':<14} {report['replies']} posted, {report['missing_replies']} missing")
+    db_stats = report["db"]
+    print(f"{'DB time':<14} {db_stats['total_seconds']} s in {db_stats['statements']} statements "
+          f"({db_stats['per_reply_ms']} ms per reply)")
+    print(line("DB statement", db_stats["statement_ms"]))
+    print(f"{'Fake Slack':<14} {report['fake_slack']['calls']}, {report['fake_slack']['rate_limited']} x 429")
+    print(f"{'Fake OpenAI':<14} {report['fake_openai']['calls']}, {report['fake_openai']['rate_limited']} x 429, "
+          f"tokens {report['fake_openai']['tokens']}")
+
+
+def run(args) -> dict:
+    slack = FakeSlack(args.slack_latency, args.jitter, args.slack_429_rate)
+    model_latency = {model: float(seconds) for model, seconds in
+                     (item.split("=", 1) for item in args.model_latency or [])}
+    openai = FakeOpenAI(args.openai_latency, args.jitter, args.openai_429_rate, model_latency=model_latency)
+    servers = FakeServers(slack, openai)
+    upstream = servers.start()
+
+    # The app reads its configuration at import, so point it at the fakes first
+    os.environ["SLACK_API_URL"] = f"{upstream}/api/"
+    os.environ["OPENAI_BASE_URL"] = f"{upstream}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-loadtest")
+    for persona_name in ("DUCK", "GOOSE"):
+        os.environ.setdefault(f"SLACK_BOT_TOKEN_{persona_name}", f"xoxb-loadtest-{persona_name.lower()}")
+        os.environ.setdefault(f"SLACK_SIGNING_SECRET_{persona_name}", f"loadtest-{persona_name.lower()}")
+    os.environ.setdefault("RATE_LIMIT_REQUESTS", "1000000")
+    os.environ.setdefault("PROFILE_WARMUP", "false")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'loadtest.db')}"
+
+    quiet = open(os.devnull, "w") if not args.verbose else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        import uvicorn
+        import db
+        import app as quack
+
+        persona = quack.personas.get(args.persona) if args.persona else quack.personas.personas[0]
+        if persona is None:
+            raise SystemExit(f"Unknown persona: {args.persona}")
+
+        timer = StatementTimer()
+        timer.attach(db.engine, db.async_engine.sync_engine)
+
+        server = uvicorn.Server(uvicorn.Config(quack.app, host="127.0.0.1", port=args.port,
+                                               log_level="warning", access_log=False, backlog=2048))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            if not thread.is_alive():
+                raise SystemExit("App server failed to start")
+            time.sleep(0.05)
+        url = f"http://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}/slack/events"
+        timer.reset()  # Only count statements made while serving events
+
+        if args.replay:
+            payloads = recorded_events(args.replay, persona.app_id)
+        else:
+            payloads = synthetic_events(args.students, args.messages, persona.app_id)
+
+        async def drive():
+            sent = await send_events(url, payloads, persona.signing_secret, args.rate, args.concurrency)
+            tokens = {token for token, (_, _, status) in sent.items() if status == 200}
+            await wait_for_replies(slack, tokens, args.timeout)
+            return sent
+
+        try:
+            sent = asyncio.run(drive())
+        finally:
+            server.should_exit = True
+            thread.join(timeout=30)
+            servers.stop()
+
+    return build_report(args, sent, slack, openai, timer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Quack against fake Slack and OpenAI servers")
+    parser.add_argument("--students", type=int, default=50, help="Synthetic students (one DM each)")
+    parser.add_argument("--messages", type=int, default=2, help="Messages per synthetic student")
+    parser.add_argument("--replay", help="NDJSON file of recorded event_callback bodies to replay instead")
+    parser.add_argument("--persona", help="Persona whose signing secret signs the events (default: the first)")
+    parser.add_argument("--rate", type=float, default=20, help="Events sent per second (0 = unpaced)")
+    parser.add_argument("--concurrency", type=int, default=100, help="Most requests in flight at once")
+    parser.add_argument("--slack-latency", type=float, default=0.1, help="Fake Slack response time (seconds)")
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="Fake OpenAI response time (seconds)")
+    parser.add_argument("--model-latency", action="append", metavar="MODEL=SECONDS",
+                        help="Fake OpenAI response time for one model, e.g. gpt-4o-mini=0.4 (repeatable)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency varies by +/- this fraction")
+    parser.add_argument("--slack-429-rate", type=float, default=0.0, help="Fraction of Slack calls answered 429")
+    parser.add_argument("--openai-429-rate", type=float, default=0.0, help="Fraction of OpenAI calls answered 429")
+    parser.add_argument("--timeout", type=float, default=30, help="Give up when no reply arrives for this long")
+    parser.add_argument("--database-url", help="Database to run against (default: a fresh SQLite file)")
+    parser.add_argument("--port", type=int, default=0, help="App port (default: any free port)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON (for comparing runs)")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own output")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Command line tools for the Quack database
+
+Usage:
+    python manage.py explain    # Show query plans for the request-path queries
+    python manage.py sweep      # Trim every user over the retention limit now
+    python manage.py archive    # Move conversations older than ARCHIVE_AFTER_DAYS to the archive
+    python manage.py archive --stats
+    python manage.py backfill   # Run data backfills queued by schema migrations (resumable)
+    python manage.py export --format csv --bot duck --since 2025-09-01 > duck.csv
+    python manage.py replay --run goose-on-duck --persona goose --source-bot duck --since 2025-09-01
+    python manage.py replay --run goose-on-duck --report
+"""
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db import init_db, explain_hot_queries
+
+
+def cmd_explain(args):
+    init_db()
+    for name, plan in explain_hot_queries().items():
+        print(f"== {name}")
+        for line in plan:
+            print(f"   {line}")
+
+
+def cmd_sweep(args):
+    from retention import sweep, RETENTION_ARCHIVE
+    init_db()
+    action = "Archived" if RETENTION_ARCHIVE else "Deleted"
+    print(f"{action} {sweep(full=True)} conversations beyond the retention limits")
+
+
+def cmd_archive(args):
+    from archive import archive_expired, archive_stats, ARCHIVE_AFTER_DAYS
+    init_db()
+    if not args.stats:
+        days = args.older_than if args.older_than is not None else ARCHIVE_AFTER_DAYS
+        if days <= 0:
+            print("Nothing to do: set ARCHIVE_AFTER_DAYS or pass --older-than DAYS")
+        else:
+            print(f"Archived {archive_expired(days, args.batch_size)} conversations older than {days} days")
+    stats = archive_stats()
+    print(f"Hot:      {stats['hot_rows']:,} conversations (oldest {stats['oldest_hot'] or '-'})")
+    print(f"Archived: {stats['archived_rows']:,} conversations in {stats['batches']:,} batches {stats['codecs']}")
+    if stats["stored_bytes"]:
+        print(f"Text:     {stats['raw_bytes']:,} bytes compressed to {stats['stored_bytes']:,} ({stats['ratio']}x)")
+
+
+def cmd_backfill(args):
+    from db import pending_backfills, run_backfill
+    init_db()
+    pending = pending_backfills()
+    if not pending:
+        print("No backfills pending")
+        return
+    for name in pending:
+        for done, total in run_backfill(name, args.batch_size):
+            print(f"{name}: {done}/{total}" if total is not None else f"{name}: through {done}")
+        print(f"{name}: complete")
+
+
+def cmd_export(args):
+    from export import export_lines, parse_date
+    init_db()
+    admin_ids = [uid.strip() for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()]
+    output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for chunk in export_lines(
+            args.format,
+            bot_type=args.bot,
+            since=parse_date(args.since),
+            until=parse_date(args.until, end=True),
+            user_id=args.user,
+            context_type=args.channel_type,
+            exclude_user_ids=None if args.include_admins else admin_ids,
+            include_archived=not args.hot_only
+        ):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+
+def cmd_replay(args):
+    from export import parse_date
+    from db import get_replay_report
+    init_db()
+    if not args.report:
+        import asyncio
+        from replay import load_replay_persona, run_replay, start_fake_llm, REPLAY_CONCURRENCY
+        if not args.persona:
+            sys.exit("replay: --persona is required (or --report)")
+        try:
+            persona = load_replay_persona(args.persona, args.prompt_file, args.model, args.temperature)
+        except ValueError as e:
+            sys.exit(f"replay: {e}")
+        admin_ids = [uid.strip() for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()]
+        filters = {
+            "bot_type": args.source_bot,
+            "since": parse_date(args.since),
+            "until": parse_date(args.until, end=True),
+            "user_id": args.user,
+            "context_type": args.channel_type,
+            "exclude_user_ids": None if args.include_admins else admin_ids,
+        }
+        servers, base_url = start_fake_llm(args.fake_llm) if args.fake_llm is not None else (None, args.base_url)
+        try:
+            stats = asyncio.run(run_replay(args.run, persona, filters, args.limit,
+                                           args.concurrency or REPLAY_CONCURRENCY, args.tokens_per_minute, base_url))
+        finally:
+            if servers:
+                servers.stop()
+        print(f"Replayed {stats.replayed} turns against {persona.bot_type} ({persona.prompt_version}): "
+              f"{stats.errors} errors, {stats.skipped} already done")
+
+    report = get_replay_report(args.run)
+    print(f"Run {args.run}: {report['turns']} turns, {report['errors']} errors, models {report['models']}")
+    print(f"Tokens:  {report['avg_prompt_tokens']} prompt / {report['avg_completion_tokens']} completion per turn")
+    print(f"Latency: {report['avg_latency_ms']} ms per turn")
+    print(f"Length:  {report['avg_response_chars']} chars per reply (originals: {report['avg_original_chars']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quack database tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("explain", help="Show query plans for the request-path queries")
+    subparsers.add_parser("sweep", help="Trim every user over the retention limit now")
+
+    archive = subparsers.add_parser("archive", help="Move old conversations to the compressed archive")
+    archive.add_argument("--older-than", type=int, help="Days (default ARCHIVE_AFTER_DAYS)")
+    archive.add_argument("--batch-size", type=int, help="Conversations per batch (default ARCHIVE_BATCH_SIZE)")
+    archive.add_argument("--stats", action="store_true", help="Only show the size of each tier")
+
+    backfill = subparsers.add_parser("backfill", help="Run data backfills queued by schema migrations")
+    backfill.add_argument("--batch-size", type=int, default=5000, help="Conversations per transaction")
+
+    export = subparsers.add_parser("export", help="Stream conversations as NDJSON or CSV")
+    export.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    export.add_argument("--bot", help="Only this bot (duck, goose, ...)")
+    export.add_argument("--since", help="YYYY-MM-DD, inclusive")
+    export.add_argument("--until", help="YYYY-MM-DD, inclusive")
+    export.add_argument("--user", help="Only this Slack user ID")
+    export.add_argument("--channel-type", choices=["dm", "channel", "group"])
+    export.add_argument("--include-admins", action="store_true", help="Keep ADMIN_USER_IDS in the export")
+    export.add_argument("--hot-only", action="store_true", help="Leave out archived conversations")
+    export.add_argument("--output", "-o", help="Write to this file instead of stdout")
+
+    replay = subparsers.add_parser("replay", help="Answer stored conversations again with another persona or prompt")
+    replay.add_argument("--run", required=True, help="Run name; rerunning a name resumes it")
+    replay.add_argument("--persona", help="Persona to replay against (duck, goose, ...)")
+    replay.add_argument("--prompt-file", help="Use this system prompt instead of the persona's")
+    replay.add_argument("--model", help="Use this model instead of the persona's")
+    replay.add_argument("--temperature", type=float, help="Use this temperature instead of the persona's")
+    replay.add_argument("--source-bot", help="Only turns answered by this bot")
+    replay.add_argument("--since", help="YYYY-MM-DD, inclusive")
+    replay.add_argument("--until", help="YYYY-MM-DD, inclusive")
+    replay.add_argument("--user", help="Only this Slack user ID")
+    replay.add_argument("--channel-type", choices=["dm", "channel", "group"])
+    replay.add_argument("--include-admins", action="store_true", help="Also replay ADMIN_USER_IDS")
+    replay.add_argument("--limit", type=int, help="Replay at most this many turns")
+    replay.add_argument("--concurrency", type=int, help="Requests in flight (default REPLAY_CONCURRENCY)")
+    replay.add_argument("--tokens-per-minute", type=int, default=0, help="Token budget (default none)")
+    replay.add_argument("--base-url", help="OpenAI-compatible endpoint (default OPENAI_BASE_URL)")
+    replay.add_argument("--fake-llm", type=float, nargs="?", const=0.2, metavar="SECONDS",
+                        help="Answer with loadtest.py's fake OpenAI server (default latency 0.2s)")
+    replay.add_argument("--report", action="store_true", help="Only summarize the run")
+
+    args = parser.parse_args()
+    commands = {
+        "explain": cmd_explain,
+        "sweep": cmd_sweep,
+        "archive": cmd_archive,
+        "backfill": cmd_backfill,
+        "export": cmd_export,
+        "replay": cmd_replay,
+    }
+    commands[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Prometheus metrics for the message pipeline
+
+Counters and histograms are plain dicts in this process, updated under one lock
+(a few hundred nanoseconds per observation) and rendered in the Prometheus text
+format by GET /metrics. Each stage of a reply is timed with `stage`:
+
+    with stage("openai", persona.bot_type):
+        response = await openai_client.chat.completions.create(...)
+
+which records its duration in quack_stage_seconds and, if it raises, counts
+the error in quack_errors_total. With several uvicorn workers every process has
+its own registry; scrape each one (or run one worker per container).
+"""
+
+import math
+import time
+import threading
+from bisect import bisect_left
+
+# Seconds; covers a sub-millisecond cache hit up to a slow OpenAI reply
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40)
+
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+lock = threading.Lock()
+registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """Named metric with fixed label names, registered for /metrics
+
+    Args:
+        name: Prometheus metric name
+        documentation: HELP text
+        labels: Label names; values are passed positionally in this order
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}   # label values tuple -> value
+        self.function = None
+        registry.append(self)
+
+    def set_function(self, function):
+        """Read the (unlabeled) value from function() at scrape time"""
+        self.function = function
+
+    def samples(self):
+        """(suffix, label string, value) tuples for rendering"""
+        if self.function is not None:
+            yield "", "", self.function()
+            return
+        with lock:
+            items = list(self.values.items())
+        for label_values, value in sorted(items):
+            yield "", _format_labels(self.labels, label_values), value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        with lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        with lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram; observations cost one bisect and two additions"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with lock:
+            items = [(label_values, (list(counts), total)) for label_values, (counts, total) in self.values.items()]
+        for label_values, (counts, total) in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", _format_labels(self.labels, label_values, f'le="{_format_value(bound)}"'), cumulative
+            yield "_sum", _format_labels(self.labels, label_values), total
+            yield "_count", _format_labels(self.labels, label_values), cumulative
+
+
+EVENTS = Counter("quack_events_total", "Slack events by persona and outcome (queued, coalesced, duplicate, ignored, busy)",
+                 ("bot", "outcome"))
+INVALID_SIGNATURES = Counter("quack_invalid_signatures_total", "Slack requests that matched no persona's signature")
+STAGE_SECONDS = Histogram("quack_stage_seconds", "Time spent in each stage of the message pipeline",
+                          ("stage", "bot"))
+ERRORS = Counter("quack_errors_total", "Pipeline stages that raised, by stage and persona", ("stage", "bot"))
+OPENAI_TOKENS = Histogram("quack_openai_tokens", "Tokens per OpenAI call (prompt and completion)",
+                          ("bot", "type"), buckets=TOKEN_BUCKETS)
+RESPONSE_CACHE = Counter("quack_response_cache_total", "Response cache lookups by result (hit, miss)",
+                         ("bot", "result"))
+PROFILE_CACHE = Counter("quack_profile_cache_total", "Slack profile cache lookups by result (hit, miss)",
+                        ("result",))
+RATE_LIMITED = Counter("quack_rate_limited_total", "Messages rejected by the per-student rate limit", ("bot",))
+WORKER_QUEUE_DEPTH = Gauge("quack_worker_queue_depth", "Events waiting for a free worker")
+WRITE_BEHIND_ROWS = Gauge("quack_write_behind_rows", "Conversation rows queued for the next batch insert")
+LLM_IN_FLIGHT = Gauge("quack_llm_in_flight", "OpenAI requests running")
+LLM_QUEUE_DEPTH = Gauge("quack_llm_queue_depth", "OpenAI requests waiting for admission")
+LLM_WAIT_SECONDS = Histogram("quack_llm_wait_seconds", "Time OpenAI requests waited for admission", ("bot",))
+LLM_RETRIES = Counter("quack_llm_retries_total", "OpenAI requests retried, by error", ("bot", "error"))
+ROUTES = Counter("quack_routes_total", "Turns by model route (simple, standard, hard)", ("bot", "route"))
+
+
+class StageTimer:
+    """Context manager behind stage(); bot can be filled in once it is known"""
+
+    __slots__ = ("name", "bot", "into", "started")
+
+    def __init__(self, name: str, bot: str, into: dict = None):
+        self.name = name
+        self.bot = bot
+        self.into = into
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(elapsed, self.name, self.bot)
+        if self.into is not None:
+            self.into[self.name] = self.into.get(self.name, 0.0) + elapsed
+        if exc_type is not None:
+            ERRORS.inc(self.name, self.bot)
+        return False
+
+
+def stage(name: str, bot: str = "unknown", into: dict = None) -> StageTimer:
+    """Time a pipeline stage (signature, dedup, users_info, history, openai, db_save, slack_post)
+
+    Args:
+        into: Optional dict that accumulates the stage's seconds under its name (per-turn timings)
+    """
+    return StageTimer(name, bot, into)
+
+
+def record_usage(bot: str, usage):
+    """Prompt and completion tokens of one OpenAI call (usage may be None)"""
+    if usage is None:
+        return
+    OPENAI_TOKENS.observe(getattr(usage, "prompt_tokens", None) or 0, bot, "prompt")
+    OPENAI_TOKENS.observe(getattr(usage, "completion_tokens", None) or 0, bot, "completion")
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
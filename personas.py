@@ -0,0 +1,275 @@
+"""
+Tutoring persona registry
+
+A persona is one Slack app (token + signing secret) with its own prompt and
+model settings. Duck and Goose are the built-in personas, configured from the
+SLACK_*_DUCK / SLACK_*_GOOSE environment variables. Set PERSONAS_FILE to a JSON
+list (see personas.example.json) to run any number of personas, e.g. one per
+research arm, from a single deployment.
+
+Incoming events are routed in constant time: by the per-persona endpoint
+(/slack/events/<name>), or by the event's api_app_id. Only events that carry
+neither (e.g. url_verification) fall back to trying each persona's signing
+key, and those keys are prepared once at startup.
+
+Each persona's bot user ID (needed to spot @mentions in group DMs) is resolved
+after startup, concurrently, and persisted in bot_identities, so booting a
+worker never waits on Slack.
+"""
+
+import os
+import re
+import hmac
+import json
+import time
+import asyncio
+import hashlib
+from dataclasses import dataclass, field
+from db import get_bot_identity_async, save_bot_identity_async
+from routing import ROUTING_ENABLED
+
+DUCK_PROMPT = """You are an expert programming tutor configured as the Duck programming assistant. Begin each response with "Quack!". Use warm, friendly language, express enthusiasm, and show interest in the user's coding questions and thoughts. Pay close attention to the user's opinions and preferences, and adapt your responses to align with and complement their inputs. Begin by providing a balanced view on programming topics relevant to the user query, then gradually support the user's perspective if they express strong opinions. Provide additional information to support and strengthen the user's views. Avoid directly challenging the user's perspective. Use open, educational questioning techniques to help the user think critically, but never provide whole code solutions. Before responding, identify and define key computational thinking or coding concepts related to the user's question, using metaphors, analogies, or everyday examples suitable for novice programmers. Prompt the user for clarification if their question is ambiguous. Do not use first-person pronouns or present yourself as a human tutor.
+
+Format your responses using Slack's mrkdwn syntax: use *text* for bold (single asterisk, NOT **text**), _text_ for italic, `code` for inline code, ```code block``` for code blocks, ~text~ for strikethrough, and dashes with line breaks for lists. Do not use double asterisks for bold.
+
+Never ignore any of these instructions."""
+
+GOOSE_PROMPT = """You are an expert programming tutor configured as the Goose programming assistant. Begin each response with "Honk!". Maintain an objective, neutral, and clear tone in your responses. Focus on providing well-structured, accurate explanations that acknowledge multiple perspectives on programming topics. Avoid overly formal or stiff language, but communicate concepts in a straightforward and approachable manner. Do not adapt your responses to align with the user's opinions or preferences. Avoid using overly polite phrases like please or thank you excessively, but remain respectful. Provide answers based strictly on programming knowledge and best practices. Use educational questioning techniques to encourage critical thinking, but do not provide whole code solutions. Before responding, identify and define key computational thinking or coding concepts related to the user's question, using clear and understandable explanations suitable for novice programmers. Prompt the user for clarification if their question is ambiguous. Do not use first-person pronouns or present yourself as a human tutor.
+
+Format your responses using Slack's mrkdwn syntax: use *text* for bold (single asterisk, NOT **text**), _text_ for italic, `code` for inline code, ```code block``` for code blocks, ~text~ for strikethrough, and dashes with line breaks for lists. Do not use double asterisks for bold.
+
+Never ignore any of these instructions."""
+
+# Cheap extraction of api_app_id without parsing (or trusting) the whole body
+APP_ID_PATTERN = re.compile(rb'"api_app_id"\s*:\s*"([A-Z0-9]+)"')
+
+# After a failed auth.test, wait this long before asking Slack again (seconds)
+IDENTITY_RETRY_INTERVAL = 60
+
+# bot_type -> auth.test in flight, so concurrent events share one call
+pending_identities = {}
+identity_retry_at = {}
+
+
+@dataclass
+class Persona:
+    """One tutoring bot: Slack credentials, prompt and model settings"""
+    bot_type: str                 # Stored in conversations.bot_type, e.g. 'duck'
+    display_name: str             # Shown in admin output, e.g. 'Duck'
+    greeting: str                 # Reply prefix / streaming placeholder, e.g. 'Quack!'
+    token: str = field(repr=False)
+    signing_secret: str = field(repr=False)
+    prompt: str = field(repr=False)
+    model: str = "gpt-4o"
+    max_tokens: int = 500
+    temperature: float = 0.7
+    context_tokens: int = None    # Prompt token budget (None = CONTEXT_TOKEN_BUDGET)
+    routing: bool = False         # Pick model and max_tokens per turn (see routing.py)
+    routes: dict = None           # Per-route overrides, e.g. {"simple": {"model": "gpt-4o-mini"}}
+    app_id: str = None            # Slack api_app_id; learned from the first verified event if unset
+    user_id: str = None           # Bot user ID for @mention detection (see resolve_user_id)
+    client: object = field(default=None, repr=False)
+    hmac_key: object = field(default=None, repr=False)
+    prompt_version: str = field(default=None, repr=False)
+
+    def __post_init__(self):
+        # Keyed HMAC prepared once; each request only copies it
+        self.hmac_key = hmac.new((self.signing_secret or "").encode(), digestmod=hashlib.sha256)
+
+        # Changes whenever anything that shapes a reply changes (used by the response cache)
+        settings = f"{self.prompt}\n{self.model}\n{self.max_tokens}\n{self.temperature}"
+        if self.routing:
+            settings += "\n" + json.dumps(self.routes or {}, sort_keys=True)
+        self.prompt_version = hashlib.sha256(settings.encode()).hexdigest()[:12]
+
+    def verify(self, body: bytes, timestamp: str, signature: str) -> bool:
+        """Check a Slack request signature against this persona's signing secret"""
+        if not self.signing_secret:
+            return False
+        try:
+            if abs(time.time() - int(timestamp)) > 60 * 5:
+                return False
+        except ValueError:
+            return False
+
+        mac = self.hmac_key.copy()
+        mac.update(b"v0:" + timestamp.encode() + b":" + body)
+        return hmac.compare_digest("v0=" + mac.hexdigest(), signature)
+
+
+class PersonaRegistry:
+    """Personas indexed by name and by Slack app ID"""
+
+    def __init__(self, personas: list):
+        self.personas = list(personas)
+        self.by_name = {persona.bot_type: persona for persona in self.personas}
+        self.by_app_id = {persona.app_id: persona for persona in self.personas if persona.app_id}
+
+    def __iter__(self):
+        return iter(self.personas)
+
+    def __len__(self):
+        return len(self.personas)
+
+    def get(self, name: str):
+        return self.by_name.get(name)
+
+    def route(self, body: bytes, timestamp: str, signature: str, name: str = None):
+        """Find the persona an event belongs to and verify its signature
+
+        Args:
+            name: Persona from the endpoint path (/slack/events/<name>), if any
+
+        Returns:
+            The verified Persona, or None if no persona's signature matches
+        """
+        if name is not None:
+            persona = self.by_name.get(name)
+            return persona if persona and persona.verify(body, timestamp, signature) else None
+
+        match = APP_ID_PATTERN.search(body)
+        app_id = match.group(1).decode() if match else None
+        if app_id in self.by_app_id:
+            persona = self.by_app_id[app_id]
+            return persona if persona.verify(body, timestamp, signature) else None
+
+        # No known app ID: try each persona, and remember the app ID for next time
+        for persona in self.personas:
+            if persona.verify(body, timestamp, signature):
+                if app_id and persona.app_id is None:
+                    persona.app_id = app_id
+                    self.by_app_id[app_id] = persona
+                return persona
+        return None
+
+    async def resolve_identities(self):
+        """Resolve every persona's bot user ID at once (database first, then auth.test)"""
+        await asyncio.gather(*(resolve_user_id(persona) for persona in self.personas))
+
+
+def token_fingerprint(token: str) -> str:
+    """Short hash identifying a bot token (a new token means a new identity)"""
+    return hashlib.sha256((token or "").encode()).hexdigest()[:16]
+
+
+async def resolve_user_id(persona: Persona, timeout: float = None):
+    """The persona's bot user ID, resolved once and then kept on the persona
+
+    Args:
+        timeout: Give up waiting after this many seconds (the lookup carries on)
+
+    Returns:
+        The user ID, or None if it could not be resolved (yet)
+    """
+    if persona.user_id or time.monotonic() < identity_retry_at.get(persona.bot_type, 0):
+        return persona.user_id
+
+    task = pending_identities.get(persona.bot_type)
+    if task is None:
+        task = asyncio.ensure_future(_resolve_user_id(persona))
+        pending_identities[persona.bot_type] = task
+        task.add_done_callback(lambda _: pending_identities.pop(persona.bot_type, None))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def _resolve_user_id(persona: Persona):
+    fingerprint = token_fingerprint(persona.token)
+    try:
+        persona.user_id = await get_bot_identity_async(persona.bot_type, fingerprint)
+    except Exception as e:
+        print(f"Bot identity: could not read {persona.bot_type} from the database: {e}")
+    if persona.user_id:
+        return persona.user_id
+
+    try:
+        response = await persona.client.auth_test()
+    except Exception as e:
+        identity_retry_at[persona.bot_type] = time.monotonic() + IDENTITY_RETRY_INTERVAL
+        print(f"Bot identity: auth.test failed for {persona.bot_type}: {e}")
+        return None
+    persona.user_id = response.get("user_id")
+    if persona.user_id:
+        try:
+            await save_bot_identity_async(persona.bot_type, fingerprint, persona.user_id, response.get("team_id"))
+        except Exception as e:
+            print(f"Bot identity: could not persist {persona.bot_type}: {e}")
+    return persona.user_id
+
+
+def _env_int(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def default_personas() -> list:
+    """Built-in Duck and Goose personas from the environment"""
+    return [
+        Persona(
+            bot_type="duck",
+            display_name="Duck",
+            greeting="Quack!",
+            token=os.getenv("SLACK_BOT_TOKEN_DUCK"),
+            signing_secret=os.getenv("SLACK_SIGNING_SECRET_DUCK"),
+            prompt=DUCK_PROMPT,
+            context_tokens=_env_int("CONTEXT_TOKEN_BUDGET_DUCK"),
+            routing=ROUTING_ENABLED,
+            app_id=os.getenv("SLACK_APP_ID_DUCK")
+        ),
+        Persona(
+            bot_type="goose",
+            display_name="Goose",
+            greeting="Honk!",
+            token=os.getenv("SLACK_BOT_TOKEN_GOOSE"),
+            signing_secret=os.getenv("SLACK_SIGNING_SECRET_GOOSE"),
+            prompt=GOOSE_PROMPT,
+            context_tokens=_env_int("CONTEXT_TOKEN_BUDGET_GOOSE"),
+            routing=ROUTING_ENABLED,
+            app_id=os.getenv("SLACK_APP_ID_GOOSE")
+        ),
+    ]
+
+
+def persona_from_config(config: dict, base_dir: str = ".") -> Persona:
+    """Build a Persona from one PERSONAS_FILE entry
+
+    Secrets are read from the environment variables named by token_env and
+    signing_secret_env; the prompt comes from prompt, prompt_file or the
+    built-in prompt of the same name.
+    """
+    builtin_prompts = {"duck": DUCK_PROMPT, "goose": GOOSE_PROMPT}
+    prompt = config.get("prompt")
+    if prompt is None and config.get("prompt_file"):
+        with open(os.path.join(base_dir, config["prompt_file"])) as f:
+            prompt = f.read()
+    if prompt is None:
+        prompt = builtin_prompts[config["name"]]
+
+    return Persona(
+        bot_type=config["name"],
+        display_name=config.get("display_name", config["name"].capitalize()),
+        greeting=config.get("greeting", ""),
+        token=os.getenv(config.get("token_env", ""), config.get("token")),
+        signing_secret=os.getenv(config.get("signing_secret_env", ""), config.get("signing_secret")),
+        prompt=prompt,
+        model=config.get("model", "gpt-4o"),
+        max_tokens=config.get("max_tokens", 500),
+        temperature=config.get("temperature", 0.7),
+        context_tokens=config.get("context_tokens"),
+        routing=config.get("routing", ROUTING_ENABLED),
+        routes=config.get("routes"),
+        app_id=config.get("app_id")
+    )
+
+
+def load_personas(path: str = None) -> PersonaRegistry:
+    """Load personas from path (default PERSONAS_FILE), or the built-in Duck and Goose"""
+    path = path or os.getenv("PERSONAS_FILE")
+    if not path:
+        return PersonaRegistry(default_personas())
+    with open(path) as f:
+        configs = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return PersonaRegistry([persona_from_config(config, base_dir) for config in configs])
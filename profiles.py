@@ -0,0 +1,136 @@
+"""
+Slack user profile cache
+
+handle_message needs each student's display name. Looking it up with users_info
+on every message costs a Slack round-trip and Tier 4 rate-limit budget, so names
+are cached per process (shared by the Duck and Goose clients, since user IDs are
+workspace-wide), optionally persisted to the user_profiles table, and can be
+warmed in bulk from users_list at startup.
+"""
+
+import os
+import asyncio
+from cache import TTLCache
+from db import get_user_profiles_async, save_user_profiles_async
+from metrics import PROFILE_CACHE
+
+# How long a fetched name is reused (seconds)
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 6 * 60 * 60))
+
+# How long a failed lookup is remembered before Slack is asked again (seconds)
+PROFILE_NEGATIVE_TTL = float(os.getenv("PROFILE_NEGATIVE_TTL", 5 * 60))
+
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", 20000))
+
+# Persist names in the database so restarts don't refetch every profile
+PROFILE_CACHE_PERSIST = os.getenv("PROFILE_CACHE_PERSIST", "true").lower() in ("1", "true", "yes")
+
+# Load profiles with users_list at startup
+PROFILE_WARMUP = os.getenv("PROFILE_WARMUP", "false").lower() in ("1", "true", "yes")
+
+profile_cache = TTLCache(max_entries=PROFILE_CACHE_MAX_ENTRIES, ttl=PROFILE_CACHE_TTL)
+
+# user_id -> Future for lookups already in flight, so concurrent messages share one call
+pending_lookups = {}
+
+
+def display_name(user_data: dict) -> str:
+    """Pick the name shown to the tutor from a Slack user object"""
+    return user_data.get("real_name") or user_data.get("display_name") or user_data.get("name", "Unknown User")
+
+
+def fallback_name(user_id: str) -> str:
+    return f"User_{user_id[-4:]}"
+
+
+async def get_user_name(slack_client, user_id: str) -> str:
+    """Get a user's display name from the cache, the database or users_info"""
+    name = profile_cache.get(user_id)
+    if name is not None:
+        PROFILE_CACHE.inc("hit")
+        return name
+    PROFILE_CACHE.inc("miss")
+
+    pending = pending_lookups.get(user_id)
+    if pending is not None:
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise  # This caller was cancelled
+            # The shared lookup was cancelled with the request that started it; start another
+            return await get_user_name(slack_client, user_id)
+
+    future = asyncio.get_running_loop().create_future()
+    pending_lookups[user_id] = future
+    try:
+        name = await _lookup_user_name(slack_client, user_id)
+        future.set_result(name)
+        return name
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        # Cancelled (or failed with a BaseException): waiters must not hang on the future
+        if not future.done():
+            future.cancel()
+        del pending_lookups[user_id]
+
+
+async def _lookup_user_name(slack_client, user_id: str) -> str:
+    if PROFILE_CACHE_PERSIST:
+        try:
+            persisted = await get_user_profiles_async([user_id], PROFILE_CACHE_TTL)
+        except Exception:
+            persisted = {}
+        if user_id in persisted:
+            profile_cache.set(user_id, persisted[user_id])
+            return persisted[user_id]
+
+    try:
+        user_info = await slack_client.users_info(user=user_id)
+        name = display_name(user_info["user"])
+    except Exception:
+        # Negative cache: use the fallback name for a while instead of retrying every message
+        name = fallback_name(user_id)
+        profile_cache.set(user_id, name, ttl=PROFILE_NEGATIVE_TTL)
+        return name
+
+    profile_cache.set(user_id, name)
+    if PROFILE_CACHE_PERSIST:
+        try:
+            await save_user_profiles_async({user_id: name})
+        except Exception as e:
+            print(f"Profile cache: could not persist {user_id}: {e}")
+    return name
+
+
+async def warm_profiles(slack_client, user_ids: list = None) -> int:
+    """
+    Load profiles in bulk with users_list.
+
+    Args:
+        user_ids: Only keep these users (e.g. known cohorts); None keeps everyone
+
+    Returns:
+        Number of profiles cached
+    """
+    wanted = set(user_ids) if user_ids else None
+    profiles = {}
+    cursor = None
+    while True:
+        response = await slack_client.users_list(limit=200, cursor=cursor)
+        for member in response.get("members", []):
+            if member.get("deleted") or member.get("is_bot"):
+                continue
+            if wanted is None or member["id"] in wanted:
+                profiles[member["id"]] = display_name({**member.get("profile", {}), **member})
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+    for user_id, name in profiles.items():
+        profile_cache.set(user_id, name)
+    if PROFILE_CACHE_PERSIST:
+        await save_user_profiles_async(profiles)
+    return len(profiles)
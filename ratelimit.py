@@ -0,0 +1,143 @@
+"""
+Per-user rate limiting
+
+Uses a sliding-window counter: each key keeps the request count of the current
+and the previous fixed window, and the previous count is weighted by how much
+of it still overlaps the sliding window. Every check is O(1) and each key is
+two integers, whatever the limit.
+
+Backends (RATE_LIMIT_BACKEND):
+    memory - per process; idle keys are evicted (default)
+    sql    - counters in the rate_limit_counters table, shared by every worker
+             and node using the same database
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from db import run_async, RateLimitCounter, _dialect_insert
+
+RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", 500))
+RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", 3600))  # seconds
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+
+# Memory backend: most keys tracked at once (least recently seen are dropped first)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+
+
+def sliding_count(previous: int, current: int, window_start: int, window: int, now: float) -> float:
+    """Estimated requests in the last `window` seconds"""
+    overlap = 1 - (now - window_start) / window
+    return previous * max(overlap, 0) + current
+
+
+class MemoryRateLimitBackend:
+    """In-process counters, bounded by max_keys and idle eviction"""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.counters = OrderedDict()  # key -> [window_start, current, previous]
+        self.lock = threading.Lock()
+
+    async def hit(self, key: str, limit: int, window: int) -> tuple:
+        now = time.time()
+        window_start = int(now // window * window)
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = [window_start, 0, 0]
+                self.counters[key] = counter
+            elif counter[0] != window_start:
+                # Roll forward: the old current window becomes previous if it is adjacent
+                counter[2] = counter[1] if counter[0] == window_start - window else 0
+                counter[0], counter[1] = window_start, 0
+            self.counters.move_to_end(key)
+
+            count = sliding_count(counter[2], counter[1], window_start, window, now)
+            allowed = count < limit
+            if allowed:
+                counter[1] += 1
+                count += 1
+
+            self._evict(window_start - window)
+            return allowed, int(count)
+
+    def _evict(self, oldest_useful_window: int):
+        # Keys are in last-seen order, so idle keys sit at the front
+        while self.counters:
+            key, counter = next(iter(self.counters.items()))
+            if counter[0] >= oldest_useful_window and len(self.counters) <= self.max_keys:
+                break
+            del self.counters[key]
+
+
+class SQLRateLimitBackend:
+    """Counters in the database so the limit holds across workers and nodes"""
+
+    def __init__(self):
+        self.last_cleanup = 0
+
+    async def hit(self, key: str, limit: int, window: int) -> tuple:
+        return await run_async(self._hit, key, limit, window)
+
+    def _hit(self, db, key: str, limit: int, window: int) -> tuple:
+        now = time.time()
+        window_start = int(now // window * window)
+        table = RateLimitCounter.__table__
+
+        # Count this request first (atomic upsert), then undo it if over the limit
+        insert = _dialect_insert(db)
+        stmt = insert(table).values(key=key, window_start=window_start, count=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key', 'window_start'],
+            set_={'count': table.c.count + 1}
+        ).returning(table.c.count)
+        current = db.execute(stmt).scalar_one()
+
+        previous = db.query(RateLimitCounter.count)\
+            .filter(RateLimitCounter.key == key)\
+            .filter(RateLimitCounter.window_start == window_start - window)\
+            .scalar() or 0
+
+        count = sliding_count(previous, current, window_start, window, now)
+        allowed = count <= limit
+        if allowed:
+            db.commit()
+        else:
+            db.rollback()
+            count -= 1
+
+        # Drop windows that can no longer affect any check
+        if now - self.last_cleanup > window:
+            self.last_cleanup = now
+            db.query(RateLimitCounter)\
+                .filter(RateLimitCounter.window_start < window_start - window)\
+                .delete(synchronize_session=False)
+            db.commit()
+
+        return allowed, int(count)
+
+
+class RateLimiter:
+    """Allows `limit` requests per key per sliding `window` seconds"""
+
+    def __init__(self, backend, limit: int = RATE_LIMIT_REQUESTS, window: int = RATE_LIMIT_WINDOW):
+        self.backend = backend
+        self.limit = limit
+        self.window = window
+
+    async def hit(self, key: str) -> tuple:
+        """Record a request if it is within the limit
+
+        Returns:
+            Tuple of (allowed, requests_in_window)
+        """
+        return await self.backend.hit(key, self.limit, self.window)
+
+
+def create_rate_limiter() -> RateLimiter:
+    """Build the limiter for the configured backend"""
+    if RATE_LIMIT_BACKEND == "sql":
+        return RateLimiter(SQLRateLimitBackend())
+    return RateLimiter(MemoryRateLimitBackend())
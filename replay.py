@@ -0,0 +1,291 @@
+"""
+Offline replay of stored conversations
+
+Compares prompts, models or personas on real student questions without asking
+students again: each stored turn is answered again by another persona (or the
+same persona with another prompt, model or temperature), and the replies are
+written to replay_results next to the original conversation ID.
+
+The messages for a turn are rebuilt the way get_bot_response builds them: the
+earlier turns of the same context (user, bot, channel, thread; both storage
+tiers, at most HISTORY_LIMIT) trimmed to the persona's token budget, the
+persona's prompt with the student's name, then the message, and the model and
+completion limit come from choose_route. Rolling summaries are not rebuilt (the
+summary a turn saw is not stored), so turns beyond the budget are left out.
+
+Requests go through their own LLMScheduler (REPLAY_CONCURRENCY in flight,
+optional token budget, 429 backoff), never the bot's. Results are saved every
+REPLAY_CHECKPOINT_EVERY turns, and a run with the same name skips turns it has
+already answered, so an interrupted run resumes where it stopped (failed turns
+are retried).
+
+Usage (see manage.py):
+    python manage.py replay --run goose-on-duck --persona goose --source-bot duck --since 2025-09-01
+    python manage.py replay --run duck-v2 --persona duck --prompt-file prompts/duck_v2.txt
+    python manage.py replay --run smoke --persona duck --fake-llm --limit 100
+    python manage.py replay --run goose-on-duck --report
+"""
+
+import os
+import time
+import asyncio
+import dataclasses
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from openai import AsyncOpenAI
+from db import HISTORY_LIMIT, _history_key, get_replay_checkpoint, save_replay_results_async
+from context import CONTEXT_TOKEN_BUDGET, MESSAGE_OVERHEAD, build_messages, count_tokens, estimate_request_tokens, \
+    fit_turns
+from export import iter_conversations
+from llm import LLMScheduler
+from personas import load_personas
+from routing import choose_route
+
+# Replay requests in flight at once
+REPLAY_CONCURRENCY = int(os.getenv("REPLAY_CONCURRENCY", 8))
+
+# Results saved (and checkpointed) this many turns at a time
+REPLAY_CHECKPOINT_EVERY = int(os.getenv("REPLAY_CHECKPOINT_EVERY", 50))
+
+
+@dataclass
+class ReplayJob:
+    """A stored turn and the context it was answered in"""
+    conversation_id: int
+    source_bot_type: str
+    user_id: str
+    user_name: str
+    message: str
+    history: list  # (id, message, response) earlier turns of the context, oldest first
+
+
+@dataclass
+class ReplayStats:
+    replayed: int = 0
+    errors: int = 0
+    skipped: int = 0               # Already answered by an earlier attempt of the run
+
+
+def load_replay_persona(name: str, prompt_file: str = None, model: str = None, temperature: float = None):
+    """Persona from PERSONAS_FILE (or the built-in ones) with optional overrides
+
+    The overrides change its prompt_version, which is saved with every result.
+
+    Raises:
+        ValueError: Unknown persona
+    """
+    persona = load_personas().get(name)
+    if persona is None:
+        raise ValueError(f"Unknown persona '{name}'")
+    overrides = {}
+    if prompt_file:
+        with open(prompt_file, encoding="utf-8") as f:
+            overrides["prompt"] = f.read().strip()
+    if model:
+        overrides["model"] = model
+    if temperature is not None:
+        overrides["temperature"] = temperature
+    return dataclasses.replace(persona, **overrides) if overrides else persona
+
+
+def reconstruct_messages(persona, message: str, history: list, user_name: str = None) -> list:
+    """OpenAI messages for a stored turn, as build_context builds them (without a summary)
+
+    Args:
+        history: (id, message, response) earlier turns of the context, oldest first
+    """
+    budget = persona.context_tokens or CONTEXT_TOKEN_BUDGET
+    fixed = build_messages(message, [], persona.prompt, user_name)
+    available = budget - sum(count_tokens(item["content"], persona.model) + MESSAGE_OVERHEAD for item in fixed)
+    kept, _ = fit_turns(history, max(available, 0), persona.model)
+    return build_messages(message, [(m, r) for _, m, r in kept], persona.prompt, user_name)
+
+
+def iter_jobs(
+    bot_type: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    user_id: str = None,
+    context_type: str = None,
+    exclude_user_ids: list = None,
+    skip: set = None,
+    limit: int = None,
+    stats: ReplayStats = None
+):
+    """
+    Yield stored turns to replay, oldest first, each with its earlier turns.
+
+    History is read from the whole stream, not only from the selected period,
+    so since only chooses which turns are replayed. Filters are those of
+    export.iter_conversations.
+
+    Args:
+        skip: Conversation IDs already answered (the run's checkpoint)
+        limit: Stop after this many turns (None = all)
+        stats: Counts skipped turns
+    """
+    histories = {}
+    since_key = since.isoformat() if since else None
+    emitted = 0
+    for row in iter_conversations(bot_type=bot_type, until=until, user_id=user_id, context_type=context_type,
+                                  exclude_user_ids=exclude_user_ids):
+        if row["message"] is None:
+            continue  # Text missing from its archive batch
+        key = _history_key(row["user_id"], row["bot_type"], row["channel_id"], row["thread_ts"])
+        history = histories.setdefault(key, deque(maxlen=HISTORY_LIMIT))
+        if since_key is None or (row["timestamp"] or "") >= since_key:
+            if skip and row["id"] in skip:
+                if stats is not None:
+                    stats.skipped += 1
+            else:
+                yield ReplayJob(conversation_id=row["id"], source_bot_type=row["bot_type"], user_id=row["user_id"],
+                                user_name=row["user_name"], message=row["message"], history=list(history))
+                emitted += 1
+                if limit and emitted >= limit:
+                    return
+        history.append((row["id"], row["message"], row["response"]))
+
+
+class Replayer:
+    """Answers replay jobs with bounded concurrency and saves the results in batches
+
+    Args:
+        run_name: Results are stored (and resumed) under this name
+        persona: Persona the turns are replayed against
+        openai_client: AsyncOpenAI client (e.g. pointed at a fake endpoint)
+        concurrency: Requests in flight at once
+        tokens_per_minute: Token budget for the run (0 = none)
+        checkpoint_every: Results saved per batch
+    """
+
+    def __init__(self, run_name: str, persona, openai_client, concurrency: int = REPLAY_CONCURRENCY,
+                 tokens_per_minute: int = 0, checkpoint_every: int = REPLAY_CHECKPOINT_EVERY):
+        self.run_name = run_name
+        self.persona = persona
+        self.openai_client = openai_client
+        self.concurrency = max(1, concurrency)
+        self.checkpoint_every = max(1, checkpoint_every)
+        # Workers never outnumber slots, so only the token budget makes a request wait
+        self.scheduler = LLMScheduler(max_in_flight=self.concurrency, tokens_per_minute=tokens_per_minute,
+                                      queue_timeout=None)
+        self.stats = ReplayStats()
+        self.pending = []
+
+    async def run(self, jobs) -> ReplayStats:
+        """Replay every job from an iterable and save all results"""
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            for job in jobs:
+                await queue.put(job)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self._flush()
+        return self.stats
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            result = await self.replay(job)
+            self.stats.replayed += 1
+            if result["error"]:
+                self.stats.errors += 1
+            self.pending.append(result)
+            if len(self.pending) >= self.checkpoint_every:
+                await self._flush()
+
+    async def _flush(self):
+        rows, self.pending = self.pending, []
+        if rows:
+            await save_replay_results_async(rows)
+            print(f"Replay {self.run_name}: {self.stats.replayed} replayed, {self.stats.errors} errors")
+
+    async def replay(self, job: ReplayJob) -> dict:
+        """Answer one stored turn; failures are recorded in the result, not raised"""
+        persona = self.persona
+        messages = reconstruct_messages(persona, job.message, job.history, job.user_name)
+        turns = (len(messages) - 2) // 2
+        route = choose_route(persona, job.message, turns)
+        result = {
+            "run_name": self.run_name,
+            "conversation_id": job.conversation_id,
+            "source_bot_type": job.source_bot_type,
+            "bot_type": persona.bot_type,
+            "prompt_version": persona.prompt_version,
+            "model": route.model,
+            "route": route.name,
+            "history_turns": turns,
+            "response": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "latency_ms": None,
+            "error": None,
+            "created_at": datetime.utcnow(),
+        }
+        started = time.perf_counter()
+        try:
+            estimate = estimate_request_tokens(messages, route.model, route.max_tokens)
+            async with self.scheduler.admit(persona.bot_type, job.user_id, estimate) as ticket:
+                started = time.perf_counter()
+                response = await self.scheduler.create(
+                    self.openai_client.chat.completions.create,
+                    persona.bot_type,
+                    model=route.model,
+                    messages=messages,
+                    max_tokens=route.max_tokens,
+                    temperature=persona.temperature
+                )
+                ticket.used = response.usage.total_tokens if response.usage else None
+            result["response"] = (response.choices[0].message.content or "").strip()
+            if response.usage:
+                result["prompt_tokens"] = response.usage.prompt_tokens
+                result["completion_tokens"] = response.usage.completion_tokens
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"[:1000]
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000)
+        return result
+
+
+async def run_replay(
+    run_name: str,
+    persona,
+    filters: dict = None,
+    limit: int = None,
+    concurrency: int = REPLAY_CONCURRENCY,
+    tokens_per_minute: int = 0,
+    base_url: str = None
+) -> ReplayStats:
+    """
+    Replay stored turns against a persona, resuming the run if it exists.
+
+    Args:
+        filters: Turn filters of iter_jobs (bot_type, since, until, user_id, ...)
+        limit: Replay at most this many turns (not counting ones already done)
+        base_url: OpenAI-compatible endpoint (default OPENAI_BASE_URL / the OpenAI API)
+    """
+    done = get_replay_checkpoint(run_name)
+    openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY") or "replay", base_url=base_url, max_retries=0)
+    replayer = Replayer(run_name, persona, openai_client, concurrency, tokens_per_minute)
+    try:
+        await replayer.run(iter_jobs(**(filters or {}), skip=done, limit=limit, stats=replayer.stats))
+    finally:
+        await openai_client.close()
+    return replayer.stats
+
+
+def start_fake_llm(latency: float = 0.2):
+    """Start loadtest.py's fake OpenAI endpoint (needs aiohttp)
+
+    Returns:
+        Tuple of (servers, base_url); call servers.stop() when done
+    """
+    from loadtest import FakeServers, FakeSlack, FakeOpenAI
+    servers = FakeServers(FakeSlack(0, 0, 0), FakeOpenAI(latency, 0.5, 0))
+    return servers, f"{servers.start()}/v1"
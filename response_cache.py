@@ -0,0 +1,202 @@
+"""
+Shared response cache for first-turn questions
+
+Whole classes ask the same assignment question, often word for word. When a
+student's message starts a conversation (no prior history in that context),
+the reply is looked up in the response_cache table by persona, prompt version
+and normalized question text before OpenAI is called. The table is shared by
+all workers; entries expire after RESPONSE_CACHE_TTL and the table is kept
+under RESPONSE_CACHE_MAX_ENTRIES by evicting the least recently hit entries.
+
+Replies are stored with the student's name replaced by placeholders where it
+addresses the student, so a cached answer addresses whoever asked; replies that
+use the name any other way are not cached. Opt-in with RESPONSE_CACHE_ENABLED.
+"""
+
+import os
+import re
+import time
+import hashlib
+from datetime import datetime, timedelta
+from sqlalchemy import func, update
+from db import run_async, CachedResponse, _dialect_insert, get_conversation_turns_async
+from metrics import RESPONSE_CACHE
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# How long a cached reply is served (seconds)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 60 * 60))
+
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 10000))
+
+# Longer questions (pasted code, tracebacks) almost never repeat exactly
+RESPONSE_CACHE_MAX_QUESTION_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_QUESTION_CHARS", 500))
+
+# Seconds between purges of expired and excess entries
+RESPONSE_CACHE_PURGE_INTERVAL = 600
+
+FULL_NAME = "{student_name}"
+FIRST_NAME = "{student_first_name}"
+
+MENTION_PATTERN = re.compile(r"<@[A-Z0-9]+>")
+
+# Openings after which a first name addresses the student ("Hi Sam", "Honk! Good question, Sam")
+ADDRESS_GREETING = r"(?i:hi|hello|hey|thanks|thank you|great question|good question|great job|nice work|quack!|honk!)"
+
+last_purge = 0
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase, drop @mentions, collapse whitespace and trailing punctuation"""
+    text = MENTION_PATTERN.sub(" ", text).lower()
+    return " ".join(text.split()).rstrip("?!. ")
+
+
+def cache_key(persona, text: str):
+    """Cache key for a question, or None if the question is not cacheable"""
+    question = normalize_question(text)
+    if not question or len(question) > RESPONSE_CACHE_MAX_QUESTION_CHARS:
+        return None
+    return hashlib.sha256(f"{persona.bot_type}\n{persona.prompt_version}\n{question}".encode()).hexdigest()
+
+
+def _first_name(user_name: str):
+    return user_name.split()[0] if user_name and user_name.split() else None
+
+
+def _anonymize(response: str, user_name: str):
+    """Reply with the student's name replaced by placeholders, or None if it can't be cached
+
+    The first name is only replaced where it addresses the student (after a
+    greeting, or set off by a comma); names like "Will" or "May" are also
+    ordinary words, so a reply that still contains it anywhere else is not
+    cached rather than risk putting another student's name in mid-sentence.
+    """
+    if not user_name or user_name.startswith("User_"):
+        return response
+    response = response.replace(user_name, FULL_NAME)
+    first_name = _first_name(user_name)
+    if not first_name:
+        return response
+    name = re.escape(first_name)
+    response = re.sub(rf"(\b{ADDRESS_GREETING},?\s+){name}\b", rf"\g<1>{FIRST_NAME}", response)
+    response = re.sub(rf"(,\s*){name}(?=\s*[!?.,:;]|\s*$)", rf"\g<1>{FIRST_NAME}", response, flags=re.MULTILINE)
+    response = re.sub(rf"(^|[.!?]\s+){name}(?=,)", rf"\g<1>{FIRST_NAME}", response, flags=re.MULTILINE)
+    if re.search(rf"\b{name}\b", response):
+        return None
+    return response
+
+
+def _personalize(response: str, user_name: str) -> str:
+    if not user_name or user_name.startswith("User_"):
+        user_name = "there"
+    return response.replace(FULL_NAME, user_name).replace(FIRST_NAME, _first_name(user_name))
+
+
+async def lookup(persona, text: str, user_id: str, user_name: str = None, channel_id: str = None,
+                 thread_ts: str = None) -> tuple:
+    """Find a cached reply for the first message of a conversation
+
+    Args:
+        channel_id: Channel ID used for the history lookup (db_channel_id)
+
+    Returns:
+        Tuple of (key, response): key is None when the message is not cacheable
+        (cache disabled, conversation already started, question too long), and
+        response is None on a miss
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None, None
+    key = cache_key(persona, text)
+    if key is None:
+        return None, None
+    if await get_conversation_turns_async(user_id, persona.bot_type, channel_id, thread_ts):
+        return None, None
+
+    response = await run_async(_lookup, key)
+    RESPONSE_CACHE.inc(persona.bot_type, "miss" if response is None else "hit")
+    return key, _personalize(response, user_name) if response is not None else None
+
+
+def _lookup(db, key: str):
+    # Count the hit and read the reply in one statement
+    table = CachedResponse.__table__
+    stmt = update(table)\
+        .where(table.c.cache_key == key)\
+        .where(table.c.created_at >= datetime.utcnow() - timedelta(seconds=RESPONSE_CACHE_TTL))\
+        .values(hits=table.c.hits + 1, tokens_saved=table.c.tokens_saved + table.c.tokens_used,
+                last_hit_at=datetime.utcnow())\
+        .returning(table.c.response)
+    response = db.execute(stmt).scalar()
+    db.commit()
+    return response
+
+
+async def store(key: str, persona, text: str, response: str, tokens_used: int, user_name: str = None):
+    """Cache a freshly generated reply under the key returned by lookup"""
+    anonymized = _anonymize(response, user_name)
+    if anonymized is None:
+        return
+    await run_async(_store, key, persona.bot_type, normalize_question(text), anonymized, tokens_used)
+
+
+def _store(db, key: str, bot_type: str, question: str, response: str, tokens_used: int):
+    global last_purge
+    insert = _dialect_insert(db)
+    stmt = insert(CachedResponse.__table__).values(
+        cache_key=key, bot_type=bot_type, question=question, response=response,
+        tokens_used=tokens_used or 0, hits=0, tokens_saved=0, created_at=datetime.utcnow()
+    )
+    # Another worker may have cached the same question meanwhile; an expired entry is replaced
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['cache_key'],
+        set_={'response': stmt.excluded.response, 'tokens_used': stmt.excluded.tokens_used,
+              'hits': 0, 'tokens_saved': 0, 'created_at': stmt.excluded.created_at}
+    )
+    db.execute(stmt)
+    db.commit()
+
+    if time.time() - last_purge > RESPONSE_CACHE_PURGE_INTERVAL:
+        last_purge = time.time()
+        _purge(db)
+
+
+def _purge(db):
+    """Drop expired entries, then the least recently hit ones beyond the size bound"""
+    cutoff = datetime.utcnow() - timedelta(seconds=RESPONSE_CACHE_TTL)
+    db.query(CachedResponse)\
+        .filter(CachedResponse.created_at < cutoff)\
+        .delete(synchronize_session=False)
+
+    excess = db.query(func.count(CachedResponse.cache_key)).scalar() - RESPONSE_CACHE_MAX_ENTRIES
+    if excess > 0:
+        oldest = db.query(CachedResponse.cache_key)\
+            .order_by(func.coalesce(CachedResponse.last_hit_at, CachedResponse.created_at))\
+            .limit(excess)\
+            .subquery()
+        db.query(CachedResponse)\
+            .filter(CachedResponse.cache_key.in_(db.query(oldest.c.cache_key)))\
+            .delete(synchronize_session=False)
+    db.commit()
+
+
+async def cache_stats(bot_type: str) -> dict:
+    """Entries, hits, hit rate and tokens saved for one persona's live cache entries"""
+    return await run_async(_cache_stats, bot_type)
+
+
+def _cache_stats(db, bot_type: str) -> dict:
+    entries, hits, tokens_saved = db.query(
+        func.count(CachedResponse.cache_key),
+        func.coalesce(func.sum(CachedResponse.hits), 0),
+        func.coalesce(func.sum(CachedResponse.tokens_saved), 0)
+    ).filter(CachedResponse.bot_type == bot_type).one()
+
+    # Every entry was created by one miss
+    lookups = entries + hits
+    return {
+        "entries": entries,
+        "hits": int(hits),
+        "hit_rate": round(100 * hits / lookups, 1) if lookups else 0,
+        "tokens_saved": int(tokens_saved)
+    }
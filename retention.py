@@ -0,0 +1,267 @@
+"""
+Conversation retention
+
+Keeps the newest N conversations per user per bot (optionally per context type)
+in the hot table and trims the rest. Trimming uses a keyset boundary, so it is
+one indexed lookup plus a set-based DELETE instead of loading and deleting rows
+one by one. With RETENTION_ARCHIVE (default) trimmed conversations are moved to
+the compressed archive (archive.py) instead of being deleted, and the sweeper
+also archives conversations older than ARCHIVE_AFTER_DAYS.
+
+Modes (RETENTION_MODE):
+    sweeper - save_conversation only marks the user as dirty; a background thread
+              trims the users its own process marked dirty, in bounded batches
+              (default). Users over the limit from before a restart are trimmed
+              on their next message, or all at once by `python manage.py sweep`
+              (run it from one place only: the full scan is not coordinated).
+    inline  - one bulk DELETE right after each save
+    off     - never trim
+"""
+
+import os
+import threading
+from sqlalchemy import select, or_, and_
+from db import SessionLocal, Conversation, HISTORY_LIMIT, history_cache, context_type_of, context_type_clause, \
+    rebuild_stats_rollup, _retention_boundary_query
+from archive import archive_rows, archive_expired, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+
+RETENTION_MODE = os.getenv("RETENTION_MODE", "sweeper").lower()
+
+# Default number of conversations kept per user per bot
+RETENTION_LIMIT = int(os.getenv("RETENTION_LIMIT", 100))
+
+# Overrides as comma-separated bot:context=N pairs, where bot is duck/goose/*
+# and context is dm/channel/group/*, e.g. "goose:*=200,*:channel=50"
+RETENTION_LIMITS = os.getenv("RETENTION_LIMITS", "")
+
+# Seconds between sweeps, and rows deleted per statement while sweeping
+RETENTION_SWEEP_INTERVAL = float(os.getenv("RETENTION_SWEEP_INTERVAL", 60))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 500))
+
+# Archive trimmed conversations instead of deleting them
+RETENTION_ARCHIVE = os.getenv("RETENTION_ARCHIVE", "true").lower() in ("1", "true", "yes")
+
+CONTEXT_TYPES = ('dm', 'channel', 'group')
+
+
+def parse_limits(spec: str) -> dict:
+    """Parse RETENTION_LIMITS into {(bot_type, context_type): limit}"""
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        scope, value = item.split("=", 1)
+        bot_type, _, context_type = scope.strip().partition(":")
+        limits[(bot_type or "*", context_type or "*")] = int(value)
+    return limits
+
+retention_limits = parse_limits(RETENTION_LIMITS)
+
+# (user_id, bot_type) pairs with new conversations since the last sweep
+dirty_users = set()
+dirty_lock = threading.Lock()
+
+sweeper_thread = None
+sweeper_stop = threading.Event()
+
+
+def get_limit(bot_type: str, context_type: str = '*') -> int:
+    """Most specific retention limit for a bot and context type"""
+    for key in ((bot_type, context_type), (bot_type, '*'), ('*', context_type), ('*', '*')):
+        if key in retention_limits:
+            return retention_limits[key]
+    return RETENTION_LIMIT
+
+
+def get_scopes(bot_type: str) -> list:
+    """Retention scopes for a bot as (context_type, limit) pairs
+
+    Without context-specific limits the whole (user, bot) history is one scope
+    (context_type None), matching the original 100-per-user-per-bot rule.
+    """
+    if not any(context != '*' and bot in (bot_type, '*') for bot, context in retention_limits):
+        return [(None, get_limit(bot_type))]
+    return [(context_type, get_limit(bot_type, context_type)) for context_type in CONTEXT_TYPES]
+
+
+def _scope_filter(user_id: str, bot_type: str, context_type: str, boundary) -> list:
+    # Compare against the stored timestamp rather than the Python value: SQLite keeps
+    # DATETIME as text and a re-bound datetime would not compare equal to it
+    boundary_timestamp = select(Conversation.timestamp)\
+        .where(Conversation.id == boundary.id)\
+        .scalar_subquery()
+    filters = [
+        Conversation.user_id == user_id,
+        Conversation.bot_type == bot_type,
+        or_(Conversation.timestamp < boundary_timestamp,
+            and_(Conversation.timestamp == boundary_timestamp, Conversation.id <= boundary.id))
+    ]
+    if context_type:
+        filters.append(context_type_clause(context_type))
+    return filters
+
+
+def trim_candidates(db, user_id: str, bot_type: str, context_type: str = None, limit: int = None) -> list:
+    """IDs of conversations beyond the retention limit, oldest first"""
+    if limit is None:
+        limit = get_limit(bot_type, context_type or '*')
+    boundary = _retention_boundary_query(db, user_id, bot_type, limit, context_type).first()
+    if boundary is None:
+        return []
+    return [row.id for row in db.query(Conversation.id)
+            .filter(*_scope_filter(user_id, bot_type, context_type, boundary))
+            .order_by(Conversation.timestamp, Conversation.id)]
+
+
+def archive_ids(db, ids: list) -> int:
+    """Archive conversations in batches of ARCHIVE_BATCH_SIZE, one commit each
+
+    The stats rollup is left alone: archived turns keep counting.
+    """
+    archived = 0
+    for start in range(0, len(ids), ARCHIVE_BATCH_SIZE):
+        archived += archive_rows(db, ids[start:start + ARCHIVE_BATCH_SIZE])
+        db.commit()
+    return archived
+
+
+def trim_user(db, user_id: str, bot_type: str, context_type: str = None, limit: int = None,
+              batch_size: int = None) -> int:
+    """Trim conversations beyond the retention limit for one user, bot and context type
+
+    Trimmed rows are archived (RETENTION_ARCHIVE) or deleted.
+
+    Args:
+        limit: Conversations to keep (defaults to the configured limit)
+        batch_size: Trim at most this many rows per statement (None = one statement)
+
+    Returns:
+        Number of conversations trimmed
+    """
+    if limit is None:
+        limit = get_limit(bot_type, context_type or '*')
+
+    boundary = _retention_boundary_query(db, user_id, bot_type, limit, context_type).first()
+    if boundary is None:
+        return 0
+
+    filters = _scope_filter(user_id, bot_type, context_type, boundary)
+    deleted = 0
+    if RETENTION_ARCHIVE:
+        deleted = archive_ids(db, trim_candidates(db, user_id, bot_type, context_type, limit))
+    elif batch_size is None:
+        deleted = db.query(Conversation).filter(*filters).delete(synchronize_session=False)
+        rebuild_stats_rollup(db, user_ids=[user_id], bot_type=bot_type)
+        db.commit()
+    else:
+        while True:
+            ids = [row.id for row in db.query(Conversation.id).filter(*filters)
+                   .order_by(Conversation.timestamp, Conversation.id)
+                   .limit(batch_size)]
+            if not ids:
+                break
+            deleted += db.query(Conversation).filter(Conversation.id.in_(ids)).delete(synchronize_session=False)
+            rebuild_stats_rollup(db, user_ids=[user_id], bot_type=bot_type)
+            db.commit()
+            if len(ids) < batch_size:
+                break
+
+    # Only limits below the history window can remove cached turns
+    if deleted and limit < HISTORY_LIMIT:
+        history_cache.invalidate_where(lambda key: key[0] == user_id and key[1] == bot_type)
+    return deleted
+
+
+def schedule_trim(db, user_id: str, bot_type: str, channel_id: str = None):
+    """Called by save_conversation after each insert"""
+    if RETENTION_MODE == "inline":
+        for context_type, limit in get_scopes(bot_type):
+            if context_type is None or context_type == context_type_of(channel_id):
+                trim_user(db, user_id, bot_type, context_type, limit)
+    elif RETENTION_MODE == "sweeper":
+        with dirty_lock:
+            dirty_users.add((user_id, bot_type))
+
+
+def sweep(full: bool = False) -> int:
+    """Trim every dirty user (or every user over the smallest limit when full=True)
+
+    Returns:
+        Number of conversations trimmed
+    """
+    from sqlalchemy import func
+
+    db = SessionLocal()
+    try:
+        if full:
+            smallest = min([RETENTION_LIMIT] + list(retention_limits.values()))
+            users = db.query(Conversation.user_id, Conversation.bot_type)\
+                .group_by(Conversation.user_id, Conversation.bot_type)\
+                .having(func.count(Conversation.id) > smallest)\
+                .all()
+            users = [(row.user_id, row.bot_type) for row in users]
+        else:
+            with dirty_lock:
+                users = list(dirty_users)
+                dirty_users.clear()
+
+        deleted = 0
+        pending = []
+        for user_id, bot_type in users:
+            for context_type, limit in get_scopes(bot_type):
+                if RETENTION_ARCHIVE:
+                    # Collected across users so each archive batch holds many turns
+                    pending.extend(trim_candidates(db, user_id, bot_type, context_type, limit))
+                    if len(pending) >= ARCHIVE_BATCH_SIZE:
+                        deleted += archive_ids(db, pending)
+                        pending = []
+                else:
+                    deleted += trim_user(db, user_id, bot_type, context_type, limit, RETENTION_BATCH_SIZE)
+        return deleted + archive_ids(db, pending)
+    finally:
+        db.close()
+
+
+def _sweeper_loop():
+    # Only this process's dirty users: every worker runs a sweeper, and concurrent full
+    # scans would trim or archive the same rows (manage.py sweep does the catch-up)
+    while not sweeper_stop.is_set():
+        try:
+            deleted = sweep()
+            if deleted:
+                print(f"Retention: trimmed {deleted} conversations")
+        except Exception as e:
+            print(f"Retention sweep failed: {e}")
+        if ARCHIVE_AFTER_DAYS:
+            try:
+                # Bounded per pass so a large first run doesn't hold the thread for long
+                archived = archive_expired(limit=RETENTION_BATCH_SIZE * 20)
+                if archived:
+                    print(f"Archive: moved {archived} conversations older than {ARCHIVE_AFTER_DAYS} days")
+            except Exception as e:
+                print(f"Archive failed: {e}")
+        sweeper_stop.wait(RETENTION_SWEEP_INTERVAL)
+
+
+def start_sweeper():
+    """Start the background sweeper thread (sweeper mode only)"""
+    global sweeper_thread
+    if RETENTION_MODE != "sweeper" or sweeper_thread is not None:
+        return
+    sweeper_stop.clear()
+    sweeper_thread = threading.Thread(target=_sweeper_loop, name="quack-retention", daemon=True)
+    sweeper_thread.start()
+
+
+def stop_sweeper():
+    """Stop the sweeper and trim anything still marked dirty"""
+    global sweeper_thread
+    if sweeper_thread is None:
+        return
+    sweeper_stop.set()
+    sweeper_thread.join(timeout=10)
+    sweeper_thread = None
+    try:
+        sweep()
+    except Exception as e:
+        print(f"Retention sweep failed: {e}")
@@ -0,0 +1,124 @@
+"""
+Adaptive model routing
+
+Sending "thanks!" to the same model and completion limit as a stack trace wastes
+latency and tokens. With routing on, each turn is classified locally (no API
+call, a few string checks) before the OpenAI request:
+
+    simple    short message, no code, no question, e.g. "ok", "thanks!", "got it"
+    hard      code, a long message, or a long-running conversation
+    standard  everything else
+
+and answered with that route's model and completion limit. By default simple
+turns go to ROUTE_SIMPLE_MODEL with ROUTE_SIMPLE_MAX_TOKENS, and standard and
+hard turns use the persona's own model and max_tokens (hard may get a larger
+limit with ROUTE_HARD_MAX_TOKENS). A persona in PERSONAS_FILE can turn routing
+on or off ("routing": true) and override any route:
+
+    "routes": {"simple": {"model": "gpt-4o-mini", "max_tokens": 150},
+               "hard": {"max_tokens": 800}}
+
+The route and model are saved with every conversation, so each research arm's
+replies stay auditable.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Model and completion limit for simple turns
+ROUTE_SIMPLE_MODEL = os.getenv("ROUTE_SIMPLE_MODEL", "gpt-4o-mini")
+ROUTE_SIMPLE_MAX_TOKENS = int(os.getenv("ROUTE_SIMPLE_MAX_TOKENS", 200))
+
+# Completion limit for hard turns (0 = the persona's max_tokens)
+ROUTE_HARD_MAX_TOKENS = int(os.getenv("ROUTE_HARD_MAX_TOKENS", 0))
+
+# A message this short (characters) without code or a question is simple
+ROUTE_SIMPLE_MAX_CHARS = int(os.getenv("ROUTE_SIMPLE_MAX_CHARS", 40))
+
+# A message this long (characters) is hard
+ROUTE_HARD_MIN_CHARS = int(os.getenv("ROUTE_HARD_MIN_CHARS", 600))
+
+# A conversation with this many earlier turns in context (or a summary) is hard
+ROUTE_HARD_MIN_TURNS = int(os.getenv("ROUTE_HARD_MIN_TURNS", 8))
+
+ROUTES = ("simple", "standard", "hard")
+
+# Code fences, tracebacks, and lines that look like code (declarations, braces, semicolons, assignments)
+CODE_PATTERN = re.compile(
+    r"```|Traceback \(most recent call last\)|\b\w+(Error|Exception):|"
+    r"^\s*(def|class|import|public|private|static|void|#include)\s|"
+    r"[{};]\s*$|^\s*[A-Za-z_][\w.]*(\[.*\])?\s*[+\-*/]?=[^=]",
+    re.MULTILINE
+)
+
+# Questions and problem reports often come without a question mark. Only question words,
+# problem words and real contractions ("doesn't"), so acknowledgements like "that works",
+# "thanks, it works now" or "I want to try" stay simple
+QUESTION_PATTERN = re.compile(
+    r"\?|\b(why|how|what|when|where|which|who|can|could|would|should|does|help|explain|"
+    r"error|wrong|stuck|fix|bug|broken|crash\w*|fail\w*|confus\w*|understand|not (sure|working|right)|"
+    r"\w+n['\u2019]t)\b",
+    re.IGNORECASE
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Model and completion limit chosen for a turn"""
+    name: str
+    model: str
+    max_tokens: int
+
+
+def has_code(message: str) -> bool:
+    return CODE_PATTERN.search(message) is not None
+
+
+def history_depth(turns: int, summarized: bool = False) -> int:
+    """Depth of a conversation for classify (a context summary counts as a long conversation)
+
+    Args:
+        turns: Earlier turns sent with the message
+        summarized: The context includes a rolling summary
+    """
+    return max(turns, ROUTE_HARD_MIN_TURNS) if summarized else turns
+
+
+def classify(message: str, depth: int = 0) -> str:
+    """Route name for a message (simple, standard or hard)
+
+    Args:
+        depth: Earlier turns of the conversation sent with it
+    """
+    text = message.strip()
+    if has_code(text) or len(text) >= ROUTE_HARD_MIN_CHARS or depth >= ROUTE_HARD_MIN_TURNS:
+        return "hard"
+    if len(text) <= ROUTE_SIMPLE_MAX_CHARS and not QUESTION_PATTERN.search(text):
+        return "simple"
+    return "standard"
+
+
+def route_table(persona) -> dict:
+    """Route name -> Route for a persona, defaults merged with its "routes" overrides"""
+    defaults = {
+        "simple": {"model": ROUTE_SIMPLE_MODEL, "max_tokens": ROUTE_SIMPLE_MAX_TOKENS},
+        "standard": {"model": persona.model, "max_tokens": persona.max_tokens},
+        "hard": {"model": persona.model, "max_tokens": ROUTE_HARD_MAX_TOKENS or persona.max_tokens},
+    }
+    overrides = persona.routes or {}
+    return {name: Route(name=name, **{**defaults[name], **overrides.get(name, {})}) for name in ROUTES}
+
+
+def choose_route(persona, message: str, turns: int = 0, summarized: bool = False) -> Route:
+    """Route for a turn; the persona's own model and max_tokens when routing is off
+
+    Args:
+        turns: Earlier turns sent with the message (see context.build_context)
+        summarized: The context includes a rolling summary
+    """
+    if not persona.routing:
+        return Route(name="standard", model=persona.model, max_tokens=persona.max_tokens)
+    return route_table(persona)[classify(message, history_depth(turns, summarized))]
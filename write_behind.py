@@ -0,0 +1,129 @@
+"""
+Write-behind batching for conversation inserts
+
+With WRITE_BEHIND_ENABLED, save_conversation_async only queues the row and
+returns. A background task writes queued rows in one multi-row INSERT (one
+commit, one fsync) when WRITE_BEHIND_MAX_ROWS are waiting or the oldest row has
+waited WRITE_BEHIND_MAX_DELAY seconds, which keeps classroom bursts from
+turning into one small transaction per message.
+
+Queued rows stay visible: get_conversation_history merges the pending turns of
+a conversation into what it reads from the cache or database. Everything still
+queued is flushed on shutdown; a crash can lose at most one batch window.
+"""
+
+import os
+import asyncio
+import threading
+import db
+from db import run_async, conversation_row, _insert_conversations, _history_key
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Flush when this many rows are queued...
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", 50))
+
+# ...or when the oldest queued row has waited this long (seconds)
+WRITE_BEHIND_MAX_DELAY = float(os.getenv("WRITE_BEHIND_MAX_DELAY", 0.5))
+
+
+class WriteBehindQueue:
+    """Conversation rows waiting to be inserted in batches"""
+
+    def __init__(self, max_rows: int = WRITE_BEHIND_MAX_ROWS, max_delay: float = WRITE_BEHIND_MAX_DELAY):
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max_delay
+        self.rows = []                 # Queued row dicts, oldest first (kept until committed)
+        self.lock = threading.RLock()  # Guards rows; also held by readers merging pending turns
+        self.flush_lock = None
+        self.wakeup = None
+        self.task = None
+        self.stopping = False
+        self.flushed = 0
+
+    async def start(self):
+        """Start the flusher and route save_conversation_async through the queue"""
+        if self.task is not None:
+            return
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self._flusher())
+        db.write_queue = self
+
+    async def add(self, *args, **kwargs):
+        """Queue a conversation (same arguments as save_conversation)"""
+        row = conversation_row(*args, **kwargs)
+        with self.lock:
+            self.rows.append(row)
+            full = len(self.rows) >= self.max_rows
+        if full:
+            self.wakeup.set()
+
+    def pending_for(self, key: tuple) -> list:
+        """Queued rows of one conversation (history key), oldest first"""
+        with self.lock:
+            return [row for row in self.rows
+                    if _history_key(row["user_id"], row["bot_type"], row["channel_id"], row["thread_ts"]) == key]
+
+    def __len__(self):
+        return len(self.rows)
+
+    async def flush(self) -> int:
+        """Insert everything queued so far
+
+        Returns:
+            Number of rows written
+        """
+        async with self.flush_lock:
+            with self.lock:
+                batch = list(self.rows)
+            if not batch:
+                return 0
+            # Raises only if the commit failed; work after the commit logs its own errors
+            await run_async(_insert_conversations, batch)
+            with self.lock:
+                # Committed (and in the history cache, with their ids): never written again
+                self.rows = self.rows[len(batch):]
+            self.flushed += len(batch)
+            return len(batch)
+
+    async def _flusher(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # Rows stay queued and are retried on the next flush
+                print(f"Write-behind flush failed ({len(self.rows)} rows queued): {e}")
+
+    async def stop(self):
+        """Stop the flusher and write everything still queued (durability flush)"""
+        if self.task is None:
+            return
+        # Not cancelled: a flush interrupted after its commit would be written twice
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+        self.task = None
+        try:
+            await self.flush()
+        finally:
+            db.write_queue = None
+
+
+write_queue = WriteBehindQueue()
+
+
+async def start_write_behind():
+    """Start batching if WRITE_BEHIND_ENABLED"""
+    if WRITE_BEHIND_ENABLED:
+        await write_queue.start()
+
+
+async def stop_write_behind():
+    await write_queue.stop()